@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+This module provides a streaming importer for archived databroker (MongoDB)
+tarballs, converting them to the local journal/index format so that past runs
+can be analyzed offline without restoring a Mongo instance.
+
+Supported archive members:
+    *.bson   : mongodump of the databroker collections (run_start, run_stop,
+               event_descriptor, event, resource, datum), requires pymongo (bson)
+    *.jsonl  : document journals written by docstream.DocumentJournal
+    db/      : raw MongoDB data directories (WiredTiger, e.g. the archives under
+               seisidd/private/test_10-1*-2019), read by seisidd.wiredtiger
+
+NOTE:
+* The archive is read twice, once for the run level documents (start,
+  descriptor, resource, stop) and once to stream the events and datum into the
+  journals, so the memory does not grow with the number of events.
+* The journals are rewritten on every import, importing an archive again
+  replaces its runs instead of appending to them.
+* The 10-17-2019 data directory only holds the mongod system collections
+  (admin, local, config) and the 10-18-2019 one no collection at all, the test
+  runs were not written there.  The namespaces found are reported.
+"""
+
+import os
+import json
+import time
+import tarfile
+
+from collections import defaultdict
+
+from .docstream import DocumentJournal, read_journal
+from .wiredtiger import is_wiredtiger_file, iter_wiredtiger_bson, databroker_name
+
+
+# databroker (v0/mongo_normalized) collection name to document name
+MONGO_COLLECTIONS = {
+    'run_start':        'start',
+    'run_stop':         'stop',
+    'event_descriptor': 'descriptor',
+    'event':            'event',
+    'resource':         'resource',
+    'datum':            'datum',
+}
+
+
+def _iter_bson(fileobj):
+    import bson
+    for doc in bson.decode_file_iter(fileobj):
+        doc.pop('_id', None)
+        yield doc
+
+
+def iter_archive_documents(tar_path: str, namespaces: set=None):
+    """
+    Stream the (name, doc) stored in an archive, the tarball is never extracted.
+
+    The documents of raw MongoDB data directories are deduplicated by uid (a
+    document can be both in a table and in the log), the MongoDB namespaces
+    they hold are added to namespaces when given.
+    """
+    _seen = set()
+    # random access mode, skipping the zero filled (preallocated) mongod logs
+    # of a gzip stream ('r|*') is quadratic
+    with tarfile.open(tar_path, 'r:*') as tar:
+        for member in tar:
+            _base = os.path.basename(member.name)
+            # skip directories and the macOS resource forks (._*)
+            if not member.isfile() or _base.startswith('._'):
+                continue
+            if is_wiredtiger_file(member.name):
+                for doc in iter_wiredtiger_bson(tar.extractfile(member), member.name):
+                    if 'ns' in doc and 'ident' in doc:
+                        # catalog entry of a collection
+                        if namespaces is not None:
+                            namespaces.add(doc['ns'])
+                        continue
+                    _name = databroker_name(doc)
+                    _key = (_name, doc.get('datum_id', doc.get('uid')))
+                    if _name is None or _key in _seen:
+                        continue
+                    _seen.add(_key)
+                    doc.pop('_id', None)
+                    yield _name, doc
+                continue
+            _collection, _ext = os.path.splitext(_base)
+            if _ext == '.bson' and _collection in MONGO_COLLECTIONS:
+                _name = MONGO_COLLECTIONS[_collection]
+                for doc in _iter_bson(tar.extractfile(member)):
+                    yield _name, doc
+            elif _ext == '.jsonl':
+                for line in tar.extractfile(member):
+                    try:
+                        _name, doc = json.loads(line)
+                    except ValueError:
+                        break  # truncated journal
+                    yield _name, doc
+
+
+def _index_runs(docs):
+    """
+    first pass, keep the run level documents (start, descriptor, resource and
+    stop), the events and datum are only counted
+    """
+    _starts = {}
+    _runs = defaultdict(lambda: defaultdict(list))
+    _counts = defaultdict(int)
+    _orphans = defaultdict(int)
+    for name, doc in docs:
+        _counts[name] += 1
+        if name == 'start':
+            _starts[doc['uid']] = doc
+        elif name in ('stop', 'descriptor'):
+            _runs[doc['run_start']][name].append(doc)
+        elif name == 'resource':
+            if doc.get('run_start'):
+                _runs[doc['run_start']][name].append(doc)
+            else:
+                _orphans['resource'] += 1
+    for _uid in set(_runs) - set(_starts):
+        for name, _list in _runs.pop(_uid).items():
+            _orphans[name] += len(_list)
+    return _starts, _runs, _counts, _orphans
+
+
+def import_archive(tar_path: str, journal_dir: str, index=None, verbose: bool=True):
+    """
+    Convert an archived databroker tarball into local journals (one per run).
+
+    Each run journal starts with the start, descriptor and resource documents,
+    followed by the datum and events (archive order) and the stop document,
+    then the number of documents in the journals is checked against the
+    archive.  Runs are added to index (a scanindex.ScanIndex) when given.
+
+    Example:
+    >> import_archive('dump_10-17-2019.tar.gz', '/data/journal_2019', index=ScanIndex())
+    >> {'runs': 3, 'archive': {'start': 3, ...}, 'journal': {...}, 'orphans': {}, 'verified': True}
+    """
+    _t0 = time.perf_counter()
+    _namespaces = set()
+    _starts, _runs, _archive_counts, _orphans = _index_runs(iter_archive_documents(tar_path, _namespaces))
+
+    _parent = {
+        'descriptor': {me['uid']: _uid for _uid, _run in _runs.items() for me in _run['descriptor']},
+        'resource':   {me['uid']: _uid for _uid, _run in _runs.items() for me in _run['resource']},
+    }
+    _journals = {}
+
+    def _journal(uid):
+        if uid not in _journals:
+            _journals[uid] = DocumentJournal(journal_dir, overwrite=True)
+            _journals[uid]('start', _starts[uid])
+            for name in ('descriptor', 'resource'):
+                for doc in _runs[uid][name]:
+                    _journals[uid](name, doc)
+        return _journals[uid]
+
+    # second pass, stream the events and datum into their run journal
+    for name, doc in iter_archive_documents(tar_path):
+        if name in ('event', 'event_page'):
+            _uid = _parent['descriptor'].get(doc['descriptor'])
+        elif name == 'datum':
+            _uid = _parent['resource'].get(doc['resource'])
+        else:
+            continue
+        if _uid is None:
+            _orphans[name] += 1
+            continue
+        _journal(_uid)(name, doc)
+
+    _files = []
+    for _uid in sorted(_starts, key=lambda me: _starts[me].get('time', 0)):
+        _stops = _runs[_uid]['stop']
+        if _stops:
+            _journal(_uid)('stop', _stops[0])
+        else:
+            # unfinished run, close the journal without a stop document
+            _journal(_uid).close()
+        _files.append(_journals[_uid].current_file)
+    _orphans = {k: v for k, v in _orphans.items() if v}
+
+    _journal_counts = defaultdict(int)
+    for _fn in _files:
+        for name, _ in read_journal(_fn):
+            _journal_counts[name] += 1
+    if index is not None:
+        for _fn in _files:
+            index.add_journals(_fn, reindex=True)
+
+    # extra stop documents of a run are not imported
+    _n_stops = sum(max(len(_run['stop']) - 1, 0) for _run in _runs.values())
+    _verified = all(
+        _journal_counts.get(name, 0) + _orphans.get(name, 0) + (_n_stops if name == 'stop' else 0) == _n
+        for name, _n in _archive_counts.items()
+    )
+    if verbose:
+        print(f"{os.path.basename(tar_path)}: {len(_files)} runs, {sum(_archive_counts.values())} documents "
+              f"in {time.perf_counter()-_t0:.2f} s")
+        if not _files:
+            print(f"No databroker documents found, MongoDB namespaces in the archive: {sorted(_namespaces)}")
+        if _orphans:
+            print(f"Documents without parent run (not imported): {_orphans}")
+        if not _verified:
+            print(f"Document count mismatch, archive {dict(_archive_counts)} vs journal {dict(_journal_counts)}")
+    return {
+        'runs':       len(_files),
+        'archive':    dict(_archive_counts),
+        'journal':    dict(_journal_counts),
+        'orphans':    _orphans,
+        'verified':   _verified,
+        'files':      _files,
+        'namespaces': sorted(_namespaces),
+    }
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
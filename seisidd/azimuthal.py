@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+This module provides the azimuthal integration (caking) of the far-field
+(FF-HEDM) frames into (eta, 2theta) images for ring checks and strain
+quick-looks.
+
+The pixel -> (eta, 2theta) bin assignment only depends on the detector geometry,
+it is computed once as a sparse lookup table (CSR matrix, one row per bin, with
+the fraction of each pixel falling into the bin) and then every frame (or block
+of frames) is integrated with a single sparse matrix product.
+
+Geometry (dict, lengths in mm, angles in degree):
+    shape      : (rows, cols) of the frame
+    pixel_size : (row, col) pixel pitch
+    center     : (row, col) of the direct beam on the detector, in pixels
+    distance   : sample to detector distance along the beam
+    tilt_x     : detector rotation about the horizontal axis
+    tilt_y     : detector rotation about the vertical axis
+eta is measured counter-clockwise from the horizontal (+x, to the right when
+looking downstream), 2theta from the beam.
+
+NOTE:
+* The lookup tables are cached on disk (~/.cache/seisidd/azimuthal by default),
+  keyed by the geometry, bins, sub-pixel sampling and mask.
+* scipy.sparse is used for the products when available, otherwise numpy
+  (slower, same result).
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+# Varex 4343CT (FF detector), nominal geometry before calibration
+VAREX_GEOMETRY = {
+    'shape':      (2880, 2880),
+    'pixel_size': (0.15, 0.15),
+    'center':     (1439.5, 1439.5),
+    'distance':   1000.0,
+    'tilt_x':     0.0,
+    'tilt_y':     0.0,
+}
+
+_GEOMETRY_KEYS = ('shape', 'pixel_size', 'center', 'distance', 'tilt_x', 'tilt_y')
+
+
+def detector_to_angles(rows, cols, geometry: dict):
+    """
+    (2theta, eta) in degree of detector positions (rows, cols) in pixels.
+
+    Example:
+    >> tth, eta = detector_to_angles(*np.mgrid[0:2880, 0:2880], VAREX_GEOMETRY)
+    """
+    _rows = np.asarray(rows, dtype=np.float64)
+    _cols = np.asarray(cols, dtype=np.float64)
+    _x = (_cols - geometry['center'][1])*geometry['pixel_size'][1]
+    _y = (geometry['center'][0] - _rows)*geometry['pixel_size'][0]
+    _tx, _ty = np.radians(geometry.get('tilt_x', 0.0)), np.radians(geometry.get('tilt_y', 0.0))
+    # detector plane rotated by Ry(tilt_y).Rx(tilt_x), then moved to distance along the beam
+    _y1, _z1 = _y*np.cos(_tx), _y*np.sin(_tx)
+    _x2 = _x*np.cos(_ty) + _z1*np.sin(_ty)
+    _z2 = -_x*np.sin(_ty) + _z1*np.cos(_ty) + geometry['distance']
+    _tth = np.degrees(np.arctan2(np.hypot(_x2, _y1), _z2))
+    _eta = np.degrees(np.arctan2(_y1, _x2))
+    return _tth, _eta
+
+
+def geometry_key(geometry: dict, **kwargs):
+    """hash of a geometry (and the other lookup table settings), used as cache key"""
+    _desc = {k: np.round(np.asarray(geometry[k], dtype=float), 6).tolist() for k in _GEOMETRY_KEYS if k in geometry}
+    _desc.update(kwargs)
+    return hashlib.sha1(json.dumps(_desc, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def build_lut(
+        geometry: dict,
+        tth_edges,
+        eta_edges,
+        n_sub: int=2,
+        mask=None,
+        block_rows: int=256,
+    ):
+    """
+    Sparse (n_eta*n_tth, n_pixels) lookup table as CSR arrays (indptr, indices, data).
+
+    Each pixel is sampled n_sub x n_sub times, data[k] is the fraction of pixel
+    indices[k] in the bin.  Pixels with mask True are left out.
+    """
+    _n_rows, _n_cols = geometry['shape']
+    _n_tth, _n_eta = len(tth_edges) - 1, len(eta_edges) - 1
+    _offsets = (np.arange(n_sub) + 0.5)/n_sub - 0.5
+    _bins, _pixels, _weights = [], [], []
+    for _r0 in range(0, _n_rows, block_rows):
+        _r = np.arange(_r0, min(_r0 + block_rows, _n_rows))
+        _rr, _cc, _dr, _dc = np.meshgrid(_r, np.arange(_n_cols), _offsets, _offsets, indexing='ij')
+        _tth, _eta = detector_to_angles(_rr + _dr, _cc + _dc, geometry)
+        _it = np.searchsorted(tth_edges, _tth, side='right') - 1
+        _ie = np.searchsorted(eta_edges, _eta, side='right') - 1
+        _valid = (_it >= 0) & (_it < _n_tth) & (_ie >= 0) & (_ie < _n_eta)
+        _pix = (_rr*_n_cols + _cc).astype(np.int64)
+        if mask is not None:
+            _valid &= ~np.asarray(mask, dtype=bool)[_rr, _cc]
+        # one entry per (bin, pixel), sub-samples of the same pixel in the same bin merged
+        _key, _count = np.unique(
+            (_ie[_valid].astype(np.int64)*_n_tth + _it[_valid])*(_n_rows*_n_cols) + _pix[_valid],
+            return_counts=True,
+        )
+        _bins.append(_key // (_n_rows*_n_cols))
+        _pixels.append(_key % (_n_rows*_n_cols))
+        _weights.append(_count/n_sub**2)
+    _bins = np.concatenate(_bins)
+    _order = np.argsort(_bins, kind='stable')
+    _indptr = np.zeros(_n_eta*_n_tth + 1, dtype=np.int64)
+    _indptr[1:] = np.cumsum(np.bincount(_bins, minlength=_n_eta*_n_tth))
+    return (
+        _indptr,
+        np.concatenate(_pixels)[_order].astype(np.int32),
+        np.concatenate(_weights)[_order].astype(np.float32),
+    )
+
+
+class AzimuthalIntegrator:
+    """
+    Caking of FF frames with a precomputed (cached) lookup table
+
+    Usage:
+    >> ai = AzimuthalIntegrator(geometry, tth_range=(2, 12), n_tth=1000, n_eta=360)
+    >> cake = ai.integrate(frame)          # (n_eta, n_tth), mean intensity per bin
+    >> cakes = ai.integrate(frames[0:16])  # (16, n_eta, n_tth)
+    >> ai.integrate1d(frame)               # (n_tth, ) ring profile
+    >> for start, cakes in ai.iter_integrate(h5f['/exchange/data'], block=16):
+    >>     ...
+    """
+
+    def __init__(
+            self,
+            geometry: dict=None,
+            tth_range: tuple=None,
+            n_tth: int=1000,
+            eta_range: tuple=(-180, 180),
+            n_eta: int=360,
+            n_sub: int=2,
+            mask=None,
+            cache_dir: str=None,
+        ):
+        self.geometry = dict(VAREX_GEOMETRY if geometry is None else geometry)
+        if tth_range is None:
+            # everything seen by the detector
+            _r, _c = self.geometry['shape']
+            _tth, _ = detector_to_angles([0, 0, _r-1, _r-1], [0, _c-1, 0, _c-1], self.geometry)
+            tth_range = (0.0, float(_tth.max()))
+        self.tth_edges = np.linspace(tth_range[0], tth_range[1], n_tth + 1)
+        self.eta_edges = np.linspace(eta_range[0], eta_range[1], n_eta + 1)
+        self.tth = (self.tth_edges[1:] + self.tth_edges[:-1])/2
+        self.eta = (self.eta_edges[1:] + self.eta_edges[:-1])/2
+        self.shape = (n_eta, n_tth)
+
+        _mask_hash = None if mask is None else hashlib.sha1(np.packbits(np.asarray(mask, dtype=bool))).hexdigest()
+        self.key = geometry_key(
+            self.geometry,
+            tth_range=[float(me) for me in tth_range], n_tth=n_tth,
+            eta_range=[float(me) for me in eta_range], n_eta=n_eta,
+            n_sub=n_sub, mask=_mask_hash,
+        )
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(
+            os.path.expanduser('~'), '.cache', 'seisidd', 'azimuthal',
+        )
+        self.lut_file = os.path.join(self.cache_dir, f"lut_{self.key}.npz")
+        if os.path.exists(self.lut_file):
+            with np.load(self.lut_file) as _lut:
+                self._indptr, self._indices, self._data = _lut['indptr'], _lut['indices'], _lut['data']
+        else:
+            self._indptr, self._indices, self._data = build_lut(
+                self.geometry, self.tth_edges, self.eta_edges, n_sub=n_sub, mask=mask,
+            )
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(
+                self.lut_file,
+                indptr=self._indptr, indices=self._indices, data=self._data,
+                geometry=json.dumps(self.geometry, default=list),
+            )
+        self._prepare()
+
+    def _prepare(self):
+        _n_bins = len(self._indptr) - 1
+        try:
+            from scipy import sparse
+        except ImportError:
+            self._csr = None
+            self._nonempty = np.nonzero(np.diff(self._indptr))[0]
+        else:
+            self._csr = sparse.csr_matrix(
+                (self._data, self._indices, self._indptr),
+                shape=(_n_bins, int(np.prod(self.geometry['shape']))),
+            )
+        # pixel fraction per bin, normalizes the sums into mean intensities
+        self.coverage = self._matvec(np.ones((1, int(np.prod(self.geometry['shape']))), dtype=np.float32))[0]
+
+    def _matvec(self, frames):
+        """(n, n_pixels) -> (n, n_bins) bin sums"""
+        if self._csr is not None:
+            return np.asarray((self._csr @ frames.T).T)
+        _sums = np.zeros((frames.shape[0], len(self._indptr) - 1))
+        if len(self._nonempty):
+            _products = frames[:, self._indices]*self._data
+            _sums[:, self._nonempty] = np.add.reduceat(_products, self._indptr[self._nonempty], axis=1)
+        return _sums
+
+    def integrate(self, frames, normalize: bool=True):
+        """
+        Cake one frame (rows, cols) or a block of frames (n, rows, cols).
+
+        Returns the mean intensity (normalize=True, NaN where no pixel) or the
+        sum per bin, shaped (n_eta, n_tth) or (n, n_eta, n_tth).
+        """
+        _frames = np.asarray(frames, dtype=np.float32)
+        _single = _frames.ndim == 2
+        _flat = _frames.reshape(1 if _single else _frames.shape[0], -1)
+        _sums = self._matvec(_flat)
+        if normalize:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                _sums = np.where(self.coverage > 0, _sums/self.coverage, np.nan)
+        _cakes = _sums.reshape((-1, ) + self.shape)
+        return _cakes[0] if _single else _cakes
+
+    def integrate1d(self, frames):
+        """ring profile(s) over all eta, (n_tth, ) or (n, n_tth)"""
+        _sums = self.integrate(frames, normalize=False)
+        _coverage = self.coverage.reshape(self.shape).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(_coverage > 0, _sums.sum(axis=-2)/_coverage, np.nan)
+
+    def iter_integrate(self, frames, block: int=16, normalize: bool=True):
+        """
+        Cake a stack of frames (array, h5py dataset, SparseFrames, ...) block by
+        block, yields (start, cakes).
+        """
+        for _start in range(0, len(frames), block):
+            yield _start, self.integrate(frames[_start:_start+block], normalize=normalize)
+
+    def integrate_file(self, src_file: str, dst_file: str=None, dataset: str='/exchange/data', block: int=16):
+        """
+        Cake all the frames of an FF file into a side file (*_cake.h5).
+
+        Example:
+        >> ai.integrate_file('/data/ff/Ti64_ff_000003.h5')
+        >> '/data/ff/Ti64_ff_000003_cake.h5'
+        """
+        import h5py
+        if dst_file is None:
+            dst_file = "_cake".join(os.path.splitext(src_file))
+        with h5py.File(src_file, 'r') as _src, h5py.File(dst_file, 'w') as _dst:
+            _data = _src[dataset]
+            _cake = _dst.create_dataset(
+                '/exchange/cake',
+                shape=(len(_data), ) + self.shape,
+                dtype=np.float32,
+                chunks=(1, ) + self.shape,
+            )
+            _cake.attrs['axes'] = 'frame:eta:tth'
+            _cake.attrs['source'] = f"{os.path.abspath(src_file)}:{dataset}"
+            _cake.attrs['geometry'] = json.dumps(self.geometry, default=list)
+            _dst['/exchange/tth'] = self.tth
+            _dst['/exchange/eta'] = self.eta
+            for _start, _cakes in self.iter_integrate(_data, block=block):
+                _cake[_start:_start+len(_cakes)] = _cakes
+        return dst_file
+
+    def __repr__(self):
+        return (f"AzimuthalIntegrator({self.shape[0]} eta x {self.shape[1]} tth bins, "
+                f"{len(self._data)} LUT entries, key={self.key})")
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+This module provides I/O benchmarks for the data files produced by the scans,
+to compare the post-processing tools against the raw disk bandwidth, and to
+choose the HDF plugin compression for each detector.
+
+NOTE:
+* The raw bandwidth is measured by reading the source file once, run on a cold
+  page cache (or a file larger than RAM) for meaningful numbers.
+* The codec benchmark uses numcodecs (blosc/lz4/zstd, bitshuffle) when it is
+  installed, zlib and no compression are always available.
+* The codec memory is the peak resident size (RSS) of the process sampled
+  during the run, above the RSS before it.  The codecs allocate their buffers
+  in C, out of reach of tracemalloc.
+"""
+
+import os
+import time
+import zlib
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tabulate import tabulate
+
+from .h5tools import to_sinograms
+
+
+def disk_read_bandwidth(filename: str, block_size: int=64<<20):
+    """sequential read bandwidth of a file in MB/s"""
+    _n, _t0 = 0, time.perf_counter()
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            _buf = f.read(block_size)
+            if not _buf:
+                break
+            _n += len(_buf)
+    return _n/(time.perf_counter() - _t0)/1e6
+
+
+def _time_sinogram_read(filename: str, dataset: str, row: int, sinogram_major: bool):
+    import h5py
+    _t0 = time.perf_counter()
+    with h5py.File(filename, 'r') as h5f:
+        if sinogram_major:
+            h5f[dataset][row]
+        else:
+            h5f[dataset][:, row, :]
+    return time.perf_counter() - _t0
+
+
+def benchmark_sinogram_rechunk(
+        src_file: str,
+        dst_file: str=None,
+        dataset: str='/exchange/data',
+        max_memory: int=1<<30,
+        n_sinograms: int=5,
+    ):
+    """
+    Benchmark h5tools.to_sinograms against the disk bandwidth.
+
+    Example:
+    >> benchmark_sinogram_rechunk('/data/Ti64_000001.h5')
+    """
+    import h5py
+
+    if dst_file is None:
+        dst_file = "_sino".join(os.path.splitext(src_file))
+    with h5py.File(src_file, 'r') as h5f:
+        _n_rows = h5f[dataset].shape[1]
+    _rows = np.linspace(0, _n_rows-1, n_sinograms).astype(int)
+
+    _disk = disk_read_bandwidth(src_file)
+    _before = np.mean([_time_sinogram_read(src_file, dataset, me, False) for me in _rows])
+    _stats = to_sinograms(src_file, dst_file, dataset=dataset, max_memory=max_memory, verbose=False)
+    _after = np.mean([_time_sinogram_read(dst_file, '/exchange/sinogram', me, True) for me in _rows])
+
+    _results = {
+        'disk read (MB/s)':         _disk,
+        'rechunk (MB/s)':           _stats['MB/s'],
+        'rechunk / disk':           _stats['MB/s']/_disk,
+        'frames per block':         _stats['frames_per_block'],
+        'sinogram, projection (s)': _before,
+        'sinogram, rechunked (s)':  _after,
+        'sinogram speedup':         _before/_after,
+    }
+    print(tabulate(_results.items(), headers=['', 'value'], floatfmt='.3f'))
+    return _results
+
+
+# nominal full frame readout of the 6-ID-D detectors, override for ROI/binning
+DETECTORS = {
+    'PointGrey': {'modality': 'tomo', 'shape': (2048, 2448), 'dtype': np.uint16, 'fps': 30},
+    'Varex':     {'modality': 'ff',   'shape': (2880, 2880), 'dtype': np.uint16, 'fps': 12},
+    'Retiga':    {'modality': 'nf',   'shape': (2048, 2048), 'dtype': np.uint16, 'fps': 10},
+}
+
+
+def synthetic_frames(modality: str, shape: tuple=(512, 512), n_frames: int=8, seed: int=0):
+    """
+    Representative frames per modality.
+
+    tomo : smooth attenuation contrast, 12 bit with counting noise
+    ff   : dark background with a few sharp diffraction spots
+    nf   : low background with many small, dense spots
+    """
+    _rng = np.random.default_rng(seed)
+    _rows, _cols = np.mgrid[0:shape[0], 0:shape[1]]
+    _frames = []
+    for i in range(n_frames):
+        if modality == 'tomo':
+            _r2 = ((_rows - shape[0]/2)**2 + (_cols - shape[1]/2 - i)**2)/(0.35*min(shape))**2
+            _img = 3000*np.exp(-0.8*np.sqrt(np.clip(1 - _r2, 0, 1))) + 200
+            _img = _rng.poisson(_img)
+        elif modality in ('ff', 'nf'):
+            _n_spots, _sigma, _bkg = (40, 2.0, 100) if modality == 'ff' else (400, 1.0, 20)
+            _img = np.full(shape, _bkg, dtype=float)
+            for _r, _c, _amp in zip(
+                    _rng.uniform(0, shape[0], _n_spots),
+                    _rng.uniform(0, shape[1], _n_spots),
+                    _rng.uniform(500, 12000, _n_spots),
+                ):
+                _r0, _c0 = int(_r), int(_c)
+                _sl = (slice(max(_r0-8, 0), _r0+8), slice(max(_c0-8, 0), _c0+8))
+                _img[_sl] += _amp*np.exp(-((_rows[_sl]-_r)**2 + (_cols[_sl]-_c)**2)/(2*_sigma**2))
+            _img = _rng.poisson(_img)
+        else:
+            raise ValueError(f"Unknown modality {modality}, use tomo|ff|nf")
+        _frames.append(np.clip(_img, 0, 65535).astype(np.uint16))
+    return np.stack(_frames)
+
+
+def candidate_codecs():
+    """
+    {name: (compress, decompress, hdf_setting)} of the codecs available here
+
+    hdf_setting is the matching HDF plugin Compression (and blosc options).
+    """
+    _codecs = {
+        'none':   (bytes, bytes, {'compression': 'None'}),
+        'zlib-1': (lambda b: zlib.compress(b, 1), zlib.decompress, {'compression': 'zlib', 'zlevel': 1}),
+    }
+    try:
+        from numcodecs import blosc, Blosc, LZ4
+    except ImportError:
+        return _codecs
+    # contextual blosc (no global lock), the thread pool does the parallelism
+    blosc.use_threads = False
+
+    for _cname in ('lz4', 'zstd', 'blosclz'):
+        for _shuffle, _sname in ((Blosc.NOSHUFFLE, 'noshuffle'), (Blosc.SHUFFLE, 'shuffle'), (Blosc.BITSHUFFLE, 'bitshuffle')):
+            _codec = Blosc(cname=_cname, clevel=5, shuffle=_shuffle, blocksize=0)
+            _codecs[f"blosc-{_cname}-{_sname}"] = (
+                _codec.encode, _codec.decode,
+                {'compression': 'Blosc', 'blosc_compressor': _cname, 'blosc_shuffle': _sname, 'blosc_level': 5},
+            )
+    # fast zstd setting
+    _codec = Blosc(cname='zstd', clevel=1, shuffle=Blosc.BITSHUFFLE, blocksize=0)
+    _codecs['blosc-zstd1-bitshuffle'] = (
+        _codec.encode, _codec.decode,
+        {'compression': 'Blosc', 'blosc_compressor': 'zstd', 'blosc_shuffle': 'bitshuffle', 'blosc_level': 1},
+    )
+    _lz4 = LZ4()
+    _codecs['lz4'] = (_lz4.encode, _lz4.decode, {'compression': 'LZ4'})
+    # the HDF plugin bitshuffle/LZ4 filter, approximated by blosc lz4 + bitshuffle
+    _codecs['bslz4'] = _codecs['blosc-lz4-bitshuffle'][:2] + ({'compression': 'BSLZ4'}, )
+    return _codecs
+
+
+def _rss():
+    """resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # no procfs (macOS), peak RSS of the process so far, in bytes there
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sample_rss(stop, peak, interval: float=0.005):
+    while not stop.wait(interval):
+        peak[0] = max(peak[0], _rss())
+
+
+def _run_codec(compress, decompress, frames, n_threads, frames_per_thread: int=8):
+    """
+    compress/decompress frames (one frame per task), return timings
+
+    Every thread gets at least frames_per_thread frames (the frames are reused
+    in turn), so that the timings do not depend on the number of frames given.
+    """
+    _buffers = [np.ascontiguousarray(me).tobytes() for me in frames]
+    _n_tasks = max(len(_buffers), n_threads*frames_per_thread)
+    _tasks = [_buffers[i % len(_buffers)] for i in range(_n_tasks)]
+    _restored = []
+    _rss0 = _rss()
+    _peak, _stop = [_rss0], threading.Event()
+    _sampler = threading.Thread(target=_sample_rss, args=(_stop, _peak), daemon=True)
+    _sampler.start()
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        _t0 = time.perf_counter()
+        _compressed = list(pool.map(compress, _tasks))
+        _t1 = time.perf_counter()
+        # only the first pass over the frames is kept for the round trip check
+        for i, me in enumerate(pool.map(decompress, _compressed)):
+            if i < len(_buffers):
+                _restored.append(me)
+        _t2 = time.perf_counter()
+    _stop.set()
+    _sampler.join()
+    _peak = max(_peak[0], _rss()) - _rss0
+    if any(bytes(a) != b for a, b in zip(_restored, _buffers)):
+        raise RuntimeError("codec round trip is not lossless")
+    _raw = sum(len(me) for me in _tasks)
+    return {
+        'ratio':                 _raw/sum(len(me) for me in _compressed),
+        'compress (MB/s)':       _raw/(_t1-_t0)/1e6,
+        'decompress (MB/s)':     _raw/(_t2-_t1)/1e6,
+        'peak memory (MB)':      _peak/1e6,
+    }
+
+
+def benchmark_codecs(
+        frames=None,
+        src_file: str=None,
+        dataset: str='/exchange/data',
+        modality: str='tomo',
+        threads: tuple=(1, 2, 4, 8),
+        codecs: dict=None,
+        frames_per_thread: int=8,
+        verbose: bool=True,
+    ):
+    """
+    Run the candidate codecs on representative frames across thread counts.
+
+    frames are taken from (in order) the argument, the first frames of src_file,
+    or synthetic frames of the given modality.  Each thread count runs at least
+    frames_per_thread frames per thread.  Returns a list of result rows.
+
+    Example:
+    >> results = benchmark_codecs(src_file='/data/Ti64_000001.h5')
+    >> recommend_compression(results, 'PointGrey')
+    """
+    if frames is None and src_file is not None:
+        import h5py
+        with h5py.File(src_file, 'r') as h5f:
+            frames = h5f[dataset][:16]
+    if frames is None:
+        frames = synthetic_frames(modality)
+    codecs = candidate_codecs() if codecs is None else codecs
+
+    _results = []
+    for _name, (_compress, _decompress, _setting) in codecs.items():
+        for _n in threads:
+            _row = {'codec': _name, 'threads': _n}
+            _row.update(_run_codec(_compress, _decompress, frames, _n, frames_per_thread=frames_per_thread))
+            _row['hdf_setting'] = _setting
+            _results.append(_row)
+    if verbose:
+        print(tabulate(
+            [{k: v for k, v in me.items() if k != 'hdf_setting'} for me in _results],
+            headers='keys', floatfmt='.2f',
+        ))
+    return _results
+
+
+def recommend_compression(results, detector: str, margin: float=1.5, max_threads: int=None):
+    """
+    Best compression ratio among the codecs keeping up with the detector.
+
+    A codec keeps up when its compression throughput is at least margin times
+    the detector data rate (DETECTORS), with at most max_threads threads.
+    """
+    _det = DETECTORS[detector]
+    _rate = _det['fps']*np.prod(_det['shape'])*np.dtype(_det['dtype']).itemsize/1e6
+    _ok = [
+        me for me in results
+        if me['compress (MB/s)'] >= margin*_rate
+        and (max_threads is None or me['threads'] <= max_threads)
+    ]
+    if not _ok:
+        print(f"No codec keeps up with {detector} ({_rate:.0f} MB/s), use no compression")
+        return {'compression': 'None'}
+    # best ratio, then the fewest threads
+    _best = max(_ok, key=lambda me: (round(me['ratio'], 2), -me['threads']))
+    print(f"{detector} ({_det['modality']}, {_rate:.0f} MB/s): {_best['codec']} with {_best['threads']} thread(s), "
+          f"ratio {_best['ratio']:.2f}, {_best['compress (MB/s)']:.0f} MB/s")
+    return dict(_best['hdf_setting'], threads=_best['threads'])
+
+
+def benchmark_detectors(threads: tuple=(1, 2, 4, 8), margin: float=1.5, frames_per_thread: int=8):
+    """
+    run the codec benchmark on synthetic frames for every detector/modality
+
+    A few distinct full size frames are generated per detector and reused, so
+    that every thread still compresses frames_per_thread frames.
+    """
+    _recommendations = {}
+    for _name, _det in DETECTORS.items():
+        _frames = synthetic_frames(_det['modality'], shape=_det['shape'], n_frames=4)
+        _results = benchmark_codecs(
+            _frames, modality=_det['modality'], threads=threads,
+            frames_per_thread=frames_per_thread, verbose=False,
+        )
+        _recommendations[_name] = recommend_compression(_results, _name, margin=margin)
+    return _recommendations
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""
+This module calibrates the far-field (FF-HEDM) detector geometry from an image
+of a powder calibrant (CeO2 by default).
+
+    1. the ring positions (2theta) follow from the calibrant lattice and the energy
+    2. ring points are extracted from radial profiles in eta sectors around the
+       current geometry (all sectors at once, vectorized)
+    3. beam center, distance and tilts are fitted so that the ring points fall on
+       the expected 2theta (least squares)
+Steps 2 and 3 are repeated a few times since the profiles depend on the geometry.
+
+The result is the geometry dict of seisidd.azimuthal (plus the energy and the
+fit quality), kept in cfg['ff']['geometry'] so that it is stored with each FF
+run (start document, scan_config) and used by the azimuthal integration.
+
+NOTE:
+* scipy.optimize.least_squares is used when available, otherwise a small
+  Levenberg-Marquardt in numpy.
+* The first pass only uses the isolated inner rings, the initial geometry must
+  put them within ring_width (deg 2theta) of the truth.
+"""
+
+import time
+import warnings
+import numpy as np
+
+from .azimuthal import VAREX_GEOMETRY, detector_to_angles
+
+
+# hc in keV.Angstrom
+HC = 12.398419843320026
+
+# lattice type and constant (Angstrom)
+CALIBRANTS = {
+    'CeO2': ('fcc', 5.411651),   # NIST SRM 674b
+    'LaB6': ('sc',  4.156826),   # NIST SRM 660c
+    'Si':   ('diamond', 5.431020),  # NIST SRM 640e
+    'Au':   ('fcc', 4.0782),
+}
+
+# fitted geometry parameters, in this order
+FIT_PARAMETERS = ('center_row', 'center_col', 'distance', 'tilt_x', 'tilt_y')
+
+
+def _allowed(h, k, l, lattice):
+    if lattice == 'sc':
+        return True
+    _all_even = h % 2 == 0 and k % 2 == 0 and l % 2 == 0
+    _all_odd = h % 2 == 1 and k % 2 == 1 and l % 2 == 1
+    if lattice == 'fcc':
+        return _all_even or _all_odd
+    if lattice == 'diamond':
+        return _all_odd or (_all_even and (h + k + l) % 4 == 0)
+    if lattice == 'bcc':
+        return (h + k + l) % 2 == 0
+    raise ValueError(f"Unknown lattice {lattice}, use sc|fcc|bcc|diamond")
+
+
+def calibrant_rings(calibrant: str, energy: float, tth_max: float=15.0):
+    """
+    2theta (deg) of the calibrant rings below tth_max for a beam energy in keV.
+
+    Example:
+    >> calibrant_rings('CeO2', 71.676, 6)
+    >> array([3.172, 3.663, 5.182])
+    """
+    if calibrant not in CALIBRANTS:
+        raise ValueError(f"Unknown calibrant {calibrant}, use one of {sorted(CALIBRANTS)}")
+    _lattice, _a = CALIBRANTS[calibrant]
+    _wavelength = HC/energy
+    _n_max = int(np.ceil(2*_a*np.sin(np.radians(tth_max/2))/_wavelength)) + 1
+    _s2 = {
+        h*h + k*k + l*l
+        for h in range(_n_max + 1)
+        for k in range(h + 1)
+        for l in range(k + 1)
+        if (h, k, l) != (0, 0, 0) and _allowed(h, k, l, _lattice)
+    }
+    _d = _a/np.sqrt(sorted(_s2))
+    _sin = _wavelength/(2*_d)
+    _tth = np.degrees(2*np.arcsin(_sin[_sin < 1]))
+    return _tth[_tth < tth_max]
+
+
+def _with_parameters(geometry, p):
+    return dict(
+        geometry,
+        center=(float(p[0]), float(p[1])),
+        distance=float(p[2]),
+        tilt_x=float(p[3]),
+        tilt_y=float(p[4]),
+    )
+
+
+def extract_ring_points(
+        image,
+        geometry: dict,
+        rings,
+        ring_width: float=0.15,
+        n_sectors: int=180,
+        bin_width: float=0.005,
+        peak_width: float=0.03,
+        min_snr: float=5.0,
+        mask=None,
+    ):
+    """
+    Ring points (rows, cols, ring index) from radial profiles in eta sectors.
+
+    For each sector and ring, the profile within +-ring_width of the expected
+    2theta is background subtracted (edges of the window), and the ring point is
+    the intensity weighted mean pixel position within +-peak_width of the
+    profile maximum.
+    """
+    _img = np.asarray(image, dtype=np.float64)
+    _rows, _cols = np.mgrid[0:_img.shape[0], 0:_img.shape[1]]
+    _tth, _eta = detector_to_angles(_rows, _cols, geometry)
+    _tth_min, _tth_max = min(rings) - 2*ring_width, max(rings) + 2*ring_width
+    _sel = (_tth > _tth_min) & (_tth < _tth_max)
+    if mask is not None:
+        _sel &= ~np.asarray(mask, dtype=bool)
+    _n_bins = int(np.ceil((_tth_max - _tth_min)/bin_width))
+    _bin = ((_tth[_sel] - _tth_min)/bin_width).astype(np.int64)
+    _sector = ((_eta[_sel] + 180)/360*n_sectors).astype(np.int64) % n_sectors
+    _key = _sector*_n_bins + _bin
+    _values, _r, _c = _img[_sel], _rows[_sel], _cols[_sel]
+
+    # radial profiles of all the sectors at once, (sector, bin)
+    def _profile(weights=None):
+        return np.bincount(_key, weights=weights, minlength=n_sectors*_n_bins).reshape(n_sectors, _n_bins)
+    _n, _s = _profile(), _profile(_values)
+    _sr, _sc = _profile(_values*_r), _profile(_values*_c)
+    _nr, _nc = _profile(_r.astype(float)), _profile(_c.astype(float))
+    _centers = _tth_min + (np.arange(_n_bins) + 0.5)*bin_width
+
+    # windows never reach the neighbor rings
+    _rings = np.sort(np.asarray(rings, dtype=np.float64))
+    _gaps = np.diff(_rings)
+    _half = np.minimum(np.r_[np.inf, _gaps], np.r_[_gaps, np.inf])/2
+    _points = []
+    for _ring, _tth_ring in enumerate(rings):
+        _width = min(ring_width, 0.9*_half[np.searchsorted(_rings, _tth_ring)])
+        _win = np.nonzero(np.abs(_centers - _tth_ring) <= _width)[0]
+        if len(_win) < 5:
+            continue
+        _edge = np.r_[_win[:2], _win[-2:]]
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            _mean = _s[:, _win]/_n[:, _win]
+            _bkg = np.nanmedian(_s[:, _edge]/_n[:, _edge], axis=1, keepdims=True)
+            _noise = np.nanstd(_s[:, _edge]/_n[:, _edge], axis=1, keepdims=True) + np.sqrt(np.abs(_bkg)) + 1e-12
+            _snr = np.nanmax(_mean - _bkg, axis=1)/_noise[:, 0]
+            # only the bins around the maximum of each sector profile
+            _peak = np.nanargmax(np.nan_to_num(_mean - _bkg, nan=-np.inf), axis=1)[:, np.newaxis]
+            _near = np.abs(np.arange(len(_win)) - _peak) <= peak_width/bin_width
+            _net = np.where(_near, np.clip(_s[:, _win] - _bkg*_n[:, _win], 0, None), 0).sum(axis=1)
+            _pos_r = np.where(_near, _sr[:, _win] - _bkg*_nr[:, _win], 0).sum(axis=1)/_net
+            _pos_c = np.where(_near, _sc[:, _win] - _bkg*_nc[:, _win], 0).sum(axis=1)/_net
+        _good = (_snr > min_snr) & np.isfinite(_pos_r) & np.isfinite(_pos_c) & (_net > 0)
+        for _pr, _pc in zip(_pos_r[_good], _pos_c[_good]):
+            _points.append((_pr, _pc, _ring))
+    _points = np.asarray(_points, dtype=np.float64).reshape(-1, 3)
+    return _points[:, 0], _points[:, 1], _points[:, 2].astype(int)
+
+
+def _levenberg_marquardt(residuals, p0, n_iter: int=100, tol: float=1e-10):
+    """minimize sum(residuals(p)**2), numerical jacobian"""
+    _p = np.asarray(p0, dtype=np.float64)
+    _res = residuals(_p)
+    _cost = _res @ _res
+    _lambda = 1e-3
+    for _ in range(n_iter):
+        _step = 1e-6*np.maximum(np.abs(_p), 1.0)
+        _jac = np.stack([(residuals(_p + _step[i]*np.eye(len(_p))[i]) - _res)/_step[i] for i in range(len(_p))], axis=1)
+        _jtj, _jtr = _jac.T @ _jac, _jac.T @ _res
+        while True:
+            _dp = np.linalg.solve(_jtj + _lambda*np.diag(np.diag(_jtj) + 1e-12), -_jtr)
+            _res_new = residuals(_p + _dp)
+            _cost_new = _res_new @ _res_new
+            if _cost_new < _cost:
+                _lambda = max(_lambda/10, 1e-12)
+                break
+            _lambda *= 10
+            if _lambda > 1e12:
+                return _p
+        _p, _res, _improvement, _cost = _p + _dp, _res_new, _cost - _cost_new, _cost_new
+        if _improvement < tol*max(_cost, 1e-30):
+            break
+    return _p
+
+
+def fit_geometry(rows, cols, ring_index, rings, geometry: dict, fix: tuple=(), n_clip: int=3):
+    """
+    Least squares fit of the geometry so that the points fall on their ring.
+
+    fix lists FIT_PARAMETERS kept at their value in geometry.  The fit is
+    repeated n_clip times without the outliers (3 sigma, robust), i.e. points
+    picked on the wrong ring or on a spot.
+    Returns the geometry, the rms residual (deg) and the points kept.
+    """
+    _rings = np.asarray(rings)[ring_index]
+    _p0 = np.array([
+        geometry['center'][0], geometry['center'][1],
+        geometry['distance'], geometry.get('tilt_x', 0.0), geometry.get('tilt_y', 0.0),
+    ], dtype=np.float64)
+    _free = np.array([me not in fix for me in FIT_PARAMETERS])
+
+    def _residuals(p_free):
+        _p = _p0.copy()
+        _p[_free] = p_free
+        _tth, _ = detector_to_angles(rows, cols, _with_parameters(geometry, _p))
+        return _tth - _rings
+
+    try:
+        from scipy.optimize import least_squares
+    except ImportError:
+        least_squares = None
+
+    _keep = np.ones(len(_rings), dtype=bool)
+    _p_free = _p0[_free]
+    for _ in range(n_clip + 1):
+        _fun = lambda p: _residuals(p)[_keep]
+        if least_squares is None:
+            _p_free = _levenberg_marquardt(_fun, _p_free)
+        else:
+            _p_free = least_squares(_fun, _p_free, x_scale='jac').x
+        _res = _residuals(_p_free)
+        _sigma = 1.4826*np.median(np.abs(_res[_keep]))
+        _new = np.abs(_res) < max(3*_sigma, 1e-6)
+        if np.array_equal(_new, _keep) or _new.sum() < 2*len(_p_free):
+            break
+        _keep = _new
+    _p = _p0.copy()
+    _p[_free] = _p_free
+    return _with_parameters(geometry, _p), float(np.sqrt(np.mean(_res[_keep]**2))), _keep
+
+
+def calibrate(
+        image,
+        energy: float,
+        geometry: dict=None,
+        calibrant: str='CeO2',
+        ring_width: float=0.15,
+        n_sectors: int=180,
+        n_iter: int=3,
+        fix: tuple=(),
+        mask=None,
+        verbose: bool=True,
+    ):
+    """
+    Fit the FF detector geometry to a calibrant image (dark subtracted, or summed
+    over a few frames).
+
+    Example:
+    >> result = calibrate(img, energy=71.676, geometry=cfg['ff']['geometry'])
+    >> result['geometry']
+    >> {'shape': (2880, 2880), 'pixel_size': (0.15, 0.15), 'center': (1431.2, 1447.9),
+    >>  'distance': 1023.4, 'tilt_x': 0.21, 'tilt_y': -0.08, 'energy': 71.676}
+    >> result['rms_tth'], result['n_points']
+    """
+    _t0 = time.perf_counter()
+    _geometry = dict(VAREX_GEOMETRY if geometry is None else geometry)
+    _geometry.pop('energy', None)
+    _img = np.asarray(image)
+    _geometry['shape'] = tuple(_img.shape)
+
+    # only the rings seen by the detector
+    _r, _c = _img.shape
+    _tth_corners, _ = detector_to_angles([0, 0, _r-1, _r-1], [0, _c-1, 0, _c-1], _geometry)
+    _rings = calibrant_rings(calibrant, energy, tth_max=float(_tth_corners.max()))
+    if len(_rings) < 2:
+        raise ValueError(f"Less than 2 {calibrant} rings on the detector at {energy} keV")
+
+    # first pass on the isolated rings only, the initial geometry may be off by
+    # more than the distance between the outer (dense) rings
+    _gaps = np.diff(_rings)
+    _half = np.minimum(np.r_[np.inf, _gaps], np.r_[_gaps, np.inf])/2
+    _isolated = _rings[_half >= ring_width]
+
+    _width = ring_width
+    for i in range(n_iter):
+        _pass_rings = _isolated if i == 0 and len(_isolated) >= 2 else _rings
+        _rows, _cols, _ring_index = extract_ring_points(
+            _img, _geometry, _pass_rings, ring_width=_width, n_sectors=n_sectors, mask=mask,
+        )
+        if len(_rows) < 2*len(FIT_PARAMETERS):
+            raise RuntimeError(f"Only {len(_rows)} ring points found, check the energy and the initial geometry")
+        _geometry, _rms, _keep = fit_geometry(_rows, _cols, _ring_index, _pass_rings, _geometry, fix=fix)
+        if verbose:
+            print(f"iteration {i}: {_keep.sum()}/{len(_rows)} points on {len(set(_ring_index[_keep]))} rings, "
+                  f"rms {_rms*1e3:.2f} mdeg, center ({_geometry['center'][0]:.2f}, {_geometry['center'][1]:.2f}), "
+                  f"distance {_geometry['distance']:.2f} mm")
+        # narrower windows once the geometry is close
+        _width = max(ring_width/2, 10*_rms)
+
+    _geometry['energy'] = energy
+    return {
+        'geometry':  _geometry,
+        'calibrant': calibrant,
+        'rings':     _rings,
+        'rms_tth':   _rms,
+        'n_points':  int(_keep.sum()),
+        'seconds':   time.perf_counter() - _t0,
+    }
+
+
+def _sum_frames(dset, first: int=0, max_memory: int=1<<30):
+    """sum of dset[first:] over the first axis, read in blocks of whole frames"""
+    _n_frames = dset.shape[0]
+    _block = max(1, max_memory // max(1, int(np.prod(dset.shape[1:]))*8))
+    _sum = np.zeros(dset.shape[1:], dtype=np.float64)
+    for _start in range(first, _n_frames, _block):
+        _sum += dset[_start:_start+_block].sum(axis=0, dtype=np.float64)
+    return _sum, _n_frames - first
+
+
+def calibrate_file(
+        h5file: str,
+        energy: float,
+        geometry: dict=None,
+        dataset: str='/exchange/data',
+        dark_dataset: str='/exchange/data_dark',
+        max_memory: int=1<<30,
+        **kwargs,
+    ):
+    """
+    Calibrate from a calibrant exposure written by FarField.scan, the frames
+    (except the junk first frame) are summed and the mean dark subtracted.
+    The frames are read in blocks of at most max_memory bytes (as float64).
+    """
+    import h5py
+    with h5py.File(h5file, 'r') as h5f:
+        _data = h5f[dataset]
+        _img, _n = _sum_frames(_data, first=1 if len(_data) > 1 else 0, max_memory=max_memory)
+        if dark_dataset in h5f:
+            _dark, _n_dark = _sum_frames(h5f[dark_dataset], max_memory=max_memory)
+            _img -= _n*_dark/_n_dark
+    _result = calibrate(_img, energy, geometry=geometry, **kwargs)
+    _result['source'] = h5file
+    return _result
+
+
+def update_config(cfg: dict, result: dict):
+    """
+    Keep the calibrated geometry in the FF config, it is then recorded in the
+    start document of every FF run (scan_config) and used for integration.
+    """
+    _geometry = result['geometry']
+    cfg['ff']['geometry'] = {
+        'energy':     float(_geometry['energy']),
+        'distance':   float(_geometry['distance']),
+        'center':     [float(me) for me in _geometry['center']],
+        'tilt_x':     float(_geometry['tilt_x']),
+        'tilt_y':     float(_geometry['tilt_y']),
+        'pixel_size': [float(me) for me in _geometry['pixel_size']],
+        'shape':      [int(me) for me in _geometry['shape']],
+        'calibrant':  result['calibrant'],
+        'rms_tth':    float(result['rms_tth']),
+        'source':     result.get('source'),
+        'date':       time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    return cfg['ff']['geometry']
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
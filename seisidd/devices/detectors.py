@@ -9,6 +9,9 @@ NOTE:
 * Changed to PointGrey Detectors in this example
 """
 
+from collections import deque
+from collections import defaultdict
+
 from ophyd   import AreaDetector
 from ophyd   import EpicsSignal, SingleTrigger, EpicsSignalRO, EpicsSignalWithRBV
 from ophyd   import ADComponent
@@ -20,11 +23,102 @@ from ophyd   import TIFFPlugin
 from ophyd   import HDF5Plugin
 from ophyd   import TransformPlugin
 from ophyd   import ImagePlugin
+from ophyd.areadetector.filestore_mixins import resource_factory
 
 
 class HDF5Plugin6IDD(HDF5Plugin):
     """AD HDF5 plugin customizations (properties)"""
-    xml_file_name = ADComponent(EpicsSignalWithRBV, "XMLFileName")
+    xml_file_name = ADComponent(EpicsSignalWithRBV, "XMLFileName", string=True)
+
+
+class FileStoreDXchangeMixin:
+    """
+    Register the frames written by the HDF plugin (dxchange layout) with databroker
+
+    The file names are still managed by the scan plans, this mixin only follows
+    them: a resource document is generated for every new file (FullFileName_RBV),
+    and a datum for every trigger pointing to the dataset selected by
+    cam1.frame_type together with the index of the first frame written by that
+    trigger.  Frames are then retrieved lazily through handlers.DXchangeHDF5Handler.
+    """
+    filestore_spec = 'AD_HDF5_DXCHANGE'
+
+    def __init__(self, *args, path_semantics='posix', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path_semantics = path_semantics
+        self._asset_docs_cache = deque()
+        self._datum_uids = defaultdict(list)
+        self._datum_factory = None
+        self._resource_fn = None
+        self._frame_counts = defaultdict(int)
+
+    def stage(self):
+        self._datum_uids.clear()
+        self._resource_fn = None
+        super().stage()
+
+    def _frames_per_trigger(self):
+        """number of frames landing in the file for one trigger (after proc1 averaging)"""
+        _det = self.parent
+        _n = _det.cam1.num_images.get()
+        if _det.proc1.enable.get() and _det.proc1.enable_filter.get():
+            _n = _n // max(_det.proc1.num_filter.get(), 1)
+        return max(_n, 1)
+
+    def generate_datum(self, key, timestamp, datum_kwargs):
+        _fn = self.full_file_name.get()
+        if _fn != self._resource_fn:
+            resource, self._datum_factory = resource_factory(
+                spec=self.filestore_spec,
+                root='',
+                resource_path=_fn,
+                resource_kwargs={},
+                path_semantics=self.path_semantics,
+            )
+            self._asset_docs_cache.append(('resource', resource))
+            self._resource_fn = _fn
+            self._frame_counts.clear()
+
+        _dataset = self.parent.cam1.frame_type.get(as_string=True)
+        _n = self._frames_per_trigger()
+        datum_kwargs = dict(datum_kwargs or {})
+        datum_kwargs.update({
+            'dataset':         _dataset,
+            'point_number':    self._frame_counts[_dataset],
+            'frame_per_point': _n,
+        })
+        self._frame_counts[_dataset] += _n
+
+        datum = self._datum_factory(datum_kwargs)
+        self._asset_docs_cache.append(('datum', datum))
+        self._datum_uids[key].append({'value': datum['datum_id'], 'timestamp': timestamp})
+        return datum['datum_id']
+
+    def describe(self):
+        res = super().describe()
+        for k in self._datum_uids:
+            res[k] = self.parent.make_data_key()
+        return res
+
+    def read(self):
+        res = super().read()
+        for k, v in self._datum_uids.items():
+            res[k] = v[-1]
+        return res
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
+
+    def unstage(self):
+        self._asset_docs_cache.clear()
+        return super().unstage()
+
+
+class HDF5PluginDXchange(FileStoreDXchangeMixin, HDF5Plugin6IDD):
+    """HDF5 plugin with dxchange file registration"""
+    pass
 
 
 class RetigaDetectorCam(CamBase):
@@ -183,7 +277,7 @@ class Varex4343CT(SingleTrigger, AreaDetector):
     cam1   = ADComponent(Varex4343CTCAM6IDD,       suffix="cam1:"  )  # camera
     proc1  = ADComponent(ProcessPlugin,            suffix="Proc1:" )  # processing
     tiff1  = ADComponent(TIFFPlugin,               suffix="TIFF1:" )  # tiff output
-    hdf1   = ADComponent(HDF5Plugin6IDD,           suffix="HDF1:"  )  # HDF5 output
+    hdf1   = ADComponent(HDF5PluginDXchange,       suffix="HDF1:"  )  # HDF5 output
     trans1 = ADComponent(VarexTransformPlugin,     suffix="Trans1:")  # Transform images
     image1 = ADComponent(ImagePlugin,              suffix="image1:")  # Image plugin, rarely used in plan
 
@@ -261,7 +355,7 @@ class PointGreyDetector(SingleTrigger, AreaDetector):
     cam1   = ADComponent(PointGreyDetectorCam6IDD, suffix="cam1:"  )  # camera
     proc1  = ADComponent(ProcessPlugin,            suffix="Proc1:" )  # processing
     tiff1  = ADComponent(TIFFPlugin,               suffix="TIFF1:" )  # tiff output
-    hdf1   = ADComponent(HDF5Plugin6IDD,           suffix="HDF1:"  )  # HDF5 output
+    hdf1   = ADComponent(HDF5PluginDXchange,       suffix="HDF1:"  )  # HDF5 output
     trans1 = ADComponent(TransformPlugin,          suffix="Trans1:")  # Transform images
     image1 = ADComponent(ImagePlugin,              suffix="image1:")  # Image plugin, rarely used in plan
 
@@ -382,7 +476,7 @@ class SimDetector(SingleTrigger, AreaDetector):
     cam1  = ADComponent(SimDetectorCam6IDD, suffix="cam1:" )  # camera
     proc1 = ADComponent(ProcessPlugin,      suffix="Proc1:")  # processing
     tiff1 = ADComponent(TIFFPlugin,         suffix="TIFF1:")  # tiff output
-    hdf1  = ADComponent(HDF5Plugin6IDD,     suffix="HDF1:" )  # HDF5 output
+    hdf1  = ADComponent(HDF5PluginDXchange, suffix="HDF1:" )  # HDF5 output
 
     @property
     def status(self):
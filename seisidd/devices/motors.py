@@ -9,12 +9,18 @@ TODO:
 """
 
 
+import time
+import numpy                 as     np
+import bluesky.plan_stubs    as     bps
+import bluesky.preprocessors as     bpp
+
 from ophyd   import    Device
 from ophyd   import    MotorBundle
 from ophyd   import    Component
 from ophyd   import    EpicsMotor
 from ophyd   import    EpicsSignal
 from ophyd   import    EpicsSignalRO
+from ophyd   import    Signal
 
 
 class TomoCamStage(MotorBundle):
@@ -106,8 +112,61 @@ class FFCamStage(MotorBundle):
 
 
 class AeroEpicsMotor(EpicsMotor):
-    dial_readback = Component(EpicsSignalRO, '.DRBV', kind='hinted',auto_monitor=True)
-    dial_setpoint = Component(EpicsSignal, '.DVAL', limits=True)
+    """
+    Aerotech air-bearing rotation with angle wrapping
+
+    The stage can spin indefinitely, so instead of unwinding the accumulated
+    rotation with a long move, the position is redefined by whole turns (no
+    motion) before moving to the next scan start along the shortest path.
+
+    Example:
+    >> tomostage.rot.position                  # 718.0 after two 0->360 scans
+    >> RE(tomostage.rot.shortest_move(0))      # redefine to -2.0, move by 2 deg
+    """
+    dial_readback  = Component(EpicsSignalRO, '.DRBV', kind='hinted',auto_monitor=True)
+    dial_setpoint  = Component(EpicsSignal, '.DVAL', limits=True)
+    user_direction = Component(EpicsSignal, '.DIR', kind='config')  # 0: Pos, 1: Neg
+
+    @property
+    def wrapped_position(self):
+        """current angle modulo 360, in [0, 360)"""
+        return self.position % 360
+
+    @staticmethod
+    def turns_to_unwind(position, target):
+        """number of whole turns to remove so that target is at most half a turn away"""
+        return int(np.floor((position - target)/360 + 0.5))
+
+    def unwind(self, n_turns: int):
+        """
+        plan, redefine the current position by n_turns*360 deg without any motion.
+
+        Only allowed when the stage is at rest, the redefinition is done on the
+        dial (controller) position so that the user offset is preserved.  The
+        motor is always switched back to Use, even if the plan is aborted.
+        """
+        if n_turns == 0:
+            return
+        if self.moving:
+            raise RuntimeError("Cannot redefine the rotation position while the stage is moving")
+        _sign = -1 if self.user_direction.get() == 1 else 1
+
+        def _redefine():
+            yield from bps.mv(self.set_use_switch, 1)
+            yield from bps.mv(self.dial_setpoint, self.dial_readback.get() - _sign*360*n_turns)
+
+        yield from bpp.finalize_wrapper(_redefine(), bps.mv(self.set_use_switch, 0))
+
+    def unwind_near(self, target):
+        """plan, redefine the position (whole turns, no motion) to be within half a turn of target, returns the turns removed"""
+        _n_turns = self.turns_to_unwind(self.position, target)
+        yield from self.unwind(_n_turns)
+        return _n_turns
+
+    def shortest_move(self, target):
+        """plan to reach target with at most half a turn of motion"""
+        yield from self.unwind_near(target)
+        yield from bps.mv(self, target)
 
 class StageAero(MotorBundle):
     """
@@ -221,7 +280,7 @@ class SimStageAero(MotorBundle):
     kx_tilt     = Component(EpicsMotor, "6iddSIM:m16", name='kx_tilt')   # kohzu tilt motion along x
     kz_tilt     = Component(EpicsMotor, "6iddSIM:m16", name='kz_tilt')   # kohzu tilt motion along z
 
-    rot         = Component(EpicsMotor, "6iddSIM:m4",  name='rot_y'  )    # rotation with aero stage
+    rot         = Component(AeroEpicsMotor, "6iddSIM:m4",  name='rot_y'  )    # rotation with aero stage
 
     x_base      = Component(EpicsMotor, "6iddSIM:m16",  name='x_trans')    # x motion below aero stage
     tiltx_base  = Component(EpicsMotor, "6iddSIM:m16",  name='tiltx_trans')    # y motion below aero stage
@@ -295,6 +354,13 @@ class TaxiFlyScanDevice(Device):
     
     reset_fpga = EpicsSignal("6idMZ1:SG:BUFFER-1_IN_Signal.PROC", put_complete=True, name = 'reset_fpga')
     pso_state  = EpicsSignal("6idMZ1:SG:AND-1_IN1_Signal",        put_complete=True, name = 'pso_state')  # only accept str as its input
+    # software pulse for hardware step scan
+    # NOTE:
+    #   processing the BUFFER-2 input sends one pulse on its output, the hardware step
+    #   scans name that output "swpls" (soft_pulse_out) and route it to the detector
+    #   through the FI*_Signal inputs the same way as "pls"
+    soft_pulse     = EpicsSignal("6idMZ1:SG:BUFFER-2_IN_Signal.PROC", put_complete=True, name = 'soft_pulse')
+    soft_pulse_out = EpicsSignal("6idMZ1:SG:BUFFER-2_OUT_Signal",     put_complete=True, name = 'soft_pulse_out')
     
     fi1_signal = EpicsSignal("6idMZ1:SG:FI1_Signal", put_complete=True, name = 'fi1_signal')
     fi2_signal = EpicsSignal("6idMZ1:SG:FI2_Signal", put_complete=True, name = 'fi2_signal')
@@ -306,10 +372,44 @@ class TaxiFlyScanDevice(Device):
         yield from bps.mv(self.taxi, self.taxi.enum_strs[1])
         yield from bps.mv(self.fly, self.fly.enum_strs[1])
 
+    def step_pulses(self, rot, angles, frame_counter, n_frames: int=1, timeout: float=10):
+        """
+        Plan, stop-and-go through angles with n_frames software pulses per stop.
+
+        Each pulse is sent only once frame_counter (e.g. det.cam1.array_counter)
+        has counted the frame of the previous one, so the pulses follow the
+        detector readout instead of a fixed sleep.  A frame missing for timeout
+        seconds (pulse lost during readout) aborts the plan.
+
+        NOTE:
+        * The PSOFly IOC has no stop-and-go profile, and a PSO position pulse
+          would fire while the stage is still settling on the angle, so the
+          stops are motor record moves and the pulses are sent once the move
+          is done.
+        """
+        for _ang in angles:
+            yield from bps.mv(rot, _ang)
+            for _frame in range(n_frames):
+                _count = frame_counter.get()
+                yield from bps.mv(self.soft_pulse, 1)
+                _t0 = time.time()
+                while frame_counter.get() == _count:
+                    if time.time() - _t0 > timeout:
+                        raise RuntimeError(
+                            f"No frame {_frame+1}/{n_frames} at {_ang} deg within {timeout} s, "
+                            "the detector missed a pulse"
+                        )
+                    yield from bps.sleep(0.005)
+
 
 class EnsemblePSOFlyDevice(TaxiFlyScanDevice):
     """
     PSOfly control wrapper
+
+    NOTE:
+    * Arbitrary trigger angles (fly_angles) use the PSO array mode of the
+      Ensemble (PSOARRAY), exposed by the PSOFly IOC as psoMode (Window/Array)
+      and the psoArray waveform (trigger angles in deg, up to psoArray.NELM).
     """
     motor_pv_name = Component(EpicsSignalRO, "motorName")
     start         = Component(EpicsSignal,   "startPos")
@@ -324,7 +424,152 @@ class EnsemblePSOFlyDevice(TaxiFlyScanDevice):
     detector_setup_time = Component(EpicsSignal,   "detSetupTime")
     pulse_type          = Component(EpicsSignal,   "pulseType"   )
     scan_control        = Component(EpicsSignal,   "scanControl" )
-    
+
+    # array mode: one pulse each time the rotation crosses an angle of pso_array
+    pso_mode  = Component(EpicsSignal, "psoMode" )   # Window, Array
+    pso_array = Component(EpicsSignal, "psoArray")
+
+    # angles of the last fly_angles, recorded in the 'trigger_angles' stream
+    trigger_angles = Component(Signal, value=[], kind='config')
+
+    def fly_angles(self, angles, slew_speed=None, detector_setup_time=None, stream='trigger_angles'):
+        """
+        Plan to fly through a precomputed array of trigger angles.
+
+        The angles are loaded in the PSO array, and the rotation (motor_pv_name)
+        sweeps once from the first to the last angle at constant speed, firing
+        one pulse at each angle.  The detector must be armed (external trigger, one image per angle)
+        before calling this plan, and the plan must run inside a run: the angles
+        are recorded as an event of stream (None to skip).
+
+        Example:
+        >> det.cam1.num_images.put(len(angles))
+        >> RE(bpp.run_wrapper(psofly.fly_angles(angles, slew_speed=2)))
+        """
+        import bluesky.preprocessors as bpp
+        angles = np.asarray(angles, dtype=float)
+        if angles.ndim != 1 or angles.size == 0:
+            raise ValueError("Trigger angles must be a non-empty 1D array")
+        if np.any(np.diff(angles) <= 0):
+            raise ValueError("Trigger angles must be strictly increasing")
+        # the tightest spacing sets the detector timing check (delta_time)
+        _delta = float(np.diff(angles).min()) if angles.size > 1 else float(self.scan_delta.get())
+
+        if slew_speed is not None:
+            yield from bps.mv(self.slew_speed, slew_speed)
+        if detector_setup_time is not None:
+            yield from bps.mv(self.detector_setup_time, detector_setup_time)
+        yield from bps.mv(
+            self.pso_mode,   "Array",
+            self.pso_array,  angles,
+            self.start,      angles[0],
+            self.end,        angles[-1] + _delta,  # PSO window is half-open
+            self.scan_delta, _delta,
+        )
+        yield from bpp.finalize_wrapper(self._fly(), bps.mv(self.pso_mode, "Window"))
+
+        if stream is not None:
+            yield from bps.mv(self.trigger_angles, angles)
+            yield from bps.create(stream)
+            yield from bps.read(self.trigger_angles)
+            yield from bps.save()
+
+    def _fly(self):
+        """taxi (the IOC moves to the start minus the acceleration distance) and fly once"""
+        yield from bps.mv(self.pso_state, "0")    # no accidental trigger during taxi
+        yield from bps.mv(self.taxi, "Taxi")
+        yield from bps.mv(self.pso_state, "1")
+        yield from bps.abs_set(self.fly, "1", group='fly_angles')
+        yield from bps.wait(group='fly_angles')
+        yield from bps.mv(self.pso_state, "0")
+
+
+class SimPSOSignal(Signal):
+    """Soft signal with fixed control limits, mimicking the PSOFly IOC records"""
+
+    def __init__(self, *args, limits=(0, 0), **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sim_limits = tuple(limits)
+
+    @property
+    def limits(self):
+        return self._sim_limits
+
+    @property
+    def low_limit(self):
+        return self._sim_limits[0]
+
+    @property
+    def high_limit(self):
+        return self._sim_limits[1]
+
+
+class SimTaxiFlySignal(Signal):
+    """
+    Soft taxi/fly busy record, moves the rotation like the PSOFly IOC: taxi goes
+    to start - scan_delta, fly to end.
+    """
+
+    def set(self, value, **kwargs):
+        _parent = self.parent
+        _target = {
+            'taxi': _parent.start.get() - _parent.scan_delta.get(),
+            'fly':  _parent.end.get(),
+        }[self.attr_name]
+        super().put(value)
+        _status = _parent.motor.set(_target)
+        _status.add_callback(lambda status: Signal.put(self, "Done"))
+        return _status
+
+
+class SimEnsemblePSOFlyDevice(Device):
+    """
+    Simulated PSOfly control for debug mode
+
+    Exposes the same signals as EnsemblePSOFlyDevice (as soft signals) so that the
+    fly scan plans can be executed against the virtual beamline.  Taxi and fly
+    move the simulated rotation (motor_pv_name) between start and end.
+    """
+    taxi       = Component(SimTaxiFlySignal, value="Done")
+    fly        = Component(SimTaxiFlySignal, value="Done")
+
+    reset_fpga = Component(Signal, value="0")
+    pso_state  = Component(Signal, value="0")
+    soft_pulse     = Component(Signal, value=0)
+    soft_pulse_out = Component(Signal, value="")
+
+    fi1_signal = Component(Signal, value="")
+    fi2_signal = Component(Signal, value="")
+    fi3_signal = Component(Signal, value="")
+    fi4_signal = Component(Signal, value="")
+    fi5_signal = Component(Signal, value="")
+
+    motor_pv_name = Component(Signal, value="6iddSIM:m4")
+    start         = Component(Signal, value=0.0)
+    end           = Component(Signal, value=0.0)
+    slew_speed    = Component(SimPSOSignal, value=1.0, limits=(0.001, 10))
+    scan_delta    = Component(SimPSOSignal, value=1.0, limits=(0.001, 360))
+
+    delta_time          = Component(Signal, value=0.0)
+    detector_setup_time = Component(Signal, value=0.0)
+    pulse_type          = Component(Signal, value="Gate")
+    scan_control        = Component(Signal, value="")
+
+    pso_mode       = Component(Signal, value="Window")
+    pso_array      = Component(Signal, value=[])
+    trigger_angles = Component(Signal, value=[], kind='config')
+
+    fly_angles  = EnsemblePSOFlyDevice.fly_angles
+    _fly        = EnsemblePSOFlyDevice._fly
+    step_pulses = EnsemblePSOFlyDevice.step_pulses
+
+    @property
+    def motor(self):
+        """the rotation driven by the (simulated) IOC"""
+        if getattr(self, '_motor', None) is None:
+            self._motor = EpicsMotor(self.motor_pv_name.get(), name=f"{self.name}_motor")
+        return self._motor
+
 
 if __name__ == "__main__":
     # example usage
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+
+"""
+This module provides RunEngine document subscribers that keep metadata capture
+off the acquisition thread and independent of a live database.
+
+NOTE:
+* The RunEngine calls every subscriber synchronously, therefore anything slow
+  (e.g. a MongoDB round trip per document) directly adds dead time to a scan.
+"""
+
+import os
+import glob
+import json
+import time
+import queue
+import threading
+
+
+def _json_default(obj):
+    """make numpy scalars/arrays (and anything else with tolist) json friendly"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+def pack_event_page(events):
+    """pack events sharing the same descriptor into a columnar event_page"""
+    _keys = events[0]['data'].keys()
+    _filled = events[0].get('filled', {}).keys()
+    return {
+        'descriptor': events[0]['descriptor'],
+        'uid':        [me['uid']     for me in events],
+        'seq_num':    [me['seq_num'] for me in events],
+        'time':       [me['time']    for me in events],
+        'data':       {k: [me['data'][k]       for me in events] for k in _keys},
+        'timestamps': {k: [me['timestamps'][k] for me in events] for k in _keys},
+        'filled':     {k: [me['filled'][k]     for me in events] for k in _filled},
+    }
+
+
+def unpack_event_page(page):
+    """iterate over the events stored in an event_page"""
+    for i, _uid in enumerate(page['uid']):
+        yield {
+            'descriptor': page['descriptor'],
+            'uid':        _uid,
+            'seq_num':    page['seq_num'][i],
+            'time':       page['time'][i],
+            'data':       {k: v[i] for k, v in page['data'].items()},
+            'timestamps': {k: v[i] for k, v in page['timestamps'].items()},
+            'filled':     {k: v[i] for k, v in page.get('filled', {}).items()},
+        }
+
+
+def _expand_event_pages(docs):
+    for name, doc in docs:
+        if name == 'event_page':
+            for me in unpack_event_page(doc):
+                yield 'event', me
+        else:
+            yield name, doc
+
+
+def insert_documents(db, docs):
+    """
+    Insert a sequence of (name, doc) into databroker, batching the events.
+
+    Consecutive events (or event pages) sharing the same descriptor are written
+    with a single bulk insert when the metadata store supports it, everything
+    else goes through the regular db.insert.  Resource and datum documents do
+    not interrupt a batch, they only need to be in before their events.
+    """
+    _mds = getattr(db, 'mds', None)
+    _bulk = getattr(_mds, 'bulk_insert_events', None)
+
+    _events = []
+    def _flush_events():
+        if not _events:
+            return
+        if _bulk is None:
+            for me in _events:
+                db.insert('event', me)
+        else:
+            _bulk(_events[0]['descriptor'], list(_events))
+        _events.clear()
+
+    for name, doc in _expand_event_pages(docs):
+        if name == 'event':
+            if _events and _events[0]['descriptor'] != doc['descriptor']:
+                _flush_events()
+            _events.append(doc)
+        else:
+            if name not in EventPageBuffer.PASS_THROUGH:
+                _flush_events()
+            db.insert(name, doc)
+    _flush_events()
+
+
+class EventPageBuffer:
+    """
+    Subscriber wrapper packing consecutive events into event_page documents
+
+    The per-angle trigger_and_read of a step scan emits one event per frame (1800
+    per layer for a 0.2 deg scan).  Wrapped subscribers receive them as pages of
+    up to page_size events instead, so their overhead scales with pages.  The
+    resource and datum documents of the file registration (one datum per frame)
+    are passed through right away, they only have to precede the events that
+    reference them.  Any other document (descriptor, stop, ...) flushes the
+    current page first, therefore the event order is preserved.
+
+    NOTE:
+    * Events are held until the page is full or the stream changes, keep live
+      plotting (e.g. BestEffortCallback) subscribed to the RunEngine directly.
+
+    Usage:
+    >> RE.subscribe(EventPageBuffer(inserter, journal, page_size=200))
+    """
+
+    # documents that do not end the current page
+    PASS_THROUGH = ('resource', 'datum', 'datum_page')
+
+    def __init__(self, *callbacks, page_size: int=500):
+        self.callbacks = list(callbacks)
+        self.page_size = page_size
+        self._events = []
+
+    def __call__(self, name, doc):
+        if name == 'event':
+            if self._events and self._events[0]['descriptor'] != doc['descriptor']:
+                self.flush()
+            self._events.append(doc)
+            if len(self._events) >= self.page_size:
+                self.flush()
+            return
+        if name not in self.PASS_THROUGH:
+            self.flush()
+        self._emit(name, doc)
+
+    def flush(self):
+        """emit the pending events as one event_page"""
+        if not self._events:
+            return
+        _page = pack_event_page(self._events)
+        self._events = []
+        self._emit('event_page', _page)
+
+    def _emit(self, name, doc):
+        for cb in self.callbacks:
+            cb(name, doc)
+
+
+class BufferedInserter:
+    """
+    RunEngine subscriber inserting documents into databroker from a worker thread
+
+    Documents are queued and written in batches by a background thread.  The
+    RunEngine is only slowed down (backpressure) when the buffer is full.  If the
+    database cannot be reached, the documents are appended to a local spool that
+    can be drained into the database later.
+
+    With a journal (DocumentJournal subscribed to the same stream) nothing is
+    spooled, the journal already holds every document.  The runs missed by the
+    database are remembered and their journals replayed by drain().
+
+    Usage:
+    >> journal = DocumentJournal()
+    >> inserter = BufferedInserter(db, journal=journal)
+    >> RE.subscribe(journal)
+    >> RE.subscribe(inserter)
+    >> # ... once MongoDB is back
+    >> inserter.drain()
+    """
+
+    def __init__(
+            self,
+            db=None,
+            maxsize: int=20000,
+            batch_size: int=500,
+            flush_interval: float=0.5,
+            spool_dir: str=None,
+            journal=None,
+        ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir if spool_dir is not None else os.path.join(
+            os.path.expanduser('~'), '.local', 'share', 'seisidd', 'spool',
+        )
+        self.journal = journal
+        # once anything is spooled, keep spooling until drained so that the
+        # document order in the database is never broken
+        self.online = db is not None
+        self._spool_file = None
+        self._run_uid = None
+        self._missed_runs = []
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='BufferedInserter', daemon=True)
+        self._worker.start()
+
+    def __call__(self, name, doc):
+        # blocks only when the buffer is full
+        self._queue.put((name, doc))
+
+    @property
+    def backlog(self):
+        """number of documents waiting to be written"""
+        return self._queue.qsize()
+
+    def flush(self):
+        """block until every queued document is written (to db or spool)"""
+        self._queue.join()
+
+    def close(self):
+        """write the queued documents and stop the worker thread"""
+        self._stop.set()
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            try:
+                _item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # stop only once everything queued is written
+                if self._stop.is_set():
+                    return
+                continue
+            _batch = [_item]
+            _deadline = time.monotonic() + self.flush_interval
+            # gather a batch, but never hold documents longer than flush_interval
+            while len(_batch) < self.batch_size:
+                try:
+                    _item = self._queue.get(timeout=max(_deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                _batch.append(_item)
+            try:
+                self._write(_batch)
+            finally:
+                for _ in _batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        if self.online:
+            try:
+                insert_documents(self.db, batch)
+                self._track_runs(batch)
+                return
+            except Exception as ex:
+                self.online = False
+                _where = "kept in the journal" if self.journal is not None else f"spooled to {self.spool_dir}"
+                print(f"Databroker insert failed ({ex}), documents are {_where}")
+                print("Use .drain() to push them into the database once it is back online")
+        if self.journal is None:
+            self._spool(batch)
+            return
+        # the whole run is replayed from its journal (duplicates skipped)
+        if batch[0][0] != 'start' and self._run_uid is not None and self._run_uid not in self._missed_runs:
+            self._missed_runs.append(self._run_uid)
+        for _uid in self._track_runs(batch):
+            self._missed_runs.append(_uid)
+
+    def _track_runs(self, batch):
+        """follow the run the documents belong to, returns the new run uids"""
+        _uids = [doc['uid'] for name, doc in batch if name == 'start']
+        if _uids:
+            self._run_uid = _uids[-1]
+        return _uids
+
+    def _spool(self, batch):
+        if self._spool_file is None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._spool_file = os.path.join(
+                self.spool_dir,
+                f"spool_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}.jsonl",
+            )
+        with open(self._spool_file, 'a') as f:
+            for name, doc in batch:
+                f.write(json.dumps([name, doc], default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def drain(self, db=None, chunk_size: int=5000):
+        """
+        Push all spooled documents (or the journals of the missed runs) into db
+        (default: the inserter database).
+
+        Spool files are removed once fully inserted.  Documents already present in
+        the database (partially written batch) are skipped.  Call it between scans.
+        """
+        db = self.db if db is None else db
+        if db is None:
+            raise ValueError("No databroker to drain the spool into")
+        self.flush()
+        _n = 0
+        for _fn in sorted(glob.glob(os.path.join(self.spool_dir, 'spool_*.jsonl'))):
+            with open(_fn, 'r') as f:
+                _docs = [tuple(json.loads(me)) for me in f if me.strip()]
+            _insert_new_documents(db, _docs, chunk_size)
+            os.remove(_fn)
+            _n += len(_docs)
+            if _fn == self._spool_file:
+                self._spool_file = None
+        for _uid in list(self._missed_runs):
+            _fn = self.journal.files.get(_uid)
+            if _fn is None:
+                raise RuntimeError(f"No journal for run {_uid}")
+            if _fn == self.journal.current_file and self.journal.is_open:
+                raise RuntimeError(f"The journal of run {_uid} is still open, drain between scans")
+            _docs = list(read_journal(_fn))
+            _insert_new_documents(db, _docs, chunk_size)
+            self._missed_runs.remove(_uid)
+            _n += len(_docs)
+        self.db = db
+        self.online = True
+        return _n
+
+
+def _insert_new_documents(db, docs, chunk_size: int=5000):
+    """insert documents, skipping those already in the database"""
+    for i in range(0, len(docs), chunk_size):
+        _chunk = docs[i:i+chunk_size]
+        try:
+            insert_documents(db, _chunk)
+        except Exception as ex:
+            if 'duplicate' not in str(ex).lower():
+                raise
+            # part of this chunk made it in before the connection dropped
+            for me in _chunk:
+                try:
+                    insert_documents(db, [me])
+                except Exception as ex_doc:
+                    if 'duplicate' not in str(ex_doc).lower():
+                        raise
+
+
+class DocumentJournal:
+    """
+    Append-only journal of RunEngine documents, one file per run
+
+    Every document is appended to the journal of the current run, and the file is
+    flushed and fsync'ed when the stop document arrives.  The journal does not
+    depend on any database, use replay_journal() to load it into databroker.
+
+    Supported formats:
+        jsonl   : one json list [name, doc] per line (default, human readable)
+        msgpack : concatenated msgpack [name, doc] records (requires msgpack)
+
+    A run journal is appended to, unless overwrite is True (a new file per
+    start document, e.g. when the runs are imported again).
+
+    Usage:
+    >> journal = DocumentJournal('/home/beams/S6HEDM/journal')
+    >> RE.subscribe(journal)
+    """
+
+    def __init__(self, journal_dir: str=None, fmt: str='jsonl', overwrite: bool=False):
+        if fmt not in ['jsonl', 'msgpack']:
+            raise ValueError(f"Unsupported journal format {fmt}")
+        self.fmt = fmt
+        self.overwrite = overwrite
+        self.journal_dir = journal_dir if journal_dir is not None else os.path.join(
+            os.path.expanduser('~'), '.local', 'share', 'seisidd', 'journal',
+        )
+        self.current_file = None
+        # journal file of every run written by this journal
+        self.files = {}
+        self._fh = None
+        if fmt == 'msgpack':
+            import msgpack
+            self._packer = msgpack.Packer(default=_json_default, use_bin_type=True)
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            self._open(doc)
+        if self._fh is None:
+            # document outside a run (should not happen with the RunEngine)
+            return
+        if self.fmt == 'jsonl':
+            self._fh.write(json.dumps([name, doc], default=_json_default) + "\n")
+        else:
+            self._fh.write(self._packer.pack([name, doc]))
+        if name == 'stop':
+            self._close()
+
+    @property
+    def is_open(self):
+        return self._fh is not None
+
+    def close(self):
+        """close the current journal (e.g. run interrupted without stop document)"""
+        if self._fh is not None:
+            self._close()
+
+    def _open(self, start_doc):
+        if self._fh is not None:
+            self._close()
+        os.makedirs(self.journal_dir, exist_ok=True)
+        _stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start_doc.get('time', time.time())))
+        self.current_file = os.path.join(
+            self.journal_dir,
+            f"{_stamp}_{start_doc['uid'][:8]}.{self.fmt}",
+        )
+        self.files[start_doc['uid']] = self.current_file
+        _mode = 'w' if self.overwrite else 'a'
+        self._fh = open(self.current_file, _mode if self.fmt == 'jsonl' else _mode + 'b')
+
+    def _close(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        self._fh = None
+
+
+def read_journal(path: str):
+    """
+    Iterate over the (name, doc) stored in a journal file.
+
+    A truncated last record (e.g. power loss before the stop document) is skipped.
+    """
+    if path.endswith('.msgpack'):
+        import msgpack
+        with open(path, 'rb') as f:
+            _unpacker = msgpack.Unpacker(f, raw=False)
+            try:
+                for name, doc in _unpacker:
+                    yield name, doc
+            except msgpack.exceptions.OutOfData:
+                return
+    else:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    name, doc = json.loads(line)
+                except ValueError:
+                    # only the last line can be incomplete
+                    return
+                yield name, doc
+
+
+def journal_files(path: str):
+    """list journal files from a file, a directory or a glob pattern"""
+    if os.path.isdir(path):
+        _fns = glob.glob(os.path.join(path, '*.jsonl')) + glob.glob(os.path.join(path, '*.msgpack'))
+    else:
+        _fns = glob.glob(path)
+    return sorted(_fns)
+
+
+def replay_journal(path: str, db, chunk_size: int=5000, verbose: bool=True):
+    """
+    Bulk-load journal file(s) into a databroker backend.
+
+    path can be a single journal, a journal directory or a glob pattern, and db
+    anything with the databroker insert(name, doc) API.  Events are inserted in
+    bulk where the backend supports it.
+
+    Example:
+    >> db = databroker.Broker.named("mongodb_config")
+    >> replay_journal('~/.local/share/seisidd/journal', db)
+    >> {'20201018-101010_1a2b3c4d.jsonl': 1812, ...}
+    """
+    _counts = {}
+    for _fn in journal_files(os.path.expanduser(path)):
+        _t0 = time.perf_counter()
+        _chunk, _n = [], 0
+        for me in read_journal(_fn):
+            _chunk.append(me)
+            if len(_chunk) >= chunk_size:
+                insert_documents(db, _chunk)
+                _n += len(_chunk)
+                _chunk = []
+        insert_documents(db, _chunk)
+        _n += len(_chunk)
+        _counts[os.path.basename(_fn)] = _n
+        if verbose:
+            _dt = time.perf_counter() - _t0
+            print(f"{os.path.basename(_fn)}: {_n} documents in {_dt:.2f} s")
+    return _counts
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
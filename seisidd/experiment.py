@@ -23,10 +23,22 @@ from   time                          import sleep
 from  .devices.beamline              import Beam, SimBeam
 from  .devices.beamline              import FastShutter
 from  .devices.motors                import StageAero, SimStageAero
-from  .devices.motors                import EnsemblePSOFlyDevice
+from  .devices.motors                import EnsemblePSOFlyDevice, SimEnsemblePSOFlyDevice
 from  .devices.detectors             import Varex4343CT, PointGreyDetector, DexelaDetector, SimDetector  
+from  .docstream                     import BufferedInserter, DocumentJournal, EventPageBuffer
+from  .handlers                      import register_handlers
+from  .hdf5layout                    import configure_hdf_layout
+from  .ndattributes                  import read_attributes_xml, classify_attributes
+from  .ndattributes                  import read_static_values, write_run_static_attributes
+from  .ffsparse                      import sparsify_run
+from  .spotfinder                    import LiveSpotFinder
+from  .ffreduce                      import LayerReducer
+from  .saturation                    import SaturationGuard
+from  .calibration                   import calibrate_file, update_config
+from  .scanindex                     import ScanIndex
 from  .util                          import dict_to_msg
 from  .util                          import load_config
+from  .util                          import config_to_md
 from  .util                          import is_light_on
 
 import bluesky.preprocessors as bpp
@@ -85,6 +97,7 @@ class Experiment:
 
         # setup the RunEngine
         self.RE = bluesky.RunEngine({})
+        self.db = None
         try:
             # NOTE
             # The MongoDB configuration file should be
@@ -92,11 +105,23 @@ class Experiment:
             # Check the MongoDB container running state if RE cannot locate
             # the service (most likely a host name or port number error)
             self.db = databroker.Broker.named("mongodb_config")
-            self.RE.subscribe(self.db.insert)
-        except:
-            print("MongoDB metadata recording stream is not configured properly")
-            print("Please double check the MongoBD server and try a manual setup")
+            # frames are referenced through resource/datum documents
+            register_handlers(self.db)
+        except Exception as ex:
+            print(f"MongoDB metadata recording stream is not configured properly: {ex}")
+            print("Documents are kept in the local journal, use $ExperimentName.db_inserter.drain(db) later")
         finally:
+            # local journal, metadata capture never depends on a live database
+            self.journal = DocumentJournal()
+            # documents are written by a worker thread, the runs missed while MongoDB
+            # is not reachable are replayed from the journal
+            self.db_inserter = BufferedInserter(self.db, journal=self.journal)
+            # per-angle events reach the database and the journal as event pages
+            self.event_pages = EventPageBuffer(self.db_inserter, self.journal)
+            self.RE.subscribe(self.event_pages)
+            # local searchable index of the scans, see .scan_index.search()
+            self.scan_index = ScanIndex()
+            self.RE.subscribe(self.scan_index)
             print("It is recommended to have only one RunEngine per experiment/notebook")
             print("You can expose the RunEngine to global scope via: RE=$ExperimentName.RE")
 
@@ -195,7 +220,22 @@ class Experiment:
             self._safe2go = True
             print("Now call scan one more time to start RE")
         else:
-            self.RE(self._mysetup.scan(self, *args, **kwargs))
+            _uids = self.RE(self._mysetup.scan(self, *args, **kwargs))
+            # continuous multi-revolution scan, split frames per revolution
+            _cfg_setup = self._config[self._mysetup.setup_name]
+            # static NDAttributes are read once per scan, add them to the closed files
+            if self._mode != 'debug' and self._config['output']['type'] in ['hdf', 'hdf1', 'hdf5']:
+                for _uid in _uids or []:
+                    write_run_static_attributes(self.scan_index, _uid)
+            # FF: sparse copy of each layer file (spots only)
+            if _cfg_setup.get('sparse', {}).get('enabled', False) \
+                and self._mode != 'debug' \
+                and self._config['output']['type'] in ['hdf', 'hdf1', 'hdf5']:
+                for _uid in _uids or []:
+                    sparsify_run(self.scan_index, _uid, _cfg_setup['sparse'])
+            if 'continuous' in _cfg_setup and self._config['output']['type'] in ['hdf', 'hdf1', 'hdf5']:
+                from .h5tools import write_revolution_index
+                write_revolution_index(self.detector, _cfg_setup)
 
     def collect_white(self, *args, **kwargs):
         """wrapper of the still white field image acquisition"""
@@ -250,9 +290,8 @@ class Tomography:
     @staticmethod
     def get_flycontrol(mode):
         # the mode check should be done at the experiment level
-        from ophyd import sim
         return {
-            'debug':       sim.flyer1,
+            'debug':       SimEnsemblePSOFlyDevice(name="psofly"),
             'dryrun':      EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             'production':  EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             }[mode]
@@ -290,10 +329,15 @@ class Tomography:
 
         # set the attribute file (det.cam) and the layout file (det.hdf1)
         _current_fp = str(pathlib.Path(__file__).parent.absolute())
-        _attrib_fp = os.path.join(_current_fp, 'config/PG4_attributes.xml')
-        _layout_fp = os.path.join(_current_fp, 'config/tomo6idd_layout.xml')
-        det.cam1.nd_attributes_file.put(_attrib_fp)
-        det.hdf1.xml_file_name.put(_layout_fp)
+        # NOTE: only the per-frame (dynamic) attributes are in the slim file, the static
+        #       ones are read once per scan (see seisidd.ndattributes)
+        _attrib_fp = os.path.join(_current_fp, 'config/PG4_attributes_slim.xml')
+        if det.cam1.nd_attributes_file.get() != _attrib_fp:
+            det.cam1.nd_attributes_file.put(_attrib_fp)
+        det.nd_static_attributes, _ = classify_attributes(
+            read_attributes_xml(os.path.join(_current_fp, 'config/PG4_attributes.xml'))
+        )
+        # NOTE: the layout (XML content) is pushed to hdf1 once the camera is primed
 
         # turn off the problematic auto setting in cam1
         # NOTE:
@@ -337,6 +381,8 @@ class Tomography:
         det.cam1.acquire.put(0)
         det.hdf1.enable.put(0)
         det.hdf1.auto_increment.put(1)
+        # ---- dxchange layout and chunking for the tomo access pattern (sinogram)
+        configure_hdf_layout(det, 'tomo')
         # ---- turn on auto save (supercede by disable, so we are safe)
         det.tiff1.auto_save.put(1)
         det.hdf1.auto_save.put(1)
@@ -443,11 +489,75 @@ class Tomography:
             cfg['tomo']['omega_end']+cfg['tomo']['omega_step']/2,
             cfg['tomo']['omega_step'],
         )
+        # golden-angle interlaced fly scan, n_interlace=1 falls back to the regular sweep
+        n_interlace = cfg['tomo'].get('n_interlace', 1)
+        if cfg['tomo']['type'].lower() == 'fly' and n_interlace > 1:
+            from seisidd.util import golden_angle_interlace
+            _angle_table, _offsets = golden_angle_interlace(
+                cfg['tomo']['omega_start'],
+                cfg['tomo']['omega_end'],
+                cfg['tomo']['omega_step'],
+                n_interlace,
+            )
+            angs = _angle_table.flatten()  # acquisition order
+            cfg['tomo']['interlace_offsets'] = _offsets.tolist()
+            cfg['tomo']['n_per_loop']        = _angle_table.shape[1]
+        # helical scan: ky travels at constant speed during one long rotation
+        # -- the pitch (ky travel per 360 deg) is a fraction of the beam height
+        # -- one extra turn makes sure both ends of the volume are fully sampled
+        _omega_end = cfg['tomo']['omega_end']
+        if cfg['tomo']['type'].lower() == 'helical':
+            _cfg_helical = cfg['tomo']['helical']
+            _ky_start = cfg['tomo']['volume']['ky_start']
+            _ky_span  = (cfg['tomo']['volume']['n_layers']-1)*cfg['tomo']['volume']['ky_step']
+            _pitch    = _cfg_helical['pitch_ratio']*_cfg_helical['beam_height']*np.sign(_ky_span)
+            if _pitch == 0:
+                raise ValueError("Helical scan requires non-zero ky_step and pitch")
+            _n_turns  = abs(_ky_span/_pitch) + 1
+            _omega_end = cfg['tomo']['omega_start'] + 360*_n_turns
+            angs = np.arange(
+                cfg['tomo']['omega_start'],
+                _omega_end + cfg['tomo']['omega_step']/2,
+                cfg['tomo']['omega_step'],
+            )
+            _cfg_helical['pitch']     = _pitch
+            _cfg_helical['omega_end'] = _omega_end
+            _cfg_helical['ky_end']    = _ky_start + _pitch*_n_turns
+            ky_positions = _ky_start + _pitch*(angs - cfg['tomo']['omega_start'])/360
+        # continuous multi-revolution fly for repeated same-layer (ky_step == 0) scans
+        # -- the rotation keeps spinning through n_layers*360, no stop between layers
+        # -- the last frame (360) of each revolution is the first of the next one
+        cfg['tomo'].pop('continuous', None)
+        if cfg['tomo']['type'].lower() == 'fly' \
+            and cfg['tomo']['volume']['ky_step'] == 0 \
+            and cfg['tomo']['volume'].get('continuous', False):
+            if abs(abs(cfg['tomo']['omega_end'] - cfg['tomo']['omega_start']) - 360) > 1e-6:
+                raise ValueError("Continuous multi-revolution scan requires a 360 deg omega range")
+            if n_interlace > 1:
+                raise ValueError("Continuous multi-revolution scan cannot be interlaced")
+            _n_revolutions = cfg['tomo']['volume']['n_layers']
+            _omega_end = cfg['tomo']['omega_start'] + 360*_n_revolutions
+            angs = np.arange(
+                cfg['tomo']['omega_start'],
+                _omega_end + cfg['tomo']['omega_step']/2,
+                cfg['tomo']['omega_step'],
+            )
+            cfg['tomo']['continuous'] = {
+                'n_revolutions':         _n_revolutions,
+                'frames_per_revolution': int(round(360/abs(cfg['tomo']['omega_step']))),
+                'omega_end':             _omega_end,
+                'first_frame':           0,
+                'overlap':               1,
+            }
         n_projections = len(angs)
         cfg['tomo']['n_projections'] = n_projections
         cfg['tomo']['total_images']  = n_white + n_projections + n_white + n_dark
         fp = cfg['output']['filepath']
         fn = cfg['output']['fileprefix']
+        # layer: one file per ky layer (default), volume: hdf1 armed once for all layers
+        _volume_capture = cfg['output'].get('capture', 'layer').lower() == 'volume'
+        if _volume_capture and cfg['output']['type'] not in ['hdf', 'hdf1', 'hdf5']:
+            raise ValueError("Volume capture requires HDF5 output")
 
         # TODO
         # consider adding an extra step to:
@@ -498,14 +608,14 @@ class Tomography:
         #   decide what to do with the focus lenses
 
         # calculate slew speed for fly scan
-        if cfg['tomo']['type'].lower() == 'fly':
+        if cfg['tomo']['type'].lower() in ['fly', 'helical']:
             # using tested formula adapted from 1ID
             from seisidd.util import tomo_pso_config
             cfg['tomo']['slew_speed'], cfg['tomo']['scan_delta'], cfg['tomo']['detector_setup_time'] = tomo_pso_config(
                 psofly,
                 cfg['tomo']['omega_start'],
-                cfg['tomo']['omega_end'],
-                cfg['tomo']['omega_step'],
+                _omega_end,
+                cfg['tomo']['omega_step']*n_interlace,  # coarse step for interlaced scan
                 cfg['tomo']['acquire_time'],
                 camera_make='PointGrey',
                 speed_scale=0.9,    # scale down from 1 to add padding.
@@ -513,7 +623,7 @@ class Tomography:
         # need to make sure that the sample out position is the same for both front and back
         x0, z0 = tomostage.kx.position, tomostage.kz.position
         dfx, dfz = cfg['tomo']['sample_out_position']['kx'], cfg['tomo']['sample_out_position']['kz']
-        rotang = np.radians(cfg['tomo']['omega_end']-cfg['tomo']['omega_start'])
+        rotang = np.radians(_omega_end-cfg['tomo']['omega_start'])
         rotm = np.array([[ np.cos(rotang), np.sin(rotang)],
                          [-np.sin(rotang), np.cos(rotang)]])
         dbxz = np.dot(rotm, np.array([dfx, dfz]))
@@ -536,12 +646,8 @@ class Tomography:
         for me in [det.tiff1, det.hdf1]:
             me.file_path.put(fp)
 
-        # Reset Aero rotation to ~0 if didn;t clean up after previous scan
-        if tomostage.rot.position > 180:    
-            tomostage.rot.set_use_switch.put(1)
-            tomostage.rot.dial_setpoint.put(tomostage.rot.dial_readback.get()-360)
-            tomostage.rot.user_offset.put(0)
-            tomostage.rot.set_use_switch.put(0) 
+        # Unwind Aero rotation (whole turns, no motion) if didn't clean up after previous scan
+        yield from tomostage.rot.unwind_near(cfg['tomo']['omega_start'])
          
         # repare cam1
         det.cam1.trigger_mode.put('Internal')
@@ -566,22 +672,14 @@ class Tomography:
         ## step 4: Actual Scan ##
         #########################
 
-        # @bpp.finalize_decorator(Tomography.safe_guard(experiment))
-        def scan_singleview():
-            # TODO:
-            # Somewhere we need to check the light status
-            # open shutter for beam
-            if mode.lower() in ['production']:
-                yield from bps.mv(shutter, 'open')
-                # no suspender for main shutter
-#                 yield from bps.install_suspender(shutter_suspender)
-            # config output
+        def config_output(num_capture):
+            """arm tiff1/hdf1 for the next num_capture images"""
             if mode.lower() in ['dryrun','production']:
                 for me in [det.tiff1, det.hdf1]:
                     yield from bps.mv(me.file_name, fn)
                     # yield from bps.mv(me.file_path, fp)
                     yield from bps.mv(me.file_write_mode, 2)  # 1: capture, 2: stream
-                    yield from bps.mv(me.num_capture, cfg['tomo']['total_images'])
+                    yield from bps.mv(me.num_capture, num_capture)
                     yield from bps.mv(me.file_template, ".".join([r"%s%s_%06d",cfg['output']['type'].lower()]))    
             elif mode.lower() in ['debug']:
                 for me in [det.tiff1, det.hdf1]:
@@ -590,7 +688,7 @@ class Tomography:
                     yield from bps.mv(me.file_name, fn)
                     yield from bps.mv(me.file_write_mode, 2) # 1: capture, 2: stream
                     yield from bps.mv(me.auto_increment, 1)
-                    yield from bps.mv(me.num_capture, cfg['tomo']['total_images'])
+                    yield from bps.mv(me.num_capture, num_capture)
                     yield from bps.mv(me.file_template, ".".join([r"%s%s_%06d",cfg['output']['type'].lower()]))
             
             if cfg['output']['type'] in ['tif', 'tiff']:
@@ -604,6 +702,19 @@ class Tomography:
             else:
                 raise ValueError(f"Unsupported output type {cfg['output']['type']}")
 
+        # @bpp.finalize_decorator(Tomography.safe_guard(experiment))
+        def scan_singleview():
+            # TODO:
+            # Somewhere we need to check the light status
+            # open shutter for beam
+            if mode.lower() in ['production']:
+                yield from bps.mv(shutter, 'open')
+                # no suspender for main shutter
+#                 yield from bps.install_suspender(shutter_suspender)
+            # config output
+            if not _volume_capture:
+                yield from config_output(cfg['tomo']['total_images'])
+
             # setting acquire_time and acquire_period
             yield from bps.mv(det.cam1.trigger_mode, 'Internal')
             yield from bps.mv(det.cam1.frame_rate_on_off, 1)
@@ -618,8 +729,12 @@ class Tomography:
             yield from bps.mv(det.cam1.frame_type, 1)  # for HDF5 dxchange data structure
             if cfg['tomo']['type'].lower() == 'step':
                 yield from Tomography.step_scan(experiment)
+            elif cfg['tomo']['type'].lower() == 'hwstep':
+                yield from Tomography.hardware_step_scan(experiment)
             elif cfg['tomo']['type'].lower() == 'fly':
                 yield from Tomography.fly_scan(experiment)
+            elif cfg['tomo']['type'].lower() == 'helical':
+                yield from Tomography.helical_scan(experiment)
             else:
                 raise ValueError(f"Unsupported scan type: {cfg['tomo']['type']}")
     
@@ -645,7 +760,10 @@ class Tomography:
         n_layers   = cfg['tomo']['volume']['n_layers']
         ky_start   = cfg['tomo']['volume']['ky_start']
         ky_step    = cfg['tomo']['volume']['ky_step']
-        if ky_step == 0:
+        if cfg['tomo']['type'].lower() == 'helical' or 'continuous' in cfg['tomo']:
+            # the whole volume (or time series) is covered by a single pass
+            _scan_positions = (ky_start, )
+        elif ky_step == 0:
             # To repeat the current layer for n_layer times
             # !!! The layer/file number will still increase for this same layer
             _scan_positions = tuple(np.arange(n_layers))
@@ -653,9 +771,38 @@ class Tomography:
         else:
             _scan_positions = tuple(np.arange(ky_start, ky_start+(n_layers-0.5)*ky_step, ky_step))
         
+        # per-frame rotation angles (acquisition order) are kept with the run
+        # so that interlaced projections can be sorted during reconstruction
+        _md = {'rotation_angles': [float(me) for me in angs]}
+        _md.update(config_to_md(cfg, 'tomo'))
+        if mode != 'debug':
+            # once-per-scan detector metadata, no longer stored with every frame
+            _md['detector_static'] = read_static_values(getattr(det, 'nd_static_attributes', []))
+            if cfg['output']['type'].lower() in ['hdf', 'hdf1', 'hdf5']:
+                # HDF5 file numbers [first, last) written by this run, one file per layer
+                _first = int(det.hdf1.file_number.get())
+                _md['file_numbers'] = [_first, _first + (1 if _volume_capture else len(_scan_positions))]
+        if cfg['tomo']['type'].lower() == 'helical':
+            _md['ky_positions'] = [float(me) for me in ky_positions]
+        if 'continuous' in cfg['tomo']:
+            _md['revolutions'] = cfg['tomo']['continuous']
+        if _volume_capture:
+            # layer i of each dataset is frames [i*n, (i+1)*n) of the single file
+            _md['volume_capture'] = {
+                'n_layers':         len(_scan_positions),
+                'frames_per_layer': {
+                    'data':            n_projections,
+                    'data_white_pre':  n_white,
+                    'data_white_post': n_white,
+                    'data_dark':       n_dark,
+                },
+            }
+
         @bpp.stage_decorator([det])
-        @bpp.run_decorator()
+        @bpp.run_decorator(md=_md)
         def scan_closure():
+            if _volume_capture:
+                yield from config_output(cfg['tomo']['total_images']*len(_scan_positions))
             for _current_scan_ky in _scan_positions:
                 _start = ky_start if ky_step == 0 else _current_scan_ky
                 yield from bps.mv(tomostage.ky, _start)
@@ -689,11 +836,77 @@ class Tomography:
             cfg_tomo['omega_end']+cfg_tomo['omega_step']/2,
             cfg_tomo['omega_step'],
         )
+        yield from tomostage.rot.shortest_move(angs[0])
         for ang in angs:
             yield from bps.checkpoint()
             yield from bps.mv(tomostage.rot, ang)
             yield from bps.trigger_and_read([det])
 
+    @staticmethod
+    def hardware_step_scan(experiment):
+        """
+        Step scan with the camera armed once in external trigger mode.
+
+        The stage still stops at every angle, but instead of a trigger_and_read per
+        angle, the softGlue FPGA sends n_frames pulses to the camera once the move
+        is done, each after the camera counted the previous frame, and all images
+        go into a single acquisition.
+        """
+        det = experiment.detector
+        tomostage = experiment.stage
+        psofly = experiment.flycontrol
+        cfg_tomo = experiment.config['tomo']
+
+        # Raw images go through the following plugins:
+        #       PG1 ==> TRANS1 ==> PROC1 ==> TIFF1
+        #                 ||          ||
+        #                 ==> IMAGE1  ======> HDF1
+        yield from bps.mv(det.proc1.nd_array_port, 'TRANS1')
+        yield from bps.mv(det.hdf1.nd_array_port, 'PROC1')
+        yield from bps.mv(det.tiff1.nd_array_port, 'PROC1') 
+        yield from bps.mv(det.trans1.enable, 1) 
+        yield from bps.mv(det.proc1.enable, 1)
+        yield from bps.mv(det.proc1.enable_filter, 1)
+        yield from bps.mv(det.proc1.filter_type, 'Average')
+        yield from bps.mv(det.proc1.reset_filter, 1)
+        yield from bps.mv(det.proc1.num_filter, cfg_tomo['n_frames'])
+
+        angs = np.arange(
+            cfg_tomo['omega_start'], 
+            cfg_tomo['omega_end']+cfg_tomo['omega_step']/2,
+            cfg_tomo['omega_step'],
+        )
+        # route the software pulse to the camera
+        yield from bps.mv(psofly.soft_pulse_out, "swpls")  # caput(6idMZ1:SG:BUFFER-2_OUT_Signal, swpls), name the software pulse output
+        yield from bps.mv(psofly.reset_fpga, "1")  # caput(6idMZ1:SG:BUFFER-1_IN_Signal.PROC, 1), reest FPGA circutry 
+        yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        yield from bps.mv(psofly.fi2_signal, "swpls") # program in FPGA to take the software pulse for TomoExp
+        yield from bps.mv(psofly.fi3_signal, "")  # clear other signal inputs from NF and FF
+        yield from bps.mv(psofly.fi4_signal, "")
+
+        yield from tomostage.rot.shortest_move(angs[0])
+        yield from bps.mv(
+            det.cam1.num_images, len(angs)*cfg_tomo['n_frames'],
+            det.cam1.trigger_mode, "Ext. Standard",
+        )
+        yield from bps.trigger(det, group='hwstep')
+        yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
+        # NOTE:
+        #   no checkpoint inside the loop, rewinding would send extra pulses
+        #   to the camera and shift all remaining frames
+        yield from psofly.step_pulses(
+            tomostage.rot, angs, det.cam1.array_counter,
+            n_frames=cfg_tomo['n_frames'],
+            timeout=cfg_tomo['acquire_period'] + 5,
+        )
+        yield from bps.wait(group='hwstep')
+        # safe guard against accidental triggering
+        yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        # record the frames of the single acquisition, images stay in the HDF5 file (resource/datum)
+        yield from bps.create('primary')
+        yield from bps.read(det)
+        yield from bps.save()
+
     @staticmethod
     def fly_scan(experiment):
         det = experiment.detector
@@ -716,10 +929,19 @@ class Tomography:
         yield from bps.mv(det.proc1.num_filter, 1)
         yield from bps.mv(det.cam1.num_images, cfg_tomo['n_projections'])
 
+        # golden-angle interlaced mode: one coarse sweep per loop, shifted by the
+        # pre-computed offsets, all frames go into the same acquisition
+        if cfg_tomo.get('n_interlace', 1) > 1:
+            _loop_starts = [cfg_tomo['omega_start'] + me for me in cfg_tomo['interlace_offsets']]
+        else:
+            _loop_starts = [cfg_tomo['omega_start']]
+        # continuous multi-revolution mode sweeps through all revolutions at once
+        _omega_end = cfg_tomo['continuous']['omega_end'] if 'continuous' in cfg_tomo else cfg_tomo['omega_end']
+
         # we are assuming that the global psofly is available
         yield from bps.mv(
             psofly.start,               cfg_tomo['omega_start'],
-            psofly.end,                 cfg_tomo['omega_end'] + cfg_tomo['omega_step'], # to get the last projection at 360
+            psofly.end,                 _omega_end + cfg_tomo['omega_step'], # to get the last projection at 360
             psofly.slew_speed,          cfg_tomo['slew_speed'],
             psofly.scan_delta,          cfg_tomo['scan_delta'],
             psofly.detector_setup_time, cfg_tomo['detector_setup_time'],
@@ -731,22 +953,126 @@ class Tomography:
         yield from bps.mv(psofly.fi2_signal, "pls") # program in FPGA to take TomoExp for the frame counter
         yield from bps.mv(psofly.fi3_signal, "")  # clear other signal inputs from NF and FF
         yield from bps.mv(psofly.fi4_signal, "")
-        # taxi
-        yield from bps.mv(tomostage.rot, cfg_tomo['omega_start'])
-        yield from bps.mv(psofly.taxi, "Taxi")     # should be equivalent to: caput(6idhedms1:PSOFly1:taxi, "Taxi")
-                                                   # Aerotech cannot be in "stop" when use flyer
         yield from bps.mv(
             det.cam1.num_images, cfg_tomo['n_projections'],
             det.cam1.trigger_mode, "Ext. Standard",
         )
-        # ready to fly
-        yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
-        # start the fly scan
+        # the camera stays armed for all loops
         yield from bps.trigger(det, group='fly')
-        yield from bps.abs_set(psofly.fly, "1", group='fly')  ## changed to "1" on 9/25/2020. Sometimes if this doesn't work, change to "Fly"
+        for _loop_start in _loop_starts:
+            yield from bps.checkpoint()
+            if len(_loop_starts) > 1:
+                yield from bps.mv(
+                    psofly.start, _loop_start,
+                    psofly.end,   _loop_start + cfg_tomo['n_per_loop']*cfg_tomo['scan_delta'],
+                    )
+            # taxi
+            yield from tomostage.rot.shortest_move(_loop_start)
+            yield from bps.mv(psofly.taxi, "Taxi")     # should be equivalent to: caput(6idhedms1:PSOFly1:taxi, "Taxi")
+                                                       # Aerotech cannot be in "stop" when use flyer
+            # ready to fly
+            yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
+            # start the fly scan
+            yield from bps.abs_set(psofly.fly, "1", group='fly_loop')  ## changed to "1" on 9/25/2020. Sometimes if this doesn't work, change to "Fly"
+            yield from bps.wait(group='fly_loop')
+            # safe guard against accidental triggering
+            yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
         yield from bps.wait(group='fly')
-        # safe guard against accidental triggering
+        # record the fly frames, images stay in the HDF5 file (resource/datum)
+        yield from bps.create('primary')
+        yield from bps.read(det)
+        yield from bps.save()
+
+    @staticmethod
+    def helical_scan(experiment):
+        det = experiment.detector
+        tomostage = experiment.stage
+        psofly = experiment.flycontrol
+        cfg_tomo = experiment.config['tomo']
+        cfg_helical = cfg_tomo['helical']
+
+        # Raw images go through the following plugins:
+        #       PG1 ==> TRANS1 ==> PROC1 ==> TIFF1
+        #                 ||          ||
+        #                 ==> IMAGE1  ======> HDF1
+        yield from bps.mv(det.proc1.nd_array_port, 'TRANS1')
+        yield from bps.mv(det.hdf1.nd_array_port, 'PROC1')
+        yield from bps.mv(det.tiff1.nd_array_port, 'PROC1') 
+        yield from bps.mv(det.trans1.enable, 1) 
+        yield from bps.mv(det.proc1.enable, 1)
+        yield from bps.mv(det.proc1.enable_filter, 1)
+        yield from bps.mv(det.proc1.filter_type, 'Average')
+        yield from bps.mv(det.proc1.reset_filter, 1)
+        yield from bps.mv(det.proc1.num_filter, 1)
+        yield from bps.mv(det.cam1.num_images, cfg_tomo['n_projections'])
+
+        # ky velocity is coupled to the rotation speed through the pitch
+        _ky_velocity = abs(cfg_helical['pitch'])*cfg_tomo['slew_speed']/360
+        _ky_velocity_cached = tomostage.ky.velocity.get()
+
+        yield from bps.mv(
+            psofly.start,               cfg_tomo['omega_start'],
+            psofly.end,                 cfg_helical['omega_end'] + cfg_tomo['omega_step'], # to get the last projection
+            psofly.slew_speed,          cfg_tomo['slew_speed'],
+            psofly.scan_delta,          cfg_tomo['scan_delta'],
+            psofly.detector_setup_time, cfg_tomo['detector_setup_time'],
+            )
+        # preparation for PSO signal 
+        yield from bps.mv(psofly.pulse_type, "Gate")
+        yield from bps.mv(psofly.reset_fpga, "1")  # caput(6idMZ1:SG:BUFFER-1_IN_Signal.PROC, 1), reest FPGA circutry 
         yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        yield from bps.mv(psofly.fi2_signal, "pls") # program in FPGA to take TomoExp for the frame counter
+        yield from bps.mv(psofly.fi3_signal, "")  # clear other signal inputs from NF and FF
+        yield from bps.mv(psofly.fi4_signal, "")
+        # taxi, ky starts at the bottom (or top) of the volume
+        yield from bps.mv(tomostage.ky, experiment.config['tomo']['volume']['ky_start'])
+        yield from tomostage.rot.shortest_move(cfg_tomo['omega_start'])
+        yield from bps.mv(psofly.taxi, "Taxi")     # Aerotech cannot be in "stop" when use flyer
+        yield from bps.mv(
+            det.cam1.num_images, cfg_tomo['n_projections'],
+            det.cam1.trigger_mode, "Ext. Standard",
+        )
+
+        # measured ky at each frame (camera array counter), ky.position is monitored
+        _ky_readback = []
+        _cid = []
+        def _on_frame(value=None, **kwargs):
+            _ky_readback.append(tomostage.ky.position)
+
+        def _helical_fly():
+            yield from bps.mv(tomostage.ky.velocity, _ky_velocity)
+            # ready to fly
+            yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
+            _cid.append(det.cam1.array_counter.subscribe(_on_frame, run=False))
+            yield from bps.trigger(det, group='fly')
+            yield from bps.abs_set(psofly.fly, "1", group='fly')
+            # ky is released once the rotation is past its acceleration ramp (taxi
+            # position -> omega_start), so that both move at constant speed together
+            _sign = np.sign(cfg_helical['omega_end'] - cfg_tomo['omega_start'])
+            for _ in range(6000):  # 60 s
+                if (tomostage.rot.position - cfg_tomo['omega_start'])*_sign >= 0:
+                    break
+                yield from bps.sleep(0.01)
+            else:
+                raise RuntimeError(f"Rotation did not reach {cfg_tomo['omega_start']} deg, helical scan aborted")
+            yield from bps.abs_set(tomostage.ky, cfg_helical['ky_end'], group='fly')
+            yield from bps.wait(group='fly')
+            # safe guard against accidental triggering
+            yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+
+        def _restore():
+            for me in _cid:
+                det.cam1.array_counter.unsubscribe(me)
+            yield from bps.mv(tomostage.ky.velocity, _ky_velocity_cached)
+
+        yield from bpp.finalize_wrapper(_helical_fly(), _restore())
+        # record the fly frames, images stay in the HDF5 file (resource/datum),
+        # with the measured ky of each frame (md ky_positions are the planned ones)
+        _ky_signal = ophyd.Signal(name='ky_readback', value=np.asarray(_ky_readback))
+        yield from bps.create('primary')
+        yield from bps.read(det)
+        yield from bps.read(_ky_signal)
+        yield from bps.save()
 
     @staticmethod
     def safe_guard(experiment):
@@ -769,6 +1095,9 @@ class Tomography:
 class FarField:
     """Far-Field HEDM scan setup for HT-HEDM instrument"""
     setup_name = 'ff'
+    # config/Varex_attributes_slim.xml is not deployed on the Varex (Windows)
+    # IOC host yet, set to True once C:\HDF\Varex_attributes_slim.xml exists
+    slim_attributes = False
 
     @staticmethod
     def get_beam(mode):
@@ -790,9 +1119,8 @@ class FarField:
     @staticmethod
     def get_flycontrol(mode):
         # the mode check should be done at the experiment level
-        from ophyd import sim
         return {
-            'debug':       sim.flyer1,
+            'debug':       SimEnsemblePSOFlyDevice(name="psofly"),
             'dryrun':      EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             'production':  EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             }[mode]
@@ -833,11 +1161,20 @@ class FarField:
         #TODO:
         #need to reconfigure these files
 #         _attrib_fp = os.path.join(_current_fp, 'config/Varex_attributes.xml')
-#         _layout_fp = os.path.join(_current_fp, 'config/Varex_layout.xml')
-        _attrib_fp = 'C:\HDF\Varex_attributes.xml'
-        _layout_fp = 'C:\HDF\Varex_layout.xml'
-        det.cam1.nd_attributes_file.put(_attrib_fp)
-        det.hdf1.xml_file_name.put(_layout_fp)
+        # NOTE: with the slim file, the static attributes are read once per scan
+        #       (see seisidd.ndattributes), otherwise the IOC stores them per frame
+        if FarField.slim_attributes:
+            _attrib_fp = 'C:\HDF\Varex_attributes_slim.xml'
+            det.nd_static_attributes, _ = classify_attributes(
+                read_attributes_xml(os.path.join(_current_fp, 'config/Varex_attributes.xml'))
+            )
+        else:
+            _attrib_fp = 'C:\HDF\Varex_attributes.xml'
+            det.nd_static_attributes = []
+        if det.cam1.nd_attributes_file.get() != _attrib_fp:
+            det.cam1.nd_attributes_file.put(_attrib_fp)
+        # NOTE: the layout (XML content) is pushed to hdf1 once the camera is primed,
+        #       no layout file is needed on the Varex (Windows) IOC host
 
         # -- prime camera
         # NOTE:
@@ -881,6 +1218,8 @@ class FarField:
         det.cam1.acquire.put(0)
         det.hdf1.enable.put(0)
         det.hdf1.auto_increment.put(1)
+        # ---- dxchange layout and chunking for the FF access pattern (omega slab)
+        configure_hdf_layout(det, 'ff')
         # ---- turn on auto save (supercede by disable, so we are safe)
         det.tiff1.auto_save.put(1)
         det.hdf1.auto_save.put(1)
@@ -892,6 +1231,24 @@ class FarField:
 
         return det 
 
+    @staticmethod
+    def calibrate(experiment, h5file, energy=None, **kwargs):
+        """
+        Fit the FF detector geometry to a calibrant (CeO2) scan file and keep it
+        in cfg['ff']['geometry'], so that it is recorded with every following FF run.
+
+        Example:
+        >> FarField.calibrate(experiment, '/data/ff/CeO2_000001.h5', energy=71.676)
+        """
+        cfg_ff = experiment.config['ff']
+        _geometry = cfg_ff.get('geometry')
+        if energy is None:
+            if not _geometry or 'energy' not in _geometry:
+                raise ValueError("Beam energy (keV) is required for the calibration")
+            energy = _geometry['energy']
+        _result = calibrate_file(h5file, energy, geometry=_geometry, **kwargs)
+        return update_config(experiment.config, _result)
+
     @staticmethod
     def collect_dark(experiment):
         # NOTE
@@ -957,10 +1314,32 @@ class FarField:
 #             cfg['ff']['omega_step'],
 #         )
         n_projections = abs(round((cfg['ff']['omega_end']-cfg['ff']['omega_start'])/cfg['ff']['omega_step']))
+        # continuous multi-revolution fly for repeated same-layer (ky_step == 0) scans
+        # -- the rotation keeps spinning through n_layers*360, no stop between layers
+        # -- the first frame is the junk frame from the taxi position
+        cfg['ff'].pop('continuous', None)
+        if cfg['ff']['type'].lower() == 'fly' \
+            and cfg['ff']['volume']['ky_step'] == 0 \
+            and cfg['ff']['volume'].get('continuous', False):
+            if abs(abs(cfg['ff']['omega_end'] - cfg['ff']['omega_start']) - 360) > 1e-6:
+                raise ValueError("Continuous multi-revolution scan requires a 360 deg omega range")
+            _n_revolutions = cfg['ff']['volume']['n_layers']
+            cfg['ff']['continuous'] = {
+                'n_revolutions':         _n_revolutions,
+                'frames_per_revolution': n_projections,
+                'omega_end':             cfg['ff']['omega_start'] + 360*_n_revolutions,
+                'first_frame':           1,
+                'overlap':               0,
+            }
+            n_projections = n_projections*_n_revolutions
         cfg['ff']['n_projections'] = n_projections
         cfg['ff']['total_images']  = n_projections + n_dark
         fp = cfg['output']['filepath']
         fn = cfg['output']['fileprefix']
+        # layer: one file per ky layer (default), volume: hdf1 armed once for all layers
+        _volume_capture = cfg['output'].get('capture', 'layer').lower() == 'volume'
+        if _volume_capture and cfg['output']['type'] not in ['hdf', 'hdf1', 'hdf5']:
+            raise ValueError("Volume capture requires HDF5 output")
 
         # TODO
         # consider adding an extra step to:
@@ -1033,13 +1412,9 @@ class FarField:
         for me in [det.tiff1, det.hdf1]:
             me.file_path.put(fp)
 
-        # Reset Aero rotation to ~0 if didn;t clean up after previous scan
-        ## remove this for 360 to 0 rotation
-#         if ffstage.rot.position > 180:    
-#             ffstage.rot.set_use_switch.put(1)
-#             ffstage.rot.dial_setpoint.put(ffstage.rot.dial_readback.get()-360)
-#             ffstage.rot.user_offset.put(0)
-#             ffstage.rot.set_use_switch.put(0) 
+        # Unwind Aero rotation (whole turns, no motion) if didn't clean up after previous scan
+        # NOTE: works for both 0 to 360 and 360 to 0 rotation
+        yield from ffstage.rot.unwind_near(cfg['ff']['omega_start'])
         
         ################################
         ## step 3: Check light status ##
@@ -1057,23 +1432,14 @@ class FarField:
         ## step 4: Actual Scan ##
         #########################
 
-        def scan_singlelayer():
-            # TODO:
-            # Somewhere we need to check the light status
-            # Get near the starting position before open the shutter
-            yield from bps.mv(ffstage.rot, cfg['ff']['omega_start'])
-            # open shutter for beam
-            if mode.lower() in ['production']:
-                yield from bps.mv(shutter, 'open')
-                # no suspender for main shutter
-#                 yield from bps.install_suspender(shutter_suspender)
-            # config output
+        def config_output(num_capture):
+            """arm tiff1/hdf1 for the next num_capture images"""
             if mode.lower() in ['dryrun','production']:
                 for me in [det.tiff1, det.hdf1]:
                     yield from bps.mv(me.file_name, fn)
                     # yield from bps.mv(me.file_path, fp)
                     yield from bps.mv(me.file_write_mode, 2)  # 1: capture, 2: stream
-                    yield from bps.mv(me.num_capture, cfg['ff']['total_images'] + 1)
+                    yield from bps.mv(me.num_capture, num_capture)
                     yield from bps.mv(me.file_template, ".".join([r"%s%s_%06d",cfg['output']['type'].lower()]))    
             elif mode.lower() in ['debug']:
                 for me in [det.tiff1, det.hdf1]:
@@ -1082,7 +1448,7 @@ class FarField:
                     yield from bps.mv(me.file_name, fn)
                     yield from bps.mv(me.file_write_mode, 2) # 1: capture, 2: stream
                     yield from bps.mv(me.auto_increment, 1)
-                    yield from bps.mv(me.num_capture, cfg['ff']['total_images'] + 1)
+                    yield from bps.mv(me.num_capture, num_capture)
                     yield from bps.mv(me.file_template, ".".join([r"%s%s_%06d",cfg['output']['type'].lower()]))
             
             if cfg['output']['type'] in ['tif', 'tiff']:
@@ -1096,6 +1462,24 @@ class FarField:
             else:
                 raise ValueError(f"Unsupported output type {cfg['output']['type']}")
 
+        def scan_singlelayer(layer=0):
+            # TODO:
+            # Somewhere we need to check the light status
+            # Get near the starting position before open the shutter
+            yield from ffstage.rot.shortest_move(cfg['ff']['omega_start'])
+            # open shutter for beam
+            if mode.lower() in ['production']:
+                yield from bps.mv(shutter, 'open')
+                # no suspender for main shutter
+#                 yield from bps.install_suspender(shutter_suspender)
+            # lowest attenuation below the saturation limit, before the first layer
+            if _guard is not None and layer == 0 and _cfg_guard.get('test_exposure', True):
+                yield from _guard.test_exposure(det, acquire_time)
+                cfg['ff']['attenuation_actual'] = beam.att._motor.position
+            # config output
+            if not _volume_capture:
+                yield from config_output(cfg['ff']['total_images'] + 1)
+
             # setting acquire_time and acquire_period
             yield from bps.mv(det.cam1.acquire_time, acquire_time + 0.065) # need to add the Varex readout for the correct estimate
             
@@ -1103,6 +1487,8 @@ class FarField:
             yield from bps.mv(det.cam1.frame_type, 1)  # for HDF5 dxchange data structure
             if cfg['ff']['type'].lower() == 'step':
                 yield from FarField.step_scan(experiment)
+            elif cfg['ff']['type'].lower() == 'hwstep':
+                yield from FarField.hardware_step_scan(experiment)
             elif cfg['ff']['type'].lower() == 'fly':
                 yield from FarField.fly_scan(experiment)
             else:
@@ -1116,6 +1502,25 @@ class FarField:
 #                 yield from bps.remove_suspender(shutter_suspender)
                 yield from bps.mv(shutter, "close")
             yield from FarField.collect_dark(experiment)
+
+            # omega rebinning and max/sum images of the layer, in the background
+            if _reducer is not None:
+                # the IOC closes the layer file once all the frames are captured
+                for _ in range(300):
+                    if det.hdf1.capture.get() == 0:
+                        _reducer.submit(det.hdf1.full_file_name.get())
+                        break
+                    yield from bps.sleep(0.1)
+                else:
+                    # never read a file the IOC may still be writing
+                    print(f"{det.hdf1.full_file_name.get()} still open after 30 s, no reduced file for this layer")
+
+            # attenuation for the next layer from the saturation seen by the spot finder
+            if _guard is not None and experiment.spotfinder is not None \
+                and _cfg_guard.get('between_layers', True) \
+                and layer < len(_scan_positions) - 1:
+                yield from _guard.adjust(experiment.spotfinder.summary(), layer)
+                cfg['ff']['attenuation_actual'] = beam.att._motor.position
             
         ###########################
         ## Far Field Volume Scan ##
@@ -1124,23 +1529,150 @@ class FarField:
         n_layers   = cfg['ff']['volume']['n_layers']
         ky_start   = cfg['ff']['volume']['ky_start']
         ky_step    = cfg['ff']['volume']['ky_step']
-        if ky_step == 0:
+        if 'continuous' in cfg['ff']:
+            # all repeats are done in a single multi-revolution pass
+            _scan_positions = (ky_start, )
+        elif ky_step == 0:
             # To repeat the current layer for n_layer times
             # !!! The layer/file number will still increase for this same layer
             _scan_positions = tuple(np.arange(n_layers))
             # For regular scans
         else:
             _scan_positions = tuple(np.arange(ky_start, ky_start+(n_layers-0.5)*ky_step, ky_step))
+
+        _md = config_to_md(cfg, 'ff')
+        if mode != 'debug':
+            # once-per-scan detector metadata, no longer stored with every frame
+            _md['detector_static'] = read_static_values(getattr(det, 'nd_static_attributes', []))
+            if cfg['output']['type'].lower() in ['hdf', 'hdf1', 'hdf5']:
+                # HDF5 file numbers [first, last) written by this run, one file per layer
+                _first = int(det.hdf1.file_number.get())
+                _md['file_numbers'] = [_first, _first + (1 if _volume_capture else len(_scan_positions))]
+        if 'continuous' in cfg['ff']:
+            _md['revolutions'] = cfg['ff']['continuous']
+        if _volume_capture:
+            # layer i of each dataset is frames [i*n, (i+1)*n) of the single file,
+            # the junk frame at the beginning of each layer is kept
+            _md['volume_capture'] = {
+                'n_layers':         len(_scan_positions),
+                'frames_per_layer': {
+                    'data':      cfg['ff']['n_projections'] + 1,
+                    'data_dark': n_dark,
+                },
+            }
         
+        # live spot finding on the fly scan frames (image1), see seisidd.spotfinder
+        _cfg_spots = dict(cfg['ff'].get('spotfinder', {}))
+        experiment.spotfinder = None
+        if _cfg_spots.pop('enabled', False) and mode.lower() in ['dryrun', 'production']:
+            experiment.spotfinder = LiveSpotFinder(det, **_cfg_spots)
+
+        # per-layer reduction (omega rebinning, max/sum images), see seisidd.ffreduce
+        _cfg_rebin = cfg['ff'].get('rebin', {})
+        _reducer = None
+        if _cfg_rebin.get('enabled', False) \
+            and mode.lower() in ['dryrun', 'production'] \
+            and cfg['output']['type'] in ['hdf', 'hdf1', 'hdf5'] \
+            and not _volume_capture:
+            _reducer = LayerReducer(factor=_cfg_rebin.get('factor', 5), md=_md)
+
+        # attenuation chosen from the saturated pixel fraction, see seisidd.saturation
+        # (beam needed, production only), decisions in the 'attenuation' stream
+        _cfg_guard = cfg['ff'].get('saturation_guard', {})
+        _guard = None
+        if _cfg_guard.get('enabled', False) and mode.lower() in ['production']:
+            _guard = SaturationGuard(
+                beam.att,
+                saturation   = _cfg_guard.get('saturation', 60000),
+                max_fraction = _cfg_guard.get('max_fraction', 1e-4),
+                transmission = _cfg_guard.get('transmission', None),
+            )
+            _md['saturation_guard'] = {
+                'saturation':   _guard.saturation,
+                'max_fraction': _guard.max_fraction,
+                'levels':       _guard.levels,
+            }
+
+        def cleanup():
+            if experiment.spotfinder is not None:
+                experiment.spotfinder.close()
+            if _reducer is not None:
+                _reducer.wait()
+            yield from bps.null()
+
         @bpp.stage_decorator([det])
-        @bpp.run_decorator()
+        @bpp.run_decorator(md=_md)
         def scan_closure():
-            for _current_scan_ky in _scan_positions:
+            if _volume_capture:
+                yield from config_output((cfg['ff']['total_images'] + 1)*len(_scan_positions))
+            for _layer, _current_scan_ky in enumerate(_scan_positions):
                 _start = ky_start if ky_step == 0 else _current_scan_ky
                 yield from bps.mv(ffstage.ky, _start)
-                yield from scan_singlelayer()
+                yield from scan_singlelayer(_layer)
         
-        return (yield from scan_closure())
+        return (yield from bpp.finalize_wrapper(scan_closure(), cleanup()))
+
+    @staticmethod
+    def hardware_step_scan(experiment):
+        """
+        Step scan with the Varex armed once in external trigger mode.
+
+        The stage still stops at every angle, but instead of a trigger_and_read per
+        angle, the softGlue FPGA sends n_frames pulses to the detector once the move
+        is done, each after the detector counted the previous frame, and all images
+        go into a single acquisition.
+        """
+        det = experiment.detector
+        psofly = experiment.flycontrol
+        cfg_ff = experiment.config['ff']
+        ffstage = experiment.stage
+
+        # Raw images go through the following plugins:
+        #    4343CT1 ==> TRANS1 ==> PROC1 ==> TIFF1
+        #                 ||          ||
+        #                 ==> IMAGE1  ======> HDF1
+        yield from bps.mv(det.proc1.nd_array_port, 'TRANS1')
+        yield from bps.mv(det.hdf1.nd_array_port, 'PROC1')
+        yield from bps.mv(det.tiff1.nd_array_port, 'PROC1') 
+        yield from bps.mv(det.trans1.enable, 1) 
+        yield from bps.mv(det.proc1.enable, 1)
+        yield from bps.mv(det.proc1.enable_filter, 1)
+        yield from bps.mv(det.proc1.filter_type, 'Average')
+        yield from bps.mv(det.proc1.reset_filter, 1)
+        yield from bps.mv(det.proc1.num_filter, cfg_ff['n_frames'])
+
+        # same frame layout as the fly scan, including the leading frame at the taxi position
+        angs = cfg_ff['omega_start'] + np.arange(-1, cfg_ff['n_projections'])*cfg_ff['omega_step']
+        # route the software pulse to the detector
+        yield from bps.mv(psofly.soft_pulse_out, "swpls")  # caput(6idMZ1:SG:BUFFER-2_OUT_Signal, swpls), name the software pulse output
+        yield from bps.mv(psofly.reset_fpga, "1")  # caput(6idMZ1:SG:BUFFER-1_IN_Signal.PROC, 1), reest FPGA circutry 
+        yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        yield from bps.mv(psofly.fi2_signal, "")  # clear other signal inputs from Tomo and NF
+        yield from bps.mv(psofly.fi3_signal, "")
+        yield from bps.mv(psofly.fi4_signal, "swpls") # program in FPGA to take the software pulse
+
+        yield from ffstage.rot.shortest_move(angs[0])
+        yield from bps.mv(
+            det.cam1.num_images, len(angs)*cfg_ff['n_frames'],
+            det.cam1.trigger_mode, "External",
+        )
+        yield from bps.trigger(det, group='hwstep')
+        yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
+        # NOTE:
+        #   no checkpoint inside the loop, rewinding would send extra pulses
+        #   to the detector and shift all remaining frames
+        yield from psofly.step_pulses(
+            ffstage.rot, angs, det.cam1.array_counter,
+            n_frames=cfg_ff['n_frames'],
+            timeout=cfg_ff['acquire_time'] + 5,
+        )
+        yield from bps.wait(group='hwstep')
+        # safe guard against accidental triggering
+        yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        # record the frames of the single acquisition, images stay in the HDF5 file (resource/datum)
+        yield from bps.create('primary')
+        yield from bps.read(det)
+        yield from bps.save()
 
     @staticmethod
     def fly_scan(experiment):
@@ -1163,10 +1695,13 @@ class FarField:
         yield from bps.mv(det.proc1.reset_filter, 1)
         yield from bps.mv(det.proc1.num_filter, cfg_ff['n_frames'])
 
+        # continuous multi-revolution mode sweeps through all revolutions at once
+        _omega_end = cfg_ff['continuous']['omega_end'] if 'continuous' in cfg_ff else cfg_ff['omega_end']
+
         # we are assuming that the global psofly is available
         yield from bps.mv(
             psofly.start,               cfg_ff['omega_start'],         #  add omega_delta in the beginning to throw out the junk frame before actual scan
-            psofly.end,                 (cfg_ff['omega_end'] + cfg_ff['omega_step']),  
+            psofly.end,                 (_omega_end + cfg_ff['omega_step']),  
             psofly.slew_speed,          cfg_ff['slew_speed'],
             psofly.scan_delta,          cfg_ff['scan_delta'],
             psofly.detector_setup_time, cfg_ff['detector_setup_time'],
@@ -1179,7 +1714,7 @@ class FarField:
         yield from bps.mv(psofly.fi3_signal, "")  # clear other signal inputs from NF and FF
         yield from bps.mv(psofly.fi4_signal, "pls")
         # taxi
-        yield from bps.mv(ffstage.rot, (cfg_ff['omega_start'] - cfg_ff['scan_delta']))
+        yield from ffstage.rot.shortest_move(cfg_ff['omega_start'] - cfg_ff['scan_delta'])
         yield from bps.mv(psofly.taxi, "Taxi")     # should be equivalent to: caput(6idhedms1:PSOFly1:taxi, "Taxi")
                                                    # Aerotech cannot be in "stop" when use flyer
         yield from bps.mv(
@@ -1189,11 +1724,22 @@ class FarField:
         # ready to fly
         yield from bps.mv(psofly.pso_state,  "1")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        1) , re-enable PSO singal
         # start the fly scan
+        _spotfinder = getattr(experiment, 'spotfinder', None)
+        if _spotfinder is not None:
+            _spotfinder.start()
         yield from bps.trigger(det, group='fly')
         yield from bps.abs_set(psofly.fly, "1", group='fly')  ## 9/25/2020 changed this from "Fly" to "1", sometimes will need to use "Fly"
         yield from bps.wait(group='fly')
         # safe guard against accidental triggering
         yield from bps.mv(psofly.pso_state,  "0")  # caput(6idMZ1:SG:AND-1_IN1_Signal,        0), disable PSO singal prevent accidental trigger
+        # record the fly frames, images stay in the HDF5 file (resource/datum)
+        yield from bps.create('primary')
+        yield from bps.read(det)
+        yield from bps.save()
+        # per-frame spot counts/saturation of this layer
+        if _spotfinder is not None:
+            _spotfinder.stop()
+            yield from _spotfinder.publish('spots')
 
     @staticmethod
     def safe_guard(experiment):
@@ -1237,9 +1783,8 @@ class NearField:
     @staticmethod
     def get_flycontrol(mode):
         # the mode check should be done at the experiment level
-        from ophyd import sim
         return {
-            'debug':       sim.flyer1,
+            'debug':       SimEnsemblePSOFlyDevice(name="psofly"),
             'dryrun':      EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             'production':  EnsemblePSOFlyDevice("6idhedms1:PSOFly1:", name="psofly"),
             }[mode]
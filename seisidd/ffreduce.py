@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+This module provides a streaming reduction of the far-field (FF-HEDM) frames
+for quick assessment of a layer:
+    * omega rebinning, every factor consecutive frames are summed
+    * all-omega max and sum images, showing the rings and the spot density
+
+Frames are fed in blocks as they become available, only one partial bin and
+the max/sum images are kept in memory, completed bins go straight to the side
+file (*_reduced.h5, with the extension of the layer file):
+
+    /exchange/data_rebin   (n_bins, rows, cols)  summed frames
+    /exchange/omega_rebin  (n_bins, )            mean omega of each bin, deg
+    /exchange/max          (rows, cols)
+    /exchange/sum          (rows, cols)
+
+NOTE:
+* The first frame of each FF layer is the junk frame from the taxi position and
+  is skipped (first_frame=1).
+* A last incomplete bin (n_frames not a multiple of factor) is kept, its number
+  of frames is in /exchange/n_frames_rebin.
+"""
+
+import os
+import time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OmegaReducer:
+    """
+    Streaming omega rebinning with running max/sum images
+
+    Usage:
+    >> with OmegaReducer('/data/ff/Ti64_ff_000003_reduced.h5', factor=5) as red:
+    >>     for start in range(0, n, 32):
+    >>         red.add(frames[start:start+32], omega[start:start+32])
+    >> red.max, red.sum
+    """
+
+    def __init__(self, dst_file: str, factor: int=5, source: str=None):
+        if factor < 1:
+            raise ValueError(f"Rebinning factor must be >= 1, got {factor}")
+        self.dst_file = dst_file
+        self.factor = factor
+        self.source = source
+        self.max = None
+        self.sum = None
+        self.n_frames = 0
+        self._h5f = None
+        self._acc = None
+        self._acc_n = 0
+        self._acc_omega = 0.0
+        self._n_bins = 0
+
+    def _open(self, frame_shape, dtype):
+        import h5py
+        self._h5f = h5py.File(self.dst_file, 'w')
+        _sum_dtype = np.uint32 if np.dtype(dtype).kind in 'iu' and np.dtype(dtype).itemsize <= 2 else np.float64
+        self._rebin = self._h5f.create_dataset(
+            '/exchange/data_rebin', shape=(0, ) + frame_shape, maxshape=(None, ) + frame_shape,
+            dtype=_sum_dtype, chunks=(1, ) + frame_shape,
+        )
+        self._rebin.attrs['factor'] = self.factor
+        if self.source is not None:
+            self._rebin.attrs['source'] = self.source
+        self._omega, self._counts = [], []
+        self._acc = np.zeros(frame_shape, dtype=np.float64)
+        self.max = np.zeros(frame_shape, dtype=dtype)
+        self.sum = np.zeros(frame_shape, dtype=np.float64)
+
+    @property
+    def n_bins(self):
+        return self._n_bins
+
+    def _flush_bin(self):
+        self._rebin.resize((self._n_bins + 1, ) + self._rebin.shape[1:])
+        self._rebin[self._n_bins] = self._acc
+        self._omega.append(self._acc_omega/self._acc_n)
+        self._counts.append(self._acc_n)
+        self._n_bins += 1
+        self._acc[...] = 0
+        self._acc_n = 0
+        self._acc_omega = 0.0
+
+    def add(self, frames, omega=None):
+        """add a block of consecutive frames (n, rows, cols), omega (n, ) in deg"""
+        _frames = np.asarray(frames)
+        if _frames.ndim == 2:
+            _frames = _frames[np.newaxis]
+        if self._h5f is None:
+            self._open(_frames.shape[1:], _frames.dtype)
+        _omega = np.full(len(_frames), np.nan) if omega is None else np.asarray(omega, dtype=float)
+        np.maximum(self.max, _frames.max(axis=0), out=self.max)
+        self.sum += _frames.sum(axis=0, dtype=np.float64)
+        self.n_frames += len(_frames)
+        _i = 0
+        while _i < len(_frames):
+            # fill the current bin with as many frames of the block as it takes
+            _n = min(self.factor - self._acc_n, len(_frames) - _i)
+            self._acc += _frames[_i:_i+_n].sum(axis=0, dtype=np.float64)
+            self._acc_omega += _omega[_i:_i+_n].sum()
+            self._acc_n += _n
+            _i += _n
+            if self._acc_n == self.factor:
+                self._flush_bin()
+
+    def close(self):
+        """write the last (incomplete) bin and the max/sum images, close the file"""
+        if self._h5f is None:
+            return
+        if self._acc_n:
+            self._flush_bin()
+        self._h5f['/exchange/omega_rebin'] = np.asarray(self._omega)
+        self._h5f['/exchange/n_frames_rebin'] = np.asarray(self._counts)
+        self._h5f['/exchange/max'] = self.max
+        self._h5f['/exchange/sum'] = self.sum
+        self._h5f.attrs['n_frames'] = self.n_frames
+        self._h5f.close()
+        self._h5f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def reduce_file(
+        src_file: str,
+        dst_file: str=None,
+        factor: int=5,
+        omega=None,
+        dataset: str='/exchange/data',
+        first_frame: int=1,
+        block: int=32,
+        verbose: bool=True,
+    ):
+    """
+    Omega rebinning and max/sum images of an FF layer file, streamed block by block.
+
+    omega (deg) is given for all the frames of the dataset (see
+    ffsparse.frame_omega), frames before first_frame are skipped.
+
+    Example:
+    >> reduce_file('/data/ff/Ti64_ff_000003.h5', factor=5, omega=frame_omega(md, 1801))
+    >> '/data/ff/Ti64_ff_000003_reduced.h5'
+    """
+    import h5py
+
+    if dst_file is None:
+        dst_file = "_reduced".join(os.path.splitext(src_file))
+    _t0 = time.perf_counter()
+    with h5py.File(src_file, 'r') as _src, \
+         OmegaReducer(dst_file, factor=factor, source=f"{os.path.abspath(src_file)}:{dataset}") as _red:
+        _data = _src[dataset]
+        for _start in range(first_frame, len(_data), block):
+            _stop = min(_start + block, len(_data))
+            _red.add(_data[_start:_stop], None if omega is None else omega[_start:_stop])
+    if verbose:
+        print(f"{os.path.basename(src_file)} -> {os.path.basename(dst_file)}: "
+              f"{_red.n_frames} frames in {_red.n_bins} bins, {time.perf_counter()-_t0:.1f} s")
+    return dst_file
+
+
+class LayerReducer:
+    """
+    Reduce each FF layer file in the background once the IOC has closed it, so
+    that the next layer starts right away (see FarField.scan)
+
+    Usage:
+    >> reducer = LayerReducer(factor=5, md=_md)
+    >> reducer.submit(det.hdf1.full_file_name.get())   # end of each layer
+    >> reducer.wait()                                  # end of the scan
+    """
+
+    def __init__(self, factor: int=5, md: dict=None, n_workers: int=1):
+        self.factor = factor
+        self.md = md or {}
+        self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._futures = []
+
+    def _reduce(self, src_file):
+        import h5py
+        from .ffsparse import frame_omega
+        with h5py.File(src_file, 'r') as h5f:
+            _n_frames = h5f['/exchange/data'].shape[0]
+        return reduce_file(src_file, factor=self.factor, omega=frame_omega(self.md, _n_frames))
+
+    def submit(self, src_file: str):
+        if not os.path.exists(src_file):
+            print(f"Cannot see {src_file} from this machine, no reduced file written")
+            return None
+        _future = self._pool.submit(self._reduce, src_file)
+        self._futures.append(_future)
+        return _future
+
+    def wait(self):
+        """wait for the pending layers, return the reduced files"""
+        _files = []
+        for me in self._futures:
+            try:
+                _files.append(me.result())
+            except Exception as ex:
+                print(f"Layer reduction failed: {ex}")
+        self._futures = []
+        self._pool.shutdown(wait=True)
+        return _files
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""
+This module provides a sparse storage format for the far-field (FF-HEDM)
+frames, which are mostly background with a few diffraction spots.
+
+Each frame is thresholded against a background model (dark frames, or the
+per-pixel median of a subset of the frames) and only the pixels above the
+threshold are kept, with their raw detector counts.  The pixels of all frames
+are stored one after the other (CSR like, frame_ptr[i]:frame_ptr[i+1] are the
+pixels of frame i):
+
+    /exchange/sparse/frame_ptr   (n_frames+1, )  int64
+    /exchange/sparse/row         (nnz, )         uint16
+    /exchange/sparse/col         (nnz, )         uint16
+    /exchange/sparse/value       (nnz, )         detector dtype
+    /exchange/sparse/omega       (n_frames, )    float64, deg
+    /exchange/sparse/background  (rows, cols)    float32
+    /exchange/sparse/threshold   (rows, cols)    float32
+
+NOTE:
+* The sparse file is written next to the dense layer file (*_sparse.h5, with
+  the extension of the layer file), the dense file is never removed here.
+  Check a few frames with SparseFrames before deleting or skipping the
+  transfer of the dense files.
+* Pixels below the threshold are lost, use a lower n_sigma when weak spots
+  (high 2theta, texture studies) matter.
+"""
+
+import os
+import time
+import numpy as np
+
+from .scanindex import is_side_file
+
+
+SPARSE_GROUP = '/exchange/sparse'
+
+
+def background_model(
+        frames,
+        n_sigma: float=5.0,
+        min_counts: float=10,
+        method: str='dark',
+    ):
+    """
+    Per-pixel background and threshold from a stack of frames (frame, row, col).
+
+    method
+        dark   : frames are dark frames, background is their mean
+        median : frames are (a subset of) the scan frames, background is their
+                 median, which includes the diffuse scattering of the sample
+    The noise is the spread of the frames, but never less than the counting
+    noise sqrt(background) since only a few dark frames are available.
+
+    Example:
+    >> bkg, thr = background_model(h5f['/exchange/data_dark'][()])
+    """
+    _frames = np.asarray(frames, dtype=np.float32)
+    if method == 'dark':
+        _bkg = _frames.mean(axis=0)
+    elif method == 'median':
+        _bkg = np.median(_frames, axis=0)
+    else:
+        raise ValueError(f"Unknown background method {method}, use dark|median")
+    _sigma = np.maximum(_frames.std(axis=0), np.sqrt(np.clip(_bkg, 1, None)))
+    _thr = _bkg + np.maximum(n_sigma*_sigma, min_counts)
+    return _bkg.astype(np.float32), _thr.astype(np.float32)
+
+
+def sparsify_frames(frames, threshold):
+    """
+    Pixels above threshold of a block of frames (frame, row, col).
+
+    Returns (counts, rows, cols, values) with counts the number of pixels per frame,
+    pixels are sorted by frame, row then col.
+    """
+    _frames = np.asarray(frames)
+    _f, _r, _c = np.nonzero(_frames > threshold)
+    _counts = np.bincount(_f, minlength=_frames.shape[0])
+    return _counts, _r.astype(np.uint16), _c.astype(np.uint16), _frames[_f, _r, _c]
+
+
+def frame_omega(md: dict, n_frames: int):
+    """
+    Omega (deg) of each frame of an FF layer file from the run start document.
+
+    The first frame of each layer is the junk frame from the taxi position
+    (omega_start - omega_step), see FarField.fly_scan.  Returns None when the
+    scan config is not in md.
+    """
+    _cfg = md.get('scan_config', {}).get('ff', {})
+    if 'omega_start' not in _cfg or 'omega_step' not in _cfg:
+        return None
+    _volume = md.get('volume_capture')
+    _per_layer = _volume['frames_per_layer']['data'] if _volume else n_frames
+    return _cfg['omega_start'] + (np.arange(n_frames) % _per_layer - 1)*_cfg['omega_step']
+
+
+def sparsify_file(
+        src_file: str,
+        dst_file: str=None,
+        dataset: str='/exchange/data',
+        dark_dataset: str='/exchange/data_dark',
+        omega=None,
+        n_sigma: float=5.0,
+        min_counts: float=10,
+        method: str='dark',
+        n_sample: int=32,
+        block: int=32,
+        verbose: bool=True,
+    ):
+    """
+    Write the sparse version of the FF frames of a dxchange file.
+
+    The frames are streamed in blocks of block frames, so the memory use does
+    not depend on the number of frames.  method='dark' requires dark_dataset
+    in the file, method='median' uses n_sample frames spread over the scan.
+
+    Example:
+    >> sparsify_file('/data/ff/Ti64_ff_000003.h5', omega=frame_omega(md, 1801))
+    >> {'file': '/data/ff/Ti64_ff_000003_sparse.h5', 'nnz': 5120344, 'density': 0.0014, 'ratio': 24.7, ...}
+    """
+    import h5py
+
+    if dst_file is None:
+        dst_file = "_sparse".join(os.path.splitext(src_file))
+
+    _t0 = time.perf_counter()
+    with h5py.File(src_file, 'r') as _src, h5py.File(dst_file, 'w') as _dst:
+        _data = _src[dataset]
+        _n_frames, _n_rows, _n_cols = _data.shape
+        if max(_n_rows, _n_cols) > np.iinfo(np.uint16).max + 1:
+            raise ValueError(f"Frames of {_n_rows}x{_n_cols} do not fit uint16 coordinates")
+        if method == 'dark':
+            if dark_dataset not in _src:
+                raise ValueError(f"No {dark_dataset} in {src_file}, use method='median'")
+            _bkg_frames = _src[dark_dataset][()]
+        else:
+            _bkg_frames = _data[np.unique(np.linspace(0, _n_frames-1, n_sample).astype(int))]
+        _bkg, _thr = background_model(_bkg_frames, n_sigma=n_sigma, min_counts=min_counts, method=method)
+
+        _grp = _dst.create_group(SPARSE_GROUP)
+        _grp.attrs['frame_shape'] = (_n_rows, _n_cols)
+        _grp.attrs['source'] = f"{os.path.abspath(src_file)}:{dataset}"
+        _grp.attrs['method'] = method
+        _grp.attrs['n_sigma'] = n_sigma
+        _grp.attrs['min_counts'] = min_counts
+        _grp['background'] = _bkg
+        _grp['threshold'] = _thr
+        _grp['omega'] = np.full(_n_frames, np.nan) if omega is None else np.asarray(omega, dtype=float)
+        _pixels = {
+            _name: _grp.create_dataset(
+                _name, shape=(0, ), maxshape=(None, ), dtype=_dtype,
+                chunks=(1<<18, ), compression='gzip', compression_opts=1, shuffle=True,
+            )
+            for _name, _dtype in (('row', np.uint16), ('col', np.uint16), ('value', _data.dtype))
+        }
+
+        _ptr = np.zeros(_n_frames + 1, dtype=np.int64)
+        _nnz = 0
+        for _start in range(0, _n_frames, block):
+            _counts, *_arrays = sparsify_frames(_data[_start:_start+block], _thr)
+            _ptr[_start+1:_start+1+len(_counts)] = _nnz + np.cumsum(_counts)
+            for _dset, _arr in zip(_pixels.values(), _arrays):
+                _dset.resize((_nnz + len(_arr), ))
+                _dset[_nnz:] = _arr
+            _nnz += len(_arrays[0])
+        _grp['frame_ptr'] = _ptr
+
+    _dense = _n_frames*_n_rows*_n_cols*_bkg_frames.dtype.itemsize
+    _stats = {
+        'file':    dst_file,
+        'nnz':     _nnz,
+        'density': _nnz/(_n_frames*_n_rows*_n_cols),
+        'ratio':   _dense/os.path.getsize(dst_file),
+        'seconds': time.perf_counter() - _t0,
+    }
+    if verbose:
+        print(f"{os.path.basename(src_file)} -> {os.path.basename(dst_file)}: "
+              f"{100*_stats['density']:.3f}% pixels kept, {_stats['ratio']:.1f}x smaller")
+    return _stats
+
+
+def sparsify_run(scan_index, uid: str, cfg_sparse: dict=None):
+    """
+    Write the sparse copy of each HDF5 file of an FF run (cfg['ff']['sparse']).
+
+    Called by Experiment.scan once the run is over (files closed by the IOC).
+    """
+    import h5py
+
+    cfg_sparse = cfg_sparse or {}
+    _md = scan_index.start_doc(uid)
+    _results = []
+    for _fn in scan_index.hdf5_files(uid):
+        if is_side_file(_fn):
+            continue
+        if not os.path.exists(_fn):
+            print(f"Cannot see {_fn} from this machine, no sparse copy written")
+            continue
+        with h5py.File(_fn, 'r') as h5f:
+            _n_frames = h5f['/exchange/data'].shape[0]
+        _results.append(sparsify_file(
+            _fn,
+            omega=frame_omega(_md, _n_frames),
+            n_sigma=cfg_sparse.get('n_sigma', 5.0),
+            min_counts=cfg_sparse.get('min_counts', 10),
+        ))
+    return _results
+
+
+class SparseFrames:
+    """
+    Read access to a sparse FF file, frames are rebuilt dense on demand
+
+    fill sets the pixels below the threshold
+        zero       : 0 (spots only)
+        background : the background model (rounded to the detector dtype)
+
+    Usage:
+    >> with SparseFrames('/data/ff/Ti64_ff_000003_sparse.h5') as ff:
+    >>     img = ff[100]                    # dense frame 100
+    >>     rows, cols, values = ff.pixels(100)
+    >>     ff.omega[100]
+    """
+
+    def __init__(self, filename: str, fill: str='zero'):
+        import h5py
+        if fill not in ('zero', 'background'):
+            raise ValueError(f"Unknown fill {fill}, use zero|background")
+        self.filename = filename
+        self._h5f = h5py.File(filename, 'r')
+        self._grp = self._h5f[SPARSE_GROUP]
+        self._ptr = self._grp['frame_ptr'][()]
+        self.omega = self._grp['omega'][()]
+        self.dtype = self._grp['value'].dtype
+        self.shape = (len(self._ptr) - 1, ) + tuple(int(me) for me in self._grp.attrs['frame_shape'])
+        self.ndim = 3
+        self._fill = None
+        if fill == 'background':
+            self._fill = np.rint(self._grp['background'][()]).astype(self.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._h5f.close()
+
+    @property
+    def nnz(self):
+        """number of stored pixels per frame"""
+        return np.diff(self._ptr)
+
+    def pixels(self, frame: int):
+        """(rows, cols, values) stored for one frame"""
+        _sl = slice(self._ptr[frame], self._ptr[frame+1])
+        return self._grp['row'][_sl], self._grp['col'][_sl], self._grp['value'][_sl]
+
+    def _empty(self, n_frames):
+        if self._fill is None:
+            return np.zeros((n_frames, ) + self.shape[1:], dtype=self.dtype)
+        return np.repeat(self._fill[np.newaxis], n_frames, axis=0)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self[key:key+1 if key != -1 else None][0]
+        if not isinstance(key, slice):
+            raise TypeError("SparseFrames supports an integer or a slice of frames")
+        _start, _stop, _step = key.indices(len(self))
+        _frames = np.arange(_start, _stop, _step)
+        _out = self._empty(len(_frames))
+        if len(_frames) == 0:
+            return _out
+        # one contiguous read covering the selected frames
+        _sl = slice(self._ptr[_frames.min()], self._ptr[_frames.max()+1])
+        _rows, _cols, _values = (self._grp[me][_sl] for me in ('row', 'col', 'value'))
+        _frame_of_pixel = np.repeat(
+            np.arange(_frames.min(), _frames.max()+1),
+            np.diff(self._ptr[_frames.min():_frames.max()+2]),
+        )
+        _keep = np.isin(_frame_of_pixel, _frames)
+        _index = np.searchsorted(_frames, _frame_of_pixel[_keep]) if _step > 0 \
+            else np.searchsorted(-_frames, -_frame_of_pixel[_keep])
+        _out[_index, _rows[_keep], _cols[_keep]] = _values[_keep]
+        return _out
+
+    def __array__(self, dtype=None):
+        _arr = self[:]
+        return _arr if dtype is None else _arr.astype(dtype)
+
+    def __repr__(self):
+        return f"SparseFrames(shape={self.shape}, dtype={self.dtype}, nnz={self._ptr[-1]})"
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
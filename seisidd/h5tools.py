@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+This module provides tools to work with the dxchange HDF5 files written by the
+area detector HDF plugin (det.hdf1) during scans.
+
+NOTE:
+* h5py is only required when these tools are actually used, so that the
+  experiment module can still be imported on machines without it.
+"""
+
+import os
+import time
+import zlib
+import multiprocessing
+import collections
+import numpy as np
+
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+
+
+DXCHANGE_DATASETS = (
+    '/exchange/data',
+    '/exchange/data_white_pre',
+    '/exchange/data_white_post',
+    '/exchange/data_dark',
+)
+
+
+# area detector NDDataType (HDF plugin DataType_RBV) to numpy
+AD_DTYPES = {
+    "Int8":    np.int8,
+    "UInt8":   np.uint8,
+    "Int16":   np.int16,
+    "UInt16":  np.uint16,
+    "Int32":   np.int32,
+    "UInt32":  np.uint32,
+    "Int64":   np.int64,
+    "UInt64":  np.uint64,
+    "Float32": np.float32,
+    "Float64": np.float64,
+}
+
+
+def split_revolutions(
+        src_file: str,
+        n_revolutions: int,
+        frames_per_revolution: int,
+        frame_shape: tuple,
+        dtype=np.uint16,
+        first_frame: int=0,
+        overlap: int=0,
+        dataset: str='/exchange/data',
+        dst_file: str=None,
+    ):
+    """
+    Split a continuous multi-revolution acquisition into per-revolution datasets.
+
+    The per-revolution datasets are HDF5 virtual datasets pointing back into the
+    source file (no data copy), written to a side file so that it can be created
+    while the HDF plugin still holds the source file open.
+
+    Example:
+    >> split_revolutions('/data/test_000001.h5', 10, 1800, (2048, 2448), first_frame=1)
+    >> '/data/test_000001_revolutions.h5'
+
+    with the layout
+        /exchange/revolution_0000/data   (1800, 2048, 2448)
+        /exchange/revolution_0001/data   (1800, 2048, 2448)
+        ...
+    """
+    import h5py
+
+    if dst_file is None:
+        dst_file = "_revolutions".join(os.path.splitext(src_file))
+    _n_total = first_frame + n_revolutions*frames_per_revolution + overlap
+    _src = h5py.VirtualSource(
+        os.path.relpath(src_file, os.path.dirname(os.path.abspath(dst_file))),
+        dataset,
+        shape=(_n_total, ) + tuple(frame_shape),
+    )
+
+    with h5py.File(dst_file, 'w') as h5f:
+        for ir in range(n_revolutions):
+            _start = first_frame + ir*frames_per_revolution
+            _stop  = _start + frames_per_revolution + overlap
+            _layout = h5py.VirtualLayout(shape=(_stop-_start, ) + tuple(frame_shape), dtype=dtype)
+            _layout[:] = _src[_start:_stop]
+            _grp = h5f.require_group(f"/exchange/revolution_{ir:04d}")
+            _grp.create_virtual_dataset("data", _layout, fillvalue=0)
+            _grp.attrs['revolution']  = ir
+            _grp.attrs['first_frame'] = _start
+        h5f.attrs['source_file']           = src_file
+        h5f.attrs['n_revolutions']         = n_revolutions
+        h5f.attrs['frames_per_revolution'] = frames_per_revolution
+
+    return dst_file
+
+
+def write_revolution_index(det, cfg_setup):
+    """
+    Build the per-revolution side file for the last file written by det.hdf1.
+
+    Called by Experiment.scan right after a continuous multi-revolution scan.  The
+    side file is skipped (with a message) if the IOC file path is not visible from
+    this machine.
+    """
+    _fn = det.hdf1.full_file_name.get()
+    if not os.path.exists(_fn):
+        print(f"Cannot see {_fn} from this machine, skip per-revolution split.")
+        print("Use seisidd.h5tools.split_revolutions() once the file is accessible.")
+        return None
+
+    _cont = cfg_setup['continuous']
+    return split_revolutions(
+        _fn,
+        _cont['n_revolutions'],
+        _cont['frames_per_revolution'],
+        (det.hdf1.array_size.height.get(), det.hdf1.array_size.width.get()),
+        dtype=AD_DTYPES.get(det.hdf1.data_type.get(as_string=True), np.uint16),
+        first_frame=_cont['first_frame'],
+        overlap=_cont['overlap'],
+    )
+
+
+def consolidate_layers(
+        layer_files: list,
+        dst_file: str,
+        ky: list=None,
+        datasets: tuple=DXCHANGE_DATASETS,
+    ):
+    """
+    Build a single volume file (HDF5 virtual datasets, no data copy) from the
+    per-layer dxchange files of a volume scan.
+
+    Every dataset present in all layers becomes (layer, frame, row, col), the
+    ky of each layer is stored in /exchange/ky.  All layers must have the same
+    number of frames per dataset.
+
+    Example:
+    >> files = sorted(glob.glob('/data/Ti64_*.h5'))
+    >> consolidate_layers(files, '/data/Ti64_volume.h5', ky=np.arange(len(files))*0.1)
+    >> '/data/Ti64_volume.h5'
+    """
+    import h5py
+
+    _dst_dir = os.path.dirname(os.path.abspath(dst_file))
+    with h5py.File(dst_file, 'w') as h5f:
+        for _path in datasets:
+            _shapes = []
+            for me in layer_files:
+                with h5py.File(me, 'r') as _src:
+                    if _path not in _src:
+                        break
+                    _shapes.append((_src[_path].shape, _src[_path].dtype))
+            if len(_shapes) != len(layer_files):
+                continue
+            if len(set(_shapes)) != 1:
+                raise ValueError(f"{_path} differs between layers: {sorted(set(_shapes))}")
+            _shape, _dtype = _shapes[0]
+            _layout = h5py.VirtualLayout(shape=(len(layer_files), ) + tuple(_shape), dtype=_dtype)
+            for i, me in enumerate(layer_files):
+                _layout[i] = h5py.VirtualSource(os.path.relpath(me, _dst_dir), _path, shape=_shape)
+            h5f.create_virtual_dataset(_path, _layout, fillvalue=0)
+        if ky is not None:
+            h5f['/exchange/ky'] = np.asarray(ky, dtype=float)
+        h5f.attrs['layer_files'] = [os.path.abspath(me) for me in layer_files]
+
+    return dst_file
+
+
+# per process cache of the open source files (rewrite_volume workers)
+_WORKER_FILES = {}
+
+
+def _init_worker():
+    # the pool shuts its workers down through the multiprocessing exit hooks
+    # (atexit handlers do not run there)
+    Finalize(None, _close_worker_files, exitpriority=10)
+
+
+def _close_worker_files():
+    while _WORKER_FILES:
+        _WORKER_FILES.popitem()[1].close()
+
+
+def _compress_frame(args):
+    import h5py
+    _fn, _path, _layer, _frame, _level = args
+    if _fn not in _WORKER_FILES:
+        _WORKER_FILES[_fn] = h5py.File(_fn, 'r')
+    _img = _WORKER_FILES[_fn][_path][_layer, _frame]
+    return zlib.compress(np.ascontiguousarray(_img).tobytes(), _level)
+
+
+def _write_chunk(dset, args, future):
+    _, _, _layer, _frame, _ = args
+    dset.id.write_direct_chunk((_layer, _frame, 0, 0), future.result())
+
+
+def rewrite_volume(
+        vds_file: str,
+        dst_file: str,
+        level: int=4,
+        n_workers: int=None,
+        window: int=None,
+    ):
+    """
+    Rewrite a consolidated (virtual) volume into a single gzip compressed file.
+
+    Frames are read and deflated by a process pool, the main process only writes
+    the compressed chunks (one frame per chunk) in order, so the output is
+    written sequentially.  The result is a regular gzip filtered HDF5 file.
+    At most window frames (default 4 per worker) are in flight, which bounds
+    the memory held by compressed chunks waiting to be written.  The workers
+    are spawned, HDF5 handles must not be inherited through fork.
+
+    Example:
+    >> rewrite_volume('/data/Ti64_volume.h5', '/data/Ti64_volume_gz.h5', n_workers=16)
+    """
+    import h5py
+
+    with h5py.File(vds_file, 'r') as _src, h5py.File(dst_file, 'w') as _dst:
+        _tasks, _dsets = [], []
+        for _path in DXCHANGE_DATASETS:
+            if _path not in _src:
+                continue
+            _shape, _dtype = _src[_path].shape, _src[_path].dtype
+            _dsets.append(_dst.create_dataset(
+                _path, shape=_shape, dtype=_dtype,
+                chunks=(1, 1) + tuple(_shape[2:]),
+                compression='gzip', compression_opts=level,
+            ))
+            _tasks += [
+                (_dsets[-1], (os.path.abspath(vds_file), _path, il, ifr, level))
+                for il in range(_shape[0])
+                for ifr in range(_shape[1])
+            ]
+        for _key, _val in _src.attrs.items():
+            _dst.attrs[_key] = _val
+        if '/exchange/ky' in _src:
+            _dst['/exchange/ky'] = _src['/exchange/ky'][()]
+
+        _n_workers = n_workers or os.cpu_count() or 1
+        _window = window or 4*_n_workers
+        with ProcessPoolExecutor(
+                max_workers=_n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            ) as _pool:
+            _pending = collections.deque()
+            for _dset, _args in _tasks:
+                _pending.append((_dset, _args, _pool.submit(_compress_frame, _args)))
+                while len(_pending) >= _window:
+                    _write_chunk(*_pending.popleft())
+            while _pending:
+                _write_chunk(*_pending.popleft())
+
+    return dst_file
+
+
+def to_sinograms(
+        src_file: str,
+        dst_file: str,
+        dataset: str='/exchange/data',
+        max_memory: int=1<<30,
+        compression: str=None,
+        verbose: bool=True,
+    ):
+    """
+    Rewrite a projection stack (frame, row, col) as sinograms (row, frame, col).
+
+    The projections are read in blocks of whole frames (sequential reads), each
+    block is transposed and written as whole (1, n_block, col) chunks, so that no
+    chunk is ever read or written twice and a sinogram is read with a handful of
+    contiguous chunks.  max_memory bounds the block and its transposed copy.
+
+    NOTE:
+    * Reads and writes are not overlapped, h5py serializes every call on its
+      global lock so a reader and a writer thread would only take turns.
+
+    Example:
+    >> to_sinograms('/data/Ti64_000001.h5', '/data/Ti64_000001_sino.h5')
+    >> {'frames_per_block': 180, 'seconds': 41.2, 'MB/s': 812.5}
+    """
+    import h5py
+
+    with h5py.File(src_file, 'r') as _src, h5py.File(dst_file, 'w') as _dst:
+        _proj = _src[dataset]
+        _n_frames, _n_rows, _n_cols = _proj.shape
+        _frame_bytes = _n_rows*_n_cols*_proj.dtype.itemsize
+        # the block read and its transposed copy
+        _block = int(np.clip(max_memory // (2*_frame_bytes), 1, _n_frames))
+        _sino = _dst.create_dataset(
+            '/exchange/sinogram',
+            shape=(_n_rows, _n_frames, _n_cols),
+            dtype=_proj.dtype,
+            chunks=(1, _block, _n_cols),
+            compression=compression,
+        )
+        _sino.attrs['axes'] = 'row:theta:col'
+        _sino.attrs['source'] = f"{os.path.abspath(src_file)}:{dataset}"
+
+        _t0 = time.perf_counter()
+        for _start in range(0, _n_frames, _block):
+            _data = np.ascontiguousarray(_proj[_start:_start+_block].transpose(1, 0, 2))
+            _sino[:, _start:_start+_data.shape[1], :] = _data
+            del _data
+        _dt = time.perf_counter() - _t0
+
+    _stats = {
+        'frames_per_block': _block,
+        'seconds':          _dt,
+        'MB/s':             _n_frames*_frame_bytes/_dt/1e6,
+    }
+    if verbose:
+        print(f"{os.path.basename(src_file)} -> {os.path.basename(dst_file)}: "
+              f"{_stats['MB/s']:.1f} MB/s ({_block} frames per block)")
+    return _stats
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+This module provides the databroker handlers for the asset documents emitted
+by the 6-ID-D detectors, so that frames can be retrieved lazily from the
+dxchange HDF5 files instead of being stored in MongoDB.
+
+NOTE:
+* A single file is shared by many datum (one per trigger), and a scan can span
+  hundreds of files (one per layer).  Open files are therefore kept in a small
+  module level LRU cache instead of one handle per handler instance.
+"""
+
+from collections import OrderedDict
+
+
+class _H5FileCache:
+    """bounded LRU cache of read-only h5py.File handles"""
+
+    def __init__(self, maxsize: int=16):
+        self.maxsize = maxsize
+        self._files = OrderedDict()
+
+    def get(self, filename: str):
+        if filename in self._files:
+            self._files.move_to_end(filename)
+            return self._files[filename]
+
+        import h5py
+        _h5f = h5py.File(filename, 'r')
+        self._files[filename] = _h5f
+        while len(self._files) > self.maxsize:
+            _, _old = self._files.popitem(last=False)
+            _old.close()
+        return _h5f
+
+    def close(self):
+        while self._files:
+            _, _old = self._files.popitem(last=False)
+            _old.close()
+
+
+_H5_FILES = _H5FileCache()
+
+
+def set_open_file_limit(maxsize: int):
+    """change the number of HDF5 files kept open by the handlers"""
+    _H5_FILES.maxsize = maxsize
+    while len(_H5_FILES._files) > maxsize:
+        _, _old = _H5_FILES._files.popitem(last=False)
+        _old.close()
+
+
+def close_open_files():
+    """close all HDF5 files kept open by the handlers (e.g. before moving data)"""
+    _H5_FILES.close()
+
+
+class DXchangeHDF5Handler:
+    """
+    Handler for the 'AD_HDF5_DXCHANGE' spec
+
+    resource: the dxchange HDF5 file written by det.hdf1
+    datum   : dataset (/exchange/data, /exchange/data_dark, ...), index of the
+              first frame (point_number) and number of frames (frame_per_point)
+    """
+    specs = {'AD_HDF5_DXCHANGE'}
+
+    def __init__(self, filename, **kwargs):
+        self._filename = filename
+
+    def __call__(self, dataset, point_number, frame_per_point=1):
+        _dset = _H5_FILES.get(self._filename)[dataset]
+        _frames = _dset[point_number:point_number+frame_per_point]
+        return _frames[0] if frame_per_point == 1 else _frames
+
+    def get_file_list(self, datum_kwargs_gen):
+        return [self._filename]
+
+    def close(self):
+        # the file handle belongs to the shared cache
+        pass
+
+
+def register_handlers(db):
+    """
+    Register the 6-ID-D handlers with a databroker (v0) instance
+
+    Example:
+    >> db = databroker.Broker.named("mongodb_config")
+    >> register_handlers(db)
+    >> h = db[-1]
+    >> imgs = h.data('det_image')
+    """
+    for _spec in DXchangeHDF5Handler.specs:
+        db.reg.register_handler(_spec, DXchangeHDF5Handler, overwrite=True)
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
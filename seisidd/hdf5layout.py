@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+This module generates the HDF5 plugin (det.hdf1) layout XML for the dxchange
+output and the matching chunking/compression settings, from a declarative
+description per setup.
+
+NOTE:
+* The layout XML of the HDF plugin only describes groups, datasets and
+  attributes.  Chunking and compression apply to all detector datasets and are
+  set through the plugin PVs (NumFramesChunks, NumRowChunks, NumColChunks,
+  Compression, ZLevel).
+* The XML content is pushed directly to XMLFileName (supported by the HDF plugin
+  when the PV starts with '<'), so no layout file needs to exist on the IOC host.
+"""
+
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from .h5tools import AD_DTYPES
+
+
+# the dataset of each cam1.frame_type (see get_detector in experiment.py)
+DXCHANGE_FRAME_TYPES = (
+    "/exchange/data_white_pre",
+    "/exchange/data",
+    "/exchange/data_white_post",
+    "/exchange/data_dark",
+)
+
+# access pattern per setup
+#   projection : whole frames (tomo quick look, FF/NF per frame processing)
+#   sinogram   : a few rows over all the frames (tomo reconstruction)
+#   omega_slab : a tile over consecutive omega frames (FF spot extraction)
+LAYOUTS = {
+    'tomo': {
+        'access':      'sinogram',
+        'compression': 'None',     # [None|zlib|blosc|lz4|bslz4]
+        'zlevel':      0,
+        'datasets':    DXCHANGE_FRAME_TYPES,
+    },
+    'ff': {
+        'access':      'omega_slab',
+        'omega_slab':  16,
+        'tile':        256,
+        'compression': 'zlib',     # sparse FF frames compress very well
+        'zlevel':      1,
+        'datasets':    DXCHANGE_FRAME_TYPES,
+    },
+    'nf': {
+        'access':      'projection',
+        'compression': 'None',
+        'zlevel':      0,
+        'datasets':    DXCHANGE_FRAME_TYPES,
+    },
+}
+
+_VALID_SOURCES = ('detector', 'ndattribute', 'constant')
+
+
+def chunk_shape(
+        access: str,
+        frame_shape: tuple,
+        itemsize: int=2,
+        target_bytes: int=1<<20,
+        max_frames: int=64,
+        omega_slab: int=16,
+        tile: int=256,
+    ):
+    """
+    Chunk shape (frames, rows, cols) for an access pattern.
+
+    max_frames bounds the frames the plugin has to buffer before writing a chunk.
+
+    Example:
+    >> chunk_shape('sinogram', (2048, 2448))
+    >> (64, 3, 2448)
+    """
+    _rows, _cols = frame_shape
+    if access == 'projection':
+        return (1, _rows, _cols)
+    if access == 'sinogram':
+        _frames = max_frames
+        _n_rows = max(1, min(_rows, target_bytes // (_frames*_cols*itemsize)))
+        return (_frames, _n_rows, _cols)
+    if access == 'omega_slab':
+        return (min(omega_slab, max_frames), min(tile, _rows), min(tile, _cols))
+    raise ValueError(f"Unknown access pattern {access}, use projection|sinogram|omega_slab")
+
+
+def layout_xml(datasets: tuple=DXCHANGE_FRAME_TYPES):
+    """HDF plugin layout XML with the detector datasets at the given paths"""
+    _root = ET.Element('hdf_layout')
+    ET.SubElement(_root, 'global', name='detector_data_destination', ndattribute='SaveDest')
+    _groups = {}
+    for _path in datasets:
+        *_group_names, _name = _path.strip('/').split('/')
+        _parent = _root
+        for i, _group in enumerate(_group_names):
+            _key = '/'.join(_group_names[:i+1])
+            if _key not in _groups:
+                _groups[_key] = ET.SubElement(_parent, 'group', name=_group)
+            _parent = _groups[_key]
+        ET.SubElement(_parent, 'dataset', name=_name, source='detector')
+    return '<?xml version="1.0" standalone="no" ?>\n' + ET.tostring(_root, encoding='unicode')
+
+
+def validate_layout_xml(xml: str, required_datasets: tuple=DXCHANGE_FRAME_TYPES):
+    """
+    Check a layout XML before it is sent to the IOC (the plugin only reports a
+    parsing error at capture time).  Returns the detector dataset paths.
+    """
+    try:
+        _root = ET.fromstring(xml)
+    except ET.ParseError as ex:
+        raise ValueError(f"Invalid layout XML: {ex}")
+    if _root.tag != 'hdf_layout':
+        raise ValueError(f"Layout root must be <hdf_layout>, got <{_root.tag}>")
+
+    _paths = []
+    def _walk(elem, prefix):
+        _names = set()
+        for _child in elem:
+            if _child.tag not in ('group', 'dataset', 'attribute', 'global', 'hardlink'):
+                raise ValueError(f"Unknown layout element <{_child.tag}> in {prefix or '/'}")
+            if _child.tag in ('group', 'dataset'):
+                _name = _child.get('name')
+                if not _name:
+                    raise ValueError(f"<{_child.tag}> without name in {prefix or '/'}")
+                if _name in _names:
+                    raise ValueError(f"Duplicated {_child.tag} {prefix}/{_name}")
+                _names.add(_name)
+            if _child.tag == 'group':
+                _walk(_child, f"{prefix}/{_child.get('name')}")
+            elif _child.tag == 'dataset':
+                _source = _child.get('source')
+                if _source not in _VALID_SOURCES:
+                    raise ValueError(f"Dataset {prefix}/{_child.get('name')} has invalid source {_source}")
+                if _source == 'ndattribute' and not _child.get('ndattribute'):
+                    raise ValueError(f"Dataset {prefix}/{_child.get('name')} needs an ndattribute")
+                if _source == 'detector':
+                    _paths.append(f"{prefix}/{_child.get('name')}")
+    _walk(_root, '')
+
+    _missing = [me for me in required_datasets if me not in _paths]
+    if _missing:
+        raise ValueError(f"Layout is missing the detector datasets {_missing}")
+    return _paths
+
+
+def configure_hdf_layout(det, setup: str, layout: dict=None):
+    """
+    Push the layout XML and the chunking/compression of a setup to det.hdf1.
+
+    Call once the plugin knows the image size (after priming the camera).
+
+    Example:
+    >> configure_hdf_layout(det, 'tomo')
+    >> {'chunks': (64, 3, 2448), 'compression': 'None', 'zlevel': 0}
+    """
+    _layout = dict(LAYOUTS[setup], **(layout or {}))
+    _xml = layout_xml(_layout['datasets'])
+    validate_layout_xml(_xml, required_datasets=_layout['datasets'])
+
+    _frame_shape = (det.hdf1.array_size.height.get(), det.hdf1.array_size.width.get())
+    _data_type = det.hdf1.data_type.get(as_string=True)
+    if _data_type not in AD_DTYPES:
+        raise ValueError(f"Unknown NDDataType {_data_type}, use one of {list(AD_DTYPES)}")
+    _chunks = chunk_shape(
+        _layout['access'],
+        _frame_shape,
+        itemsize=np.dtype(AD_DTYPES[_data_type]).itemsize,
+        omega_slab=_layout.get('omega_slab', 16),
+        tile=_layout.get('tile', 256),
+    )
+    det.hdf1.xml_file_name.put(_xml)
+    det.hdf1.num_frames_chunks.put(_chunks[0])
+    det.hdf1.num_row_chunks.put(_chunks[1])
+    det.hdf1.num_col_chunks.put(_chunks[2])
+    det.hdf1.compression.put(_layout['compression'])
+    det.hdf1.zlevel.put(_layout['zlevel'])
+    return {'chunks': _chunks, 'compression': _layout['compression'], 'zlevel': _layout['zlevel']}
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
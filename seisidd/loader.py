@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+This module provides lazy access to the dxchange HDF5 files of a scan for
+quick-look analysis, only the chunks actually indexed are read from disk.
+
+NOTE:
+* dask is optional, without it the datasets are exposed through LayerStack, a
+  minimal numpy-like (shape/dtype/slicing) wrapper around the h5py datasets.
+* Every layer file stays open (read-only) as long as the ScanData is in use,
+  call .close() when done with a large volume scan.
+"""
+
+import numpy as np
+
+from .scanindex import find_hdf5_files
+
+
+DXCHANGE_DATASETS = {
+    'data':            '/exchange/data',
+    'data_white_pre':  '/exchange/data_white_pre',
+    'data_white_post': '/exchange/data_white_post',
+    'data_dark':       '/exchange/data_dark',
+}
+
+
+class LayerStack:
+    """
+    Numpy-like read-only stack of per-layer h5py datasets, (layer, frame, row, col)
+
+    Only the layers and frames selected by the index are read.
+    """
+
+    def __init__(self, dsets):
+        self._dsets = list(dsets)
+        self.dtype = self._dsets[0].dtype
+        self.shape = (len(self._dsets), ) + tuple(self._dsets[0].shape)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        _layer, _rest = key[0], key[1:]
+        if isinstance(_layer, (int, np.integer)):
+            return self._dsets[_layer][_rest if _rest else ()]
+        _layers = np.arange(self.shape[0])[_layer]
+        return np.stack([self._dsets[i][_rest if _rest else ()] for i in _layers])
+
+    def __array__(self, dtype=None):
+        _arr = self[:]
+        return _arr if dtype is None else _arr.astype(dtype)
+
+    def __repr__(self):
+        return f"LayerStack(shape={self.shape}, dtype={self.dtype})"
+
+
+class FrameRange:
+    """frames [start, stop) of an h5py dataset, one layer of a volume capture file"""
+
+    def __init__(self, dset, start, stop):
+        self._dset = dset
+        self._start = start
+        self.dtype = dset.dtype
+        self.shape = (stop - start, ) + tuple(dset.shape[1:])
+        self.ndim = len(self.shape)
+        self.chunks = dset.chunks
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        _frame, _rest = (key[0], key[1:]) if key else (slice(None), ())
+        if isinstance(_frame, slice):
+            _start, _stop, _step = _frame.indices(self.shape[0])
+            _frame = slice(_start + self._start, _stop + self._start, _step)
+        else:
+            # integer or (increasing) index array, as accepted by h5py
+            _frame = np.asarray(_frame) + self._start
+            _frame = int(_frame) if _frame.ndim == 0 else _frame
+        return self._dset[(_frame, ) + _rest]
+
+
+def _layer_views(dset, n_layers, frames_per_layer):
+    """split a volume capture dataset into per-layer views"""
+    return [
+        FrameRange(dset, i*frames_per_layer, (i+1)*frames_per_layer)
+        for i in range(n_layers)
+    ]
+
+
+def _lazy_stack(dsets, chunks=None):
+    """stack the per-layer datasets lazily (dask when available)"""
+    try:
+        import dask.array as da
+    except ImportError:
+        return LayerStack(dsets)
+    return da.stack([
+        da.from_array(me, chunks=chunks or me.chunks or 'auto')
+        for me in dsets
+    ])
+
+
+def _lazy_volume(dset, chunks=None):
+    """(layer, frame, row, col) dataset, dask array when available"""
+    try:
+        import dask.array as da
+    except ImportError:
+        return dset
+    return da.from_array(dset, chunks=chunks or dset.chunks or 'auto')
+
+
+class ScanData:
+    """
+    Lazy view of the dxchange output of one scan (one file per layer, or a
+    single file for volume capture)
+
+    Attributes:
+        data, data_white_pre, data_white_post, data_dark :
+            lazy arrays (layer, frame, row, col), None if not written
+        angles : rotation angle of each frame of data (acquisition order)
+        ky     : ky of each layer (or of each frame for helical scans)
+        files  : HDF5 files, one per layer (or one per volume)
+        md     : run start document (empty if unknown)
+    """
+
+    def __init__(self, files, md=None, chunks=None):
+        if not files:
+            raise ValueError("No HDF5 files to load")
+        self.files = list(files)
+        self.md = md or {}
+        import h5py
+        self._h5fs = [h5py.File(me, 'r') for me in self.files]
+        _volume = self.md.get('volume_capture')
+        for _attr, _path in DXCHANGE_DATASETS.items():
+            if not all(_path in me for me in self._h5fs):
+                setattr(self, _attr, None)
+            elif len(self._h5fs) == 1 and self._h5fs[0][_path].ndim == 4:
+                # consolidated volume (h5tools.consolidate_layers/rewrite_volume)
+                setattr(self, _attr, _lazy_volume(self._h5fs[0][_path], chunks=chunks))
+            elif _volume and len(self._h5fs) == 1:
+                # single file for all layers (output.capture: volume)
+                _dsets = _layer_views(
+                    self._h5fs[0][_path],
+                    _volume['n_layers'],
+                    _volume['frames_per_layer'][_attr],
+                )
+                setattr(self, _attr, _lazy_stack(_dsets, chunks=chunks))
+            else:
+                setattr(self, _attr, _lazy_stack([me[_path] for me in self._h5fs], chunks=chunks))
+        _n_frames = self.data.shape[1] if self.data is not None else 0
+        self.angles = self._angles(_n_frames)
+        self.ky = self._ky()
+
+    def _angles(self, n_frames):
+        _angles = self.md.get('rotation_angles')
+        if _angles is None and self.md.get('setup') == 'ff':
+            # FF layers start with the junk frame from the taxi position
+            from .ffsparse import frame_omega
+            _angles = frame_omega(self.md, n_frames)
+        elif _angles is None:
+            _cfg = self.md.get('scan_config', {}).get(self.md.get('setup'), {})
+            if 'omega_start' in _cfg and 'omega_step' in _cfg:
+                _angles = _cfg['omega_start'] + np.arange(n_frames)*_cfg['omega_step']
+        if _angles is None or len(_angles) != n_frames:
+            # do not guess, a wrong angle is worse than no angle
+            return None
+        return np.asarray(_angles)
+
+    def _ky(self):
+        if len(self._h5fs) == 1 and '/exchange/ky' in self._h5fs[0]:
+            return self._h5fs[0]['/exchange/ky'][()]
+        if 'ky_positions' in self.md:
+            return np.asarray(self.md['ky_positions'])
+        _volume = self.md.get('scan_config', {}).get(self.md.get('setup'), {}).get('volume')
+        if not _volume:
+            return None
+        _n_layers = self.data.shape[0] if self.data is not None else len(self.files)
+        return _volume['ky_start'] + np.arange(_n_layers)*_volume['ky_step']
+
+    def close(self):
+        """close the layer files, the lazy arrays are no longer usable"""
+        for me in self._h5fs:
+            me.close()
+        self._h5fs = []
+
+    def __repr__(self):
+        _msg = [f"ScanData({len(self.files)} files)"]
+        for _attr in DXCHANGE_DATASETS:
+            _arr = getattr(self, _attr)
+            if _arr is not None:
+                _msg.append(f"  {_attr:16s}: {_arr.shape} {_arr.dtype}")
+        return "\n".join(_msg)
+
+
+def load_scan(run: str, index=None, filepath: str=None, output_type: str=None, chunks=None):
+    """
+    Open the HDF5 output of a scan lazily.
+
+    run is either a run uid (looked up in a scanindex.ScanIndex) or a file prefix
+    (files <filepath>/<prefix>*.<output_type> without run metadata, any HDF5
+    extension when output_type is not given).
+
+    Example:
+    >> scan = load_scan('4a1f0c2e-...', index=ScanIndex())
+    >> scan.data[3, ::10].mean(axis=0)    # reads 1 frame out of 10 of layer 3
+    >> scan.angles, scan.ky
+    """
+    if index is not None:
+        try:
+            return ScanData(index.hdf5_files(run), md=index.start_doc(run), chunks=chunks)
+        except KeyError:
+            pass
+    return ScanData(find_hdf5_files(filepath, run, output_type), chunks=chunks)
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
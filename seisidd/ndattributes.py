@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+This module trims the NDAttributes attached to every detector frame.
+
+The attribute files (config/*_attributes.xml) make the IOC read every listed PV
+and store its value for each frame, although most of them (manufacturer,
+firmware, sensor size, ...) cannot change during a file.  The attributes are
+split into
+    static  : read once per scan, stored in the run md and written as root
+              attributes of the HDF5 files after the scan (by this module)
+    dynamic : kept in the slim attribute XML, stored per frame by the IOC
+
+NOTE:
+* SaveDest must stay dynamic, the dxchange layout routes each frame with it.
+* The file name PVs (FileName, FullFileName_RBV, ...) are set by config_output
+  during the scan, they stay with the frames (read by the IOC for each file).
+"""
+
+import os
+import time
+import xml.etree.ElementTree as ET
+
+
+# PV fields that cannot change while a file is being written
+STATIC_PV_FIELDS = (
+    'Manufacturer_RBV', 'Model_RBV', 'SerialNumber_RBV', 'FirmwareVersion_RBV',
+    'SDKVersion_RBV', 'DriverVersion_RBV', 'ADCoreVersion_RBV',
+    'MaxSizeX_RBV', 'MaxSizeY_RBV', 'MinX', 'MinY', 'SizeX', 'SizeY', 'BinX', 'BinY',
+    'DataType_RBV', 'PluginType_RBV',
+)
+
+# attributes the layout (or the analysis) needs for every frame
+REQUIRED_DYNAMIC = ('SaveDest', )
+
+# bytes stored per frame for each attribute type
+_DBR_SIZES = {'DBR_STRING': 40, 'DBR_DOUBLE': 8, 'DBR_LONG': 4, 'DBR_ENUM': 2, 'DBR_NATIVE': 8}
+
+
+def read_attributes_xml(src: str):
+    """list of the (uncommented) attributes of an attribute XML file or string"""
+    _root = ET.fromstring(src) if src.lstrip().startswith('<') else ET.parse(src).getroot()
+    return [dict(me.attrib) for me in _root.iter('Attribute')]
+
+
+def classify_attributes(attrs, observed: dict=None):
+    """
+    Split attributes into (static, dynamic).
+
+    observed ({name: values over frames}, e.g. read back from an existing file)
+    overrides the rules: an attribute that changed between frames is dynamic.
+
+    Example:
+    >> static, dynamic = classify_attributes(read_attributes_xml('config/PG4_attributes.xml'))
+    >> [me['name'] for me in dynamic]
+    >> ['AcqTime', 'AcqPeriod', 'FrameRate', ..., 'SaveDest', ...]
+    """
+    _static, _dynamic = [], []
+    for me in attrs:
+        _field = me.get('source', '').rsplit(':', 1)[-1]
+        _is_static = me.get('type') == 'EPICS_PV' \
+            and _field in STATIC_PV_FIELDS \
+            and me['name'] not in REQUIRED_DYNAMIC
+        if observed is not None and me['name'] in observed:
+            _values = list(observed[me['name']])
+            _is_static = _is_static and all(v == _values[0] for v in _values)
+        (_static if _is_static else _dynamic).append(me)
+    return _static, _dynamic
+
+
+def attributes_xml(attrs):
+    """attribute XML in the layout of the config/*_attributes.xml files"""
+    _lines = [
+        '<Attributes',
+        '    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"',
+        '    xsi:schemaLocation="http://epics.aps.anl.gov/areaDetector/attributes ../attributes.xsd"',
+        '    >',
+    ]
+    # same column widths as the hand written files
+    _widths = {'name': 37, 'type': 20, 'source': 51}
+    for me in attrs:
+        _keys = ['name', 'type', 'source', 'dbrtype'] + [k for k in me if k not in ('name', 'type', 'source', 'dbrtype')]
+        _fields = [f'{k}="{me[k]}"'.ljust(_widths.get(k, 0)) for k in _keys if k in me]
+        _lines.append('    <Attribute ' + ''.join(f + ('' if f.endswith(' ') else ' ') for f in _fields).rstrip() + '/>')
+    _lines.append('</Attributes>')
+    return "\n".join(_lines) + "\n"
+
+
+def write_slim_attributes(src_xml: str, dst_xml: str=None, observed: dict=None):
+    """
+    Write the attribute XML with the dynamic attributes only.
+
+    Example:
+    >> write_slim_attributes('config/PG4_attributes.xml')
+    >> 'config/PG4_attributes_slim.xml'
+    """
+    if dst_xml is None:
+        dst_xml = "_slim".join(os.path.splitext(src_xml))
+    _, _dynamic = classify_attributes(read_attributes_xml(src_xml), observed=observed)
+    with open(dst_xml, 'w') as f:
+        f.write(attributes_xml(_dynamic))
+    return dst_xml
+
+
+def attribute_overhead(attrs, n_frames: int=1800):
+    """PV reads and attribute bytes stored for n_frames frames"""
+    return {
+        'n_attributes':   len(attrs),
+        'pv_reads':       n_frames*sum(me.get('type') == 'EPICS_PV' for me in attrs),
+        'bytes':          n_frames*sum(_DBR_SIZES.get(me.get('dbrtype'), 8) for me in attrs),
+    }
+
+
+def read_static_values(static_attrs, timeout: float=1.0):
+    """read the static attributes once, {name: value} (None if not connected)"""
+    if not static_attrs:
+        return {}
+    import epics
+    _values = epics.caget_many(
+        [me['source'] for me in static_attrs],
+        as_string=True,
+        connection_timeout=timeout,
+    )
+    return {me['name']: v for me, v in zip(static_attrs, _values)}
+
+
+def write_root_attributes(h5file: str, values: dict):
+    """write the static attribute values as root attributes of a (closed) HDF5 file"""
+    import h5py
+    with h5py.File(h5file, 'a') as h5f:
+        for _name, _value in values.items():
+            if _value is not None:
+                h5f.attrs[_name] = _value
+
+
+def write_run_static_attributes(scan_index, uid: str):
+    """
+    Write the static attributes recorded in the run md into the run HDF5 files.
+
+    Called by Experiment.scan once the run is over (files closed by the IOC).
+    """
+    _values = scan_index.start_doc(uid).get('detector_static')
+    if not _values:
+        return []
+    _written = []
+    for _fn in scan_index.hdf5_files(uid):
+        if not os.path.exists(_fn):
+            print(f"Cannot see {_fn} from this machine, static attributes are kept in the run md only")
+            continue
+        write_root_attributes(_fn, _values)
+        _written.append(_fn)
+    return _written
+
+
+def measure_attribute_overhead(det, attribute_files: dict, n_frames: int=200, timeout: float=120):
+    """
+    Time n_frames frames written by det.hdf1 with each attribute file.
+
+    The camera runs in Internal mode with its current exposure, so the
+    difference between the files is the per-frame attribute cost.
+
+    Example:
+    >> measure_attribute_overhead(det, {
+    >>     'full': 'config/PG4_attributes.xml',
+    >>     'slim': 'config/PG4_attributes_slim.xml',
+    >> })
+    >> {'full': 0.0512, 'slim': 0.0431}   # seconds per frame
+    """
+    _cached = det.cam1.nd_attributes_file.get()
+    _results = {}
+    try:
+        for _label, _fn in attribute_files.items():
+            det.cam1.nd_attributes_file.put(_fn)
+            det.cam1.image_mode.put('Multiple')
+            det.cam1.num_images.put(n_frames)
+            det.hdf1.file_write_mode.put(2)  # stream
+            det.hdf1.num_capture.put(n_frames)
+            det.hdf1.file_name.put(f'attribute_overhead_{_label}')
+            det.hdf1.enable.put(1)
+            det.hdf1.capture.put(1)
+            _t0 = time.perf_counter()
+            det.cam1.acquire.put(1)
+            while det.hdf1.num_captured.get() < n_frames:
+                if time.perf_counter() - _t0 > timeout:
+                    raise TimeoutError(f"hdf1 captured {det.hdf1.num_captured.get()}/{n_frames} frames")
+                time.sleep(0.05)
+            _results[_label] = (time.perf_counter() - _t0)/n_frames
+    finally:
+        det.cam1.acquire.put(0)
+        det.hdf1.capture.put(0)
+        det.cam1.nd_attributes_file.put(_cached)
+    return _results
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
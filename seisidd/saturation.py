@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+This module provides a saturation guard for the far-field (FF-HEDM) scans, it
+selects the attenuation level (beam.att) so that the fraction of saturated
+pixels per frame stays below max_fraction:
+    * before the scan, short test exposures starting from the least attenuating
+      level, stepping up until the frame is not saturated
+    * between layers, from the per-frame statistics of the live spot finder
+      (seisidd.spotfinder) of the layer just collected
+Each decision is recorded as an event of the 'attenuation' stream of the run.
+
+NOTE:
+* The levels are ordered by Attenuator._att_level_spreadsheet (least
+  attenuating first).  Lowering the attenuation between layers requires the
+  relative transmission of the levels (transmission={level: T}), without it the
+  guard only steps up when saturated, the test exposure still finds the lowest
+  level by trying them in order.
+"""
+
+import time
+import numpy as np
+
+
+def attenuation_levels(spreadsheet: dict):
+    """attenuation levels from the least to the most attenuating"""
+    return [me for me, _ in sorted(spreadsheet.items(), key=lambda me: (me[1], me[0]))]
+
+
+def frame_saturation(frame, saturation: float, top_fraction: float=1e-4):
+    """
+    Saturated fraction of a frame and the value exceeded by top_fraction of its
+    pixels (used to predict the saturation at another attenuation).
+    """
+    _frame = np.asarray(frame)
+    _k = max(1, int(top_fraction*_frame.size))
+    return {
+        'saturated_fraction': float(np.count_nonzero(_frame >= saturation))/_frame.size,
+        'top_value':          float(np.partition(_frame.ravel(), -_k)[-_k]),
+    }
+
+
+class SaturationGuard:
+    """
+    Choose the lowest attenuation level that keeps the saturation below max_fraction
+
+    Usage (inside FarField.scan):
+    >> guard = SaturationGuard(beam.att, saturation=60000, max_fraction=1e-4)
+    >> yield from guard.test_exposure(det, acquire_time=0.1) # before the first layer
+    >> yield from guard.adjust(spotfinder.summary(), layer)  # between layers
+    """
+
+    def __init__(
+            self,
+            attenuator,
+            saturation: float=60000,
+            max_fraction: float=1e-4,
+            transmission: dict=None,
+            levels: list=None,
+        ):
+        self.attenuator = attenuator
+        self.saturation = saturation
+        self.max_fraction = max_fraction
+        self.transmission = transmission
+        self.levels = list(levels) if levels is not None else attenuation_levels(attenuator._att_level_spreadsheet)
+        self.history = []
+        self._signals = None
+
+    @property
+    def level(self):
+        """current attenuation level (motor position)"""
+        return int(round(self.attenuator._motor.position))
+
+    def next_level(self, level: int, saturated_fraction: float, top_value: float=None):
+        """
+        Level for the next layer given the statistics at level, returns (level, reason).
+        """
+        _idx = self.levels.index(level) if level in self.levels else 0
+        if saturated_fraction > self.max_fraction:
+            if _idx == len(self.levels) - 1:
+                return level, 'saturated at the most attenuating level'
+            # the saturated pixels are clipped, their true value is unknown: one step
+            return self.levels[_idx + 1], 'saturated'
+        if self.transmission and top_value:
+            # least attenuating level predicted to stay below the saturation
+            for _level in self.levels[:_idx]:
+                if top_value*self.transmission[_level]/self.transmission[level] < self.saturation:
+                    return _level, 'below saturation, less attenuation'
+        return level, 'below saturation'
+
+    def _record(self, layer, level, new_level, saturated_fraction, top_value, reason):
+        _entry = {
+            'layer':              -1 if layer is None else int(layer),
+            'level':              int(level),
+            'new_level':          int(new_level),
+            'saturated_fraction': float(saturated_fraction),
+            'top_value':          float(np.nan if top_value is None else top_value),
+            'reason':             reason,
+            'time':               time.time(),
+        }
+        self.history.append(_entry)
+        print(f"Saturation guard: attenuation {level} -> {new_level} "
+              f"({100*saturated_fraction:.4f}% saturated pixels, {reason})")
+        return _entry
+
+    def _publish(self, entry, stream: str='attenuation'):
+        import bluesky.plan_stubs as bps
+        from ophyd import Signal
+        if self._signals is None:
+            # the same signals for every decision, bluesky needs the same objects per stream
+            self._signals = {k: Signal(name=f"attenuation_{k}", value=v) for k, v in entry.items()}
+        yield from bps.create(stream)
+        for _key, _sig in self._signals.items():
+            _sig.put(entry[_key])
+            yield from bps.read(_sig)
+        yield from bps.save()
+
+    def adjust(self, summary: dict, layer: int=None):
+        """
+        plan, set the attenuation for the next layer from a LiveSpotFinder summary
+        (max_saturated_fraction, max_top_value over the frames of the layer)
+        """
+        import bluesky.plan_stubs as bps
+        if not summary.get('n_frames'):
+            return
+        _level = self.level
+        _new, _reason = self.next_level(_level, summary['max_saturated_fraction'], summary.get('max_top_value'))
+        _entry = self._record(layer, _level, _new, summary['max_saturated_fraction'], summary.get('max_top_value'), _reason)
+        if _new != _level:
+            yield from bps.mv(self.attenuator._motor, _new)
+        yield from self._publish(_entry)
+
+    def test_exposure(self, det, acquire_time: float=None, top_fraction: float=1e-4, timeout: float=60):
+        """
+        plan, short exposures from the least attenuating level up, stop at the
+        first level below max_fraction.
+
+        The camera is acquired directly (not det.trigger), so no datum is
+        generated for the test frames, and the file plugins are disabled
+        meanwhile.  The plugin and camera settings are restored even if the plan
+        is aborted.
+        """
+        import bluesky.plan_stubs as bps
+        import bluesky.preprocessors as bpp
+        _cached = [
+            (me, me.get()) for me in (
+                det.hdf1.enable, det.tiff1.enable,
+                det.cam1.trigger_mode, det.cam1.image_mode,
+                det.cam1.num_images, det.cam1.acquire_time,
+            )
+        ]
+
+        def _exposures():
+            yield from bps.mv(det.hdf1.enable, 0, det.tiff1.enable, 0)
+            yield from bps.mv(
+                det.cam1.trigger_mode, "Internal",
+                det.cam1.image_mode,   "Multiple",
+                det.cam1.num_images,   1,
+            )
+            if acquire_time is not None:
+                yield from bps.mv(det.cam1.acquire_time, acquire_time)
+
+            _start = self.level
+            _stats = None
+            for _level in self.levels:
+                yield from bps.mv(self.attenuator._motor, _level)
+                _counter = det.image1.array_counter.get()
+                yield from bps.abs_set(det.cam1.acquire, 1)
+                # image1 gets the frame after the acquisition is done
+                _t0 = time.time()
+                while det.image1.array_counter.get() == _counter:
+                    if time.time() - _t0 > timeout:
+                        raise RuntimeError(f"No test exposure frame from {det.name} within {timeout} s")
+                    yield from bps.sleep(0.05)
+                _stats = frame_saturation(det.image1.image, self.saturation, top_fraction=top_fraction)
+                if _stats['saturated_fraction'] <= self.max_fraction:
+                    _reason = 'test exposure'
+                    break
+            else:
+                _reason = 'test exposure, saturated at the most attenuating level'
+            _entry = self._record(None, _start, _level, _stats['saturated_fraction'], _stats['top_value'], _reason)
+            yield from self._publish(_entry)
+
+        def _restore():
+            yield from bps.mv(det.cam1.acquire, 0)
+            for me, _value in _cached:
+                yield from bps.mv(me, _value)
+
+        return (yield from bpp.finalize_wrapper(_exposures(), _restore()))
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""
+This module provides a local (SQLite, no server) index of past scans so that a
+scan can be found by setup and scan parameters without querying MongoDB.
+
+The index is populated from the run start documents, either live (subscribed to
+the RunEngine), from the local document journals, or from a databroker.
+
+NOTE:
+* Only runs carrying the scan config in their start document (md 'setup' and
+  'scan_config') can be searched by scan parameters, older runs are indexed by
+  uid and date only.
+"""
+
+import os
+import glob
+import json
+import time
+import sqlite3
+
+from .docstream import read_journal, journal_files
+
+
+# column name, sql type
+_RUN_COLUMNS = (
+    ('uid',          'TEXT PRIMARY KEY'),
+    ('time',         'REAL'),
+    ('date',         'TEXT'),
+    ('setup',        'TEXT'),
+    ('scan_type',    'TEXT'),
+    ('filepath',     'TEXT'),
+    ('fileprefix',   'TEXT'),
+    ('output_type',  'TEXT'),
+    ('acquire_time', 'REAL'),
+    ('omega_start',  'REAL'),
+    ('omega_end',    'REAL'),
+    ('omega_step',   'REAL'),
+    ('ky_start',     'REAL'),
+    ('ky_step',      'REAL'),
+    ('n_layers',     'INTEGER'),
+    ('exit_status',  'TEXT'),
+    ('journal',      'TEXT'),
+    ('start_doc',    'TEXT'),
+)
+
+_INDEXED_COLUMNS = ('time', 'date', 'setup', 'fileprefix', 'acquire_time', 'omega_step', 'ky_start')
+
+# files written next to the detector files after the scan (not detector output),
+# named <detector file><suffix><detector file extension>
+SIDE_FILE_SUFFIXES = ('_revolutions', '_sparse', '_reduced', '_cake')
+
+# HDF5 output types (cfg['output']['type']), also the file extension (file_template)
+HDF5_OUTPUT_TYPES = ('hdf', 'hdf1', 'hdf5', 'h5')
+
+
+def is_side_file(filename: str):
+    """True for the side files (h5tools, ffsparse, ffreduce, azimuthal) of a detector file"""
+    return os.path.splitext(filename)[0].endswith(SIDE_FILE_SUFFIXES)
+
+
+def find_hdf5_files(filepath: str, fileprefix: str, output_type: str=None, file_numbers: tuple=None):
+    """
+    Detector HDF5 files <filepath>/<fileprefix>*.<output_type>, side files excluded.
+
+    Without output_type, any of the HDF5 extensions is accepted.  With
+    file_numbers (first, last), only the files <fileprefix>_<number>.<type>
+    numbered first to last-1 (HDF plugin file_template) are returned.
+    """
+    _types = HDF5_OUTPUT_TYPES if output_type is None else (output_type.lower(), )
+    _files = []
+    for _type in _types:
+        if file_numbers is None:
+            _files += glob.glob(os.path.join(filepath or '', f"{fileprefix}*.{_type}"))
+        else:
+            _files += [
+                me for me in (
+                    os.path.join(filepath or '', f"{fileprefix}_{_n:06d}.{_type}")
+                    for _n in range(*file_numbers)
+                )
+                if os.path.exists(me)
+            ]
+    return sorted(me for me in set(_files) if not is_side_file(me))
+
+
+def _run_row(start_doc):
+    """flatten a start document into the run table columns"""
+    _cfg = start_doc.get('scan_config', {})
+    _setup = start_doc.get('setup')
+    _cfg_setup = _cfg.get(_setup, {}) if _setup else {}
+    _volume = _cfg_setup.get('volume', {})
+    _output = _cfg.get('output', {})
+    _time = start_doc.get('time', time.time())
+    return {
+        'uid':          start_doc['uid'],
+        'time':         _time,
+        'date':         time.strftime('%Y-%m-%d', time.localtime(_time)),
+        'setup':        _setup,
+        'scan_type':    _cfg_setup.get('type'),
+        'filepath':     _output.get('filepath'),
+        'fileprefix':   _output.get('fileprefix'),
+        'output_type':  _output.get('type'),
+        'acquire_time': _cfg_setup.get('acquire_time'),
+        'omega_start':  _cfg_setup.get('omega_start'),
+        'omega_end':    _cfg_setup.get('omega_end'),
+        'omega_step':   _cfg_setup.get('omega_step'),
+        'ky_start':     _volume.get('ky_start'),
+        'ky_step':      _volume.get('ky_step'),
+        'n_layers':     _volume.get('n_layers'),
+        'start_doc':    json.dumps(start_doc, default=str),
+    }
+
+
+class ScanIndex:
+    """
+    Local SQLite index of the scans (one row per run)
+
+    Usage:
+    >> index = ScanIndex()
+    >> RE.subscribe(index)                 # index new runs live
+    >> index.add_journals('~/.local/share/seisidd/journal')
+    >> hits = index.search(setup='tomo', fileprefix='Ti64*', omega_step=(0.1, 0.3))
+    >> index.hdf5_files(hits[0]['uid'])
+    """
+
+    def __init__(self, db_file: str=None):
+        self.db_file = db_file if db_file is not None else os.path.join(
+            os.path.expanduser('~'), '.local', 'share', 'seisidd', 'scan_index.sqlite',
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_file)), exist_ok=True)
+        # the RunEngine may call the subscriber from another thread
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self):
+        _cols = ", ".join(f"{k} {v}" for k, v in _RUN_COLUMNS)
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS runs ({_cols})")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS files (uid TEXT, path TEXT, UNIQUE(uid, path))")
+            for _col in _INDEXED_COLUMNS:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_runs_{_col} ON runs ({_col})")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_uid ON files (uid)")
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    # ---------------
+    # populate
+    def __call__(self, name, doc):
+        """RunEngine subscriber, only start/resource/stop documents are used"""
+        with self._conn:
+            self._add_document(name, doc)
+
+    def _add_document(self, name, doc, journal: str=None):
+        # no commit here, callers group the inserts into one transaction
+        if name == 'start':
+            _row = _run_row(doc)
+            _row['journal'] = journal
+            _keys = list(_row)
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO runs ({', '.join(_keys)}) "
+                f"VALUES ({', '.join('?'*len(_keys))})",
+                [_row[k] for k in _keys],
+            )
+        elif name == 'resource' and doc.get('run_start'):
+            self._conn.execute(
+                "INSERT OR IGNORE INTO files (uid, path) VALUES (?, ?)",
+                (doc['run_start'], doc['resource_path']),
+            )
+        elif name == 'stop':
+            self._conn.execute(
+                "UPDATE runs SET exit_status=? WHERE uid=?",
+                (doc.get('exit_status'), doc['run_start']),
+            )
+
+    def add_start(self, start_doc, journal: str=None):
+        """insert (or update) a run from its start document"""
+        with self._conn:
+            self._add_document('start', start_doc, journal=journal)
+
+    def add_journals(self, path: str, reindex: bool=False):
+        """
+        Index journal file(s) (file, directory or glob pattern).
+
+        Journals already in the index are skipped unless reindex is True.
+        Returns the number of indexed runs.
+        """
+        _known = {me[0] for me in self._conn.execute("SELECT journal FROM runs WHERE journal IS NOT NULL")}
+        _n = 0
+        with self._conn:
+            for _fn in journal_files(os.path.expanduser(path)):
+                if _fn in _known and not reindex:
+                    continue
+                for name, doc in read_journal(_fn):
+                    if name in ('start', 'resource', 'stop'):
+                        self._add_document(name, doc, journal=_fn)
+                        _n += name == 'start'
+        return _n
+
+    def add_broker(self, db, since: str=None, until: str=None):
+        """
+        Index the runs of a databroker (v0), optionally restricted to a time range.
+
+        Example:
+        >> index.add_broker(db, since='2020-09-01')
+        """
+        _kwargs = {k: v for k, v in {'since': since, 'until': until}.items() if v is not None}
+        _n = 0
+        with self._conn:
+            for _h in db(**_kwargs):
+                self._add_document('start', dict(_h.start))
+                if _h.stop:
+                    self._add_document('stop', dict(_h.stop))
+                _n += 1
+        return _n
+
+    # ---------------
+    # query
+    def search(self, since: str=None, until: str=None, limit: int=None, **kwargs):
+        """
+        Search the indexed runs, most recent first.
+
+        Keyword arguments are run columns (setup, fileprefix, acquire_time,
+        omega_step, ky_start, date, ...):
+            value          -> exact match
+            (low, high)    -> inclusive range
+            'Ti64*'        -> glob pattern on text columns
+        since/until are dates ('2020-09-25') or epoch seconds.
+
+        Example:
+        >> index.search(setup='ff', omega_step=0.25, ky_start=(-1, 1), since='2020-09-01')
+        """
+        _columns = {k for k, _ in _RUN_COLUMNS}
+        _where, _args = [], []
+        for _key, _val in kwargs.items():
+            if _key not in _columns:
+                raise ValueError(f"Unknown search field {_key}, use one of {sorted(_columns)}")
+            if isinstance(_val, (tuple, list)):
+                _where.append(f"{_key} BETWEEN ? AND ?")
+                _args += list(_val)
+            elif isinstance(_val, str) and any(c in _val for c in '*?['):
+                _where.append(f"{_key} GLOB ?")
+                _args.append(_val)
+            else:
+                _where.append(f"{_key} = ?")
+                _args.append(_val)
+        for _op, _t in (('>=', since), ('<', until)):
+            if _t is None:
+                continue
+            if isinstance(_t, str):
+                _t = time.mktime(time.strptime(_t, '%Y-%m-%d'))
+            _where.append(f"time {_op} ?")
+            _args.append(_t)
+
+        _sql = "SELECT * FROM runs"
+        if _where:
+            _sql += " WHERE " + " AND ".join(_where)
+        _sql += " ORDER BY time DESC"
+        if limit is not None:
+            _sql += f" LIMIT {int(limit)}"
+        return [
+            {k: me[k] for k in me.keys() if k != 'start_doc'}
+            for me in self._conn.execute(_sql, _args)
+        ]
+
+    def start_doc(self, uid: str):
+        """full start document of an indexed run"""
+        _row = self._conn.execute("SELECT start_doc FROM runs WHERE uid=?", (uid, )).fetchone()
+        if _row is None:
+            raise KeyError(uid)
+        return json.loads(_row[0])
+
+    def hdf5_files(self, uid: str):
+        """
+        HDF5 files written by a run.
+
+        The files registered by the run (resource documents) are used when known,
+        otherwise the files numbered as recorded in the start document
+        (file_numbers) are located from the output filepath/fileprefix of the
+        scan config.  The file prefix is shared by the runs of an experiment, a
+        run without either has no known files.
+        """
+        _files = [me[0] for me in self._conn.execute("SELECT path FROM files WHERE uid=? ORDER BY path", (uid, ))]
+        if _files:
+            return _files
+        _row = self._conn.execute(
+            "SELECT filepath, fileprefix, output_type, start_doc FROM runs WHERE uid=?", (uid, ),
+        ).fetchone()
+        if _row is None:
+            raise KeyError(uid)
+        _numbers = json.loads(_row['start_doc']).get('file_numbers')
+        if _row['filepath'] is None or _row['fileprefix'] is None or _numbers is None:
+            return []
+        _type = _row['output_type'] if _row['output_type'] in HDF5_OUTPUT_TYPES else None
+        return find_hdf5_files(_row['filepath'], _row['fileprefix'], _type, file_numbers=_numbers)
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
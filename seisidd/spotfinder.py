@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+This module provides a live spot finder for the far-field (FF-HEDM) fly scans,
+so that a poorly diffracting (or saturated) sample is seen during the scan
+instead of after it.
+
+Frames are taken from the image plugin (det.image1) while the detector writes
+the HDF5 file, and processed by a pool of worker processes:
+    threshold -> connected components -> centroid and integrated intensity
+The per-frame spot counts and saturation are printed in the notebook and
+recorded in the 'spots' stream of the run (one event per layer).
+
+NOTE:
+* The image plugin only exposes the latest frame, when the workers cannot keep
+  up the finder skips frames (reported as n_skipped) rather than slowing down
+  the acquisition.  The HDF5 file always has all the frames.
+* scipy (ndimage.label) is used for the labeling when available, otherwise a
+  numpy fallback working on the above-threshold pixels only.
+* The workers are spawned (not forked), the acquisition process has live CA
+  threads and open HDF5 files that must not be copied into them.
+"""
+
+import time
+import queue
+import threading
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def label_pixels(rows, cols, shape):
+    """
+    Connected components (4-connectivity) of the pixels (rows, cols) of a frame.
+
+    Returns (labels, n_labels), labels[i] in [0, n_labels) for pixel i.
+    """
+    _n = len(rows)
+    if _n == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    try:
+        from scipy import ndimage
+    except ImportError:
+        ndimage = None
+    if ndimage is not None:
+        _mask = np.zeros(shape, dtype=bool)
+        _mask[rows, cols] = True
+        _label_img, _n_labels = ndimage.label(_mask)
+        return _label_img[rows, cols].astype(np.int64) - 1, _n_labels
+
+    # numpy fallback: propagate the smallest pixel index over the neighbor pairs
+    _lin = rows.astype(np.int64)*shape[1] + cols
+    _order = np.argsort(_lin)
+    _sorted = _lin[_order]
+    _pairs = []
+    for _offset, _valid in ((1, cols < shape[1] - 1), (shape[1], rows < shape[0] - 1)):
+        _target = _lin[_valid] + _offset
+        _idx = np.minimum(np.searchsorted(_sorted, _target), _n - 1)
+        _found = _sorted[_idx] == _target
+        _pairs.append((np.nonzero(_valid)[0][_found], _order[_idx[_found]]))
+    _a = np.concatenate([me[0] for me in _pairs])
+    _b = np.concatenate([me[1] for me in _pairs])
+    _labels = np.arange(_n)
+    while True:
+        _new = _labels.copy()
+        np.minimum.at(_new, _a, _labels[_b])
+        np.minimum.at(_new, _b, _labels[_a])
+        _new = _new[_new]   # pointer jumping
+        if np.array_equal(_new, _labels):
+            break
+        _labels = _new
+    _unique, _labels = np.unique(_labels, return_inverse=True)
+    return _labels.astype(np.int64), len(_unique)
+
+
+def find_spots(
+        frame,
+        threshold,
+        background=0,
+        saturation: float=None,
+        min_pixels: int=3,
+        top_fraction: float=1e-4,
+    ):
+    """
+    Spots of one frame.
+
+    threshold and background are scalars or per-pixel arrays, saturation defaults
+    to the largest value of the frame dtype.  top_value is the value exceeded by
+    top_fraction of the pixels (capped below by the threshold), used by the
+    saturation guard to predict the saturation at another attenuation.
+
+    Example:
+    >> find_spots(img, threshold=200)
+    >> {'n_spots': 42, 'n_saturated': 0, 'saturated_fraction': 0.0, 'intensity': 1.2e6,
+    >>  'centroids': array([[r, c], ...]), 'spot_intensity': array([...]), 'saturated_spots': 0}
+    """
+    _frame = np.asarray(frame)
+    if saturation is None:
+        saturation = np.iinfo(_frame.dtype).max if _frame.dtype.kind in 'iu' else np.inf
+    _rows, _cols = np.nonzero(_frame > threshold)
+    _values = _frame[_rows, _cols].astype(np.float64)
+    _bkg = background[_rows, _cols] if np.ndim(background) else background
+    _saturated = _values >= saturation
+
+    _labels, _n_labels = label_pixels(_rows, _cols, _frame.shape)
+    _n_pixels = np.bincount(_labels, minlength=_n_labels)
+    _weights = np.clip(_values - _bkg, 0, None)
+    _intensity = np.bincount(_labels, weights=_weights, minlength=_n_labels)
+    _keep = (_n_pixels >= min_pixels) & (_intensity > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _centroids = np.stack([
+            np.bincount(_labels, weights=_weights*_rows, minlength=_n_labels)/_intensity,
+            np.bincount(_labels, weights=_weights*_cols, minlength=_n_labels)/_intensity,
+        ], axis=1)[_keep]
+    _sat_spots = np.bincount(_labels, weights=_saturated, minlength=_n_labels)[_keep] > 0
+    _k = max(1, int(top_fraction*_frame.size))
+    _top = float(np.partition(_values, -_k)[-_k]) if _k <= len(_values) else float(np.max(threshold))
+    return {
+        'n_spots':            int(_keep.sum()),
+        'n_saturated':        int(_saturated.sum()),
+        'saturated_fraction': float(_saturated.sum())/_frame.size,
+        'saturated_spots':    int(_sat_spots.sum()),
+        'intensity':          float(_intensity[_keep].sum()),
+        'centroids':          _centroids,
+        'spot_intensity':     _intensity[_keep],
+        'top_value':          _top,
+    }
+
+
+# per worker process settings (see LiveSpotFinder), sent once instead of per frame
+_WORKER_SETTINGS = {}
+
+
+def _init_worker(settings):
+    _WORKER_SETTINGS.update(settings)
+
+
+def _find_spots_worker(frame_index, frame):
+    _result = find_spots(frame, **_WORKER_SETTINGS)
+    _result['frame'] = frame_index
+    return _result
+
+
+class LiveSpotFinder:
+    """
+    Spot finding on the frames of det.image1 while the detector is acquiring
+
+    Usage:
+    >> finder = LiveSpotFinder(det, threshold=200, n_workers=4)
+    >> finder.start()              # before triggering the detector
+    >> ...                         # fly
+    >> finder.stop()               # returns the layer summary
+    >> yield from finder.publish() # 'spots' stream of the run
+    >> finder.close()
+    """
+
+    # per-frame quantities recorded in the 'spots' stream
+    PER_FRAME = ('frame', 'n_spots', 'n_saturated', 'saturated_fraction', 'saturated_spots', 'intensity', 'top_value')
+
+    def __init__(
+            self,
+            det,
+            threshold: float=200,
+            background=0,
+            saturation: float=None,
+            min_pixels: int=3,
+            n_workers: int=4,
+            report_every: int=50,
+            verbose: bool=True,
+        ):
+        self.det = det
+        self.report_every = report_every
+        self.verbose = verbose
+        self._settings = {
+            'threshold':  threshold,
+            'background': background,
+            'saturation': saturation,
+            'min_pixels': min_pixels,
+        }
+        self._n_workers = n_workers
+        self._pool = None
+        self._signals = None
+        self._reset()
+
+    def _reset(self):
+        self.results = {}
+        self.n_skipped = 0
+        self._counter0 = None
+        self._last = None
+        self._pending = []
+        self._new_frames = queue.Queue()
+        self._reader = None
+        self._cid = None
+
+    def set_background(self, dark_frames, n_sigma: float=5.0, min_counts: float=10):
+        """per-pixel background/threshold from dark frames (e.g. the darks of the previous layer)"""
+        from .ffsparse import background_model
+        _bkg, _thr = background_model(dark_frames, n_sigma=n_sigma, min_counts=min_counts)
+        self._settings.update(background=_bkg, threshold=_thr)
+        self.close()   # the workers get the new settings when restarted
+
+    # ---------------
+    # acquisition
+    def _on_counter(self, value=None, **kwargs):
+        # CA callback thread, no blocking get here
+        self._new_frames.put(value)
+
+    def _read_frames(self):
+        while True:
+            _counter = self._new_frames.get()
+            if _counter is None:
+                return
+            # only the latest frame is available in the image plugin
+            while not self._new_frames.empty():
+                _next = self._new_frames.get()
+                if _next is None:
+                    self._new_frames.put(None)
+                    break
+                _counter = _next
+            if self._counter0 is None:
+                self._counter0 = _counter - 1
+            _frame = _counter - self._counter0 - 1
+            if self._last is not None:
+                self.n_skipped += max(0, _counter - self._last - 1)
+            self._last = _counter
+            if sum(not me.done() for me in self._pending) >= 2*self._n_workers:
+                # workers are behind, drop this frame
+                self.n_skipped += 1
+                continue
+            _img = self.det.image1.image
+            _future = self._pool.submit(_find_spots_worker, _frame, _img)
+            _future.add_done_callback(self._on_result)
+            self._pending = [me for me in self._pending if not me.done()] + [_future]
+
+    def _on_result(self, future):
+        if future.exception() is not None:
+            print(f"Spot finder failed: {future.exception()}")
+            return
+        _result = future.result()
+        self.results[_result['frame']] = _result
+        if self.verbose and self.report_every and len(self.results) % self.report_every == 0:
+            _flag = "  SATURATED" if _result['n_saturated'] else ""
+            print(f"frame {_result['frame']:5d}: {_result['n_spots']:4d} spots, "
+                  f"{_result['n_saturated']} saturated pixels{_flag}")
+
+    def start(self):
+        """start following det.image1, call before triggering the detector"""
+        self._reset()
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self._settings, ),
+            )
+        self._reader = threading.Thread(target=self._read_frames, daemon=True)
+        self._reader.start()
+        self._cid = self.det.image1.array_counter.subscribe(self._on_counter, run=False)
+
+    def _unsubscribe(self):
+        if self._cid is not None:
+            self.det.image1.array_counter.unsubscribe(self._cid)
+            self._cid = None
+
+    def stop(self, timeout: float=30):
+        """stop following det.image1 and wait for the frames in flight, return the summary"""
+        self._unsubscribe()
+        self._new_frames.put(None)
+        if self._reader is not None:
+            self._reader.join(timeout)
+        _t0 = time.perf_counter()
+        while any(not me.done() for me in self._pending) and time.perf_counter() - _t0 < timeout:
+            time.sleep(0.05)
+        _summary = self.summary()
+        if self.verbose:
+            print(f"Spot finder: {_summary['n_frames']} frames ({_summary['n_skipped']} skipped), "
+                  f"{_summary['median_spots']:.0f} spots/frame, "
+                  f"{_summary['saturated_frames']} frames with saturated pixels")
+        return _summary
+
+    def close(self):
+        """stop following det.image1 (e.g. scan aborted before stop) and shut down the worker pool"""
+        if self._cid is not None:
+            self._unsubscribe()
+            self._new_frames.put(None)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    # ---------------
+    # results
+    def per_frame(self):
+        """{quantity: array over the processed frames}, sorted by frame"""
+        _frames = sorted(self.results)
+        return {
+            _key: np.array([self.results[me][_key] for me in _frames])
+            for _key in self.PER_FRAME
+        }
+
+    def summary(self):
+        _per_frame = self.per_frame()
+        _n = len(_per_frame['frame'])
+        return {
+            'n_frames':         _n,
+            'n_skipped':        self.n_skipped,
+            'median_spots':     float(np.median(_per_frame['n_spots'])) if _n else 0.0,
+            'saturated_frames': int(np.count_nonzero(_per_frame['n_saturated'])),
+            'max_saturated_fraction': float(_per_frame['saturated_fraction'].max()) if _n else 0.0,
+            'max_top_value':    float(_per_frame['top_value'].max()) if _n else 0.0,
+        }
+
+    def publish(self, stream: str='spots'):
+        """plan, record the per-frame results of the layer as one event of the stream"""
+        import bluesky.plan_stubs as bps
+        from ophyd import Signal
+        _values = dict(self.per_frame(), n_skipped=self.n_skipped)
+        if self._signals is None:
+            # the same signals for every layer, bluesky needs the same objects per stream
+            self._signals = {k: Signal(name=f"spots_{k}", value=v) for k, v in _values.items()}
+        yield from bps.create(stream)
+        for _key, _sig in self._signals.items():
+            _sig.put(_values[_key])
+            yield from bps.read(_sig)
+        yield from bps.save()
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
@@ -6,6 +6,7 @@ notebook interface.
 """
 
 import yaml
+import numpy as np
 
 from tabulate             import tabulate
 from IPython              import get_ipython
@@ -125,6 +126,34 @@ def ff_pso_config(
     return slew_speed, scan_delta, detector_setup_time
 
 
+def golden_angle_interlace(
+        omega_start: float,
+        omega_end: float,
+        omega_step: float,
+        n_interlace: int,
+    ):
+    """
+    Return the golden-angle interlaced angle table for a fly scan.
+
+    The full omega range is covered n_interlace times (loops) with a coarse step of
+    n_interlace*omega_step, and each loop is shifted by a golden-ratio fraction of the
+    coarse step.  Any prefix of the acquisition (first k loops) forms a near-uniform
+    angular sampling, which allows early reconstruction and early termination.
+
+    Example:
+    >> angles, offsets = golden_angle_interlace(0, 180, 0.5, 4)
+    >> angles.shape, offsets
+    >> (4, 90), array([0.   , 1.236, 0.472, 1.708])
+    """
+    _golden = (np.sqrt(5) - 1)/2
+    coarse_step = abs(omega_step)*n_interlace
+    n_per_loop = int(round(abs(omega_end - omega_start)/coarse_step))
+    # the offsets are folded back into [0, coarse_step)
+    offsets = np.mod(np.arange(n_interlace)*_golden, 1.0)*coarse_step
+    angles = omega_start + offsets[:, None] + np.arange(n_per_loop)[None, :]*coarse_step
+    return angles, offsets
+
+
 def load_config(yamlfile):
     """load yaml to a dict"""
     with open(yamlfile, 'r') as stream:
@@ -132,6 +161,29 @@ def load_config(yamlfile):
     return _dict
 
 
+def config_to_md(cfg, setup):
+    """
+    Extract the scan config of one setup as plain python types for the run md.
+
+    Example:
+    >> config_to_md(cfg, 'tomo')
+    >> {'setup': 'tomo', 'scan_config': {'output': {...}, 'tomo': {...}}}
+    """
+    def _builtin(obj):
+        if isinstance(obj, dict):
+            return {str(k): _builtin(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [_builtin(me) for me in obj]
+        if hasattr(obj, 'tolist'):
+            return obj.tolist()  # numpy arrays and scalars
+        return obj
+
+    return {
+        'setup':       setup,
+        'scan_config': _builtin({'output': cfg['output'], setup: cfg[setup]}),
+    }
+
+
 def dict_to_msg(input_dict):
     """
     Unfold a nested dictionary to a string.
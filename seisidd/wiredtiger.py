@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""
+This module provides a reader for raw MongoDB data directories (WiredTiger
+storage engine), so that archived databroker databases can be read without
+restoring them into a running mongod.
+
+The documents are recovered from both places mongod keeps them:
+    collection-*.wt          : checkpointed b-tree pages (snappy compressed)
+    journal/WiredTigerLog.*  : write ahead log records (snappy compressed),
+                               the only copy of the writes after the last
+                               checkpoint
+Every page and log record is decompressed and scanned for complete BSON
+documents.  The databroker documents are recognized by their keys, the catalog
+entries (_mdb_catalog) give the namespaces stored in the directory.
+
+NOTE:
+* The b-tree is not walked from its root, pages left behind by older
+  checkpoints are scanned as well.  This is fine for databroker collections
+  (insert only, deduplicated by uid), it is not a general purpose reader.
+* Only the snappy (mongod default) and uncompressed block formats are
+  supported, zlib/zstd compressed collections are reported as unreadable pages.
+"""
+
+import os
+import struct
+import datetime
+
+
+WT_ALLOCATION_SIZE = 4096      # mongod default allocation_size
+WT_BLOCK_COMPRESS_SKIP = 64    # page header + block header, never compressed
+WT_LOG_ALIGN = 128             # log records are aligned on 128 bytes
+WT_LOG_HEADER = 16             # WT_LOG_RECORD header, never compressed
+WT_PAGE_COMPRESSED = 0x01      # WT_PAGE_HEADER flags
+WT_LOG_RECORD_COMPRESSED = 0x01
+
+
+def snappy_decompress(buf):
+    """decompress a raw (unframed) snappy block"""
+    _pos, _n, _shift = 0, 0, 0
+    while True:
+        _byte = buf[_pos]
+        _pos += 1
+        _n |= (_byte & 0x7f) << _shift
+        _shift += 7
+        if _byte < 0x80:
+            break
+    _out = bytearray()
+    while _pos < len(buf) and len(_out) < _n:
+        _tag = buf[_pos]
+        _pos += 1
+        _type = _tag & 3
+        if _type == 0:
+            # literal
+            _len = _tag >> 2
+            if _len >= 60:
+                _nb = _len - 59
+                _len = int.from_bytes(buf[_pos:_pos+_nb], 'little')
+                _pos += _nb
+            _len += 1
+            _out += buf[_pos:_pos+_len]
+            _pos += _len
+            continue
+        if _type == 1:
+            _len = ((_tag >> 2) & 7) + 4
+            _offset = ((_tag >> 5) << 8) | buf[_pos]
+            _pos += 1
+        elif _type == 2:
+            _len = (_tag >> 2) + 1
+            _offset = int.from_bytes(buf[_pos:_pos+2], 'little')
+            _pos += 2
+        else:
+            _len = (_tag >> 2) + 1
+            _offset = int.from_bytes(buf[_pos:_pos+4], 'little')
+            _pos += 4
+        if _offset == 0 or _offset > len(_out):
+            raise ValueError("corrupted snappy block")
+        if _offset >= _len:
+            _start = len(_out) - _offset
+            _out += _out[_start:_start+_len]
+        else:
+            # overlapping copy (run length encoding)
+            for _ in range(_len):
+                _out.append(_out[-_offset])
+    if len(_out) != _n:
+        raise ValueError("truncated snappy block")
+    return bytes(_out)
+
+
+def _wt_snappy(buf):
+    # the WiredTiger snappy extension stores the compressed length first
+    _len = struct.unpack('<Q', buf[:8])[0]
+    if _len > len(buf) - 8:
+        raise ValueError("corrupted snappy block")
+    return snappy_decompress(buf[8:8+_len])
+
+
+# ---------------
+# BSON
+def _cstring(buf, pos):
+    _end = buf.index(b'\x00', pos)
+    return buf[pos:_end].decode('utf-8'), _end + 1
+
+
+def _bson_value(buf, pos, etype):
+    if etype == 0x01:
+        return struct.unpack_from('<d', buf, pos)[0], pos + 8
+    if etype in (0x02, 0x0D, 0x0E):
+        _len = struct.unpack_from('<i', buf, pos)[0]
+        if _len < 1 or buf[pos+4+_len-1] != 0:
+            raise ValueError("bad BSON string")
+        return buf[pos+4:pos+4+_len-1].decode('utf-8'), pos + 4 + _len
+    if etype in (0x03, 0x04):
+        _doc, _end = decode_bson(buf, pos)
+        return (_doc if etype == 0x03 else list(_doc.values())), _end
+    if etype == 0x05:
+        _len = struct.unpack_from('<i', buf, pos)[0]
+        if _len < 0:
+            raise ValueError("bad BSON binary")
+        return bytes(buf[pos+5:pos+5+_len]), pos + 5 + _len
+    if etype == 0x07:
+        return bytes(buf[pos:pos+12]).hex(), pos + 12
+    if etype == 0x08:
+        if buf[pos] > 1:
+            raise ValueError("bad BSON boolean")
+        return bool(buf[pos]), pos + 1
+    if etype == 0x09:
+        _ms = struct.unpack_from('<q', buf, pos)[0]
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=_ms), pos + 8
+    if etype in (0x06, 0x0A, 0x7F, 0xFF):
+        return None, pos
+    if etype == 0x0B:
+        _pattern, pos = _cstring(buf, pos)
+        _flags, pos = _cstring(buf, pos)
+        return _pattern, pos
+    if etype == 0x10:
+        return struct.unpack_from('<i', buf, pos)[0], pos + 4
+    if etype in (0x11, 0x12):
+        return struct.unpack_from('<Q' if etype == 0x11 else '<q', buf, pos)[0], pos + 8
+    if etype == 0x13:
+        return bytes(buf[pos:pos+16]), pos + 16
+    raise ValueError(f"unknown BSON type {etype:#x}")
+
+
+def decode_bson(buf, pos: int=0):
+    """decode the BSON document at buf[pos:], returns (doc, end position)"""
+    _len = struct.unpack_from('<i', buf, pos)[0]
+    _end = pos + _len
+    if _len < 5 or _end > len(buf) or buf[_end-1] != 0:
+        raise ValueError("bad BSON document length")
+    _doc = {}
+    pos += 4
+    while pos < _end - 1:
+        _etype = buf[pos]
+        _key, pos = _cstring(buf, pos + 1)
+        _doc[_key], pos = _bson_value(buf, pos, _etype)
+    if pos != _end - 1:
+        raise ValueError("BSON document overrun")
+    return _doc, _end
+
+
+def scan_bson(buf):
+    """iterate over the (non-empty) BSON documents found anywhere in buf"""
+    _pos, _n = 0, len(buf)
+    while _pos < _n - 5:
+        _len = struct.unpack_from('<i', buf, _pos)[0]
+        # a document starts with its length and the type of its first element
+        if 5 < _len <= _n - _pos and buf[_pos+_len-1] == 0 and buf[_pos+4] in _BSON_TYPES:
+            try:
+                _doc, _end = decode_bson(buf, _pos)
+            except (ValueError, UnicodeDecodeError, struct.error, IndexError, OverflowError):
+                _pos += 1
+                continue
+            yield _doc
+            _pos = _end
+        else:
+            _pos += 1
+
+
+_BSON_TYPES = frozenset(list(range(0x01, 0x14)) + [0x7F, 0xFF])
+
+
+# ---------------
+# WiredTiger files
+def _read_exact(fileobj, n):
+    _buf = fileobj.read(n)
+    while _buf and len(_buf) < n:
+        _more = fileobj.read(n - len(_buf))
+        if not _more:
+            break
+        _buf += _more
+    return _buf
+
+
+def iter_table_pages(fileobj):
+    """
+    Iterate over the (decompressed) pages of a WiredTiger table file.
+
+    The file is read sequentially (e.g. a tar member), unreadable blocks are
+    skipped.
+    """
+    # the first allocation unit is the file descriptor block
+    _block = _read_exact(fileobj, WT_ALLOCATION_SIZE)
+    while True:
+        _block = _read_exact(fileobj, WT_ALLOCATION_SIZE)
+        if len(_block) < WT_BLOCK_COMPRESS_SKIP:
+            return
+        _mem_size = struct.unpack_from('<I', _block, 16)[0]
+        _flags = _block[25]
+        _disk_size = struct.unpack_from('<I', _block, 28)[0]
+        if _disk_size < WT_ALLOCATION_SIZE or _disk_size % WT_ALLOCATION_SIZE:
+            continue
+        _block += _read_exact(fileobj, _disk_size - WT_ALLOCATION_SIZE)
+        try:
+            if _flags & WT_PAGE_COMPRESSED:
+                yield _block[:WT_BLOCK_COMPRESS_SKIP] + _wt_snappy(_block[WT_BLOCK_COMPRESS_SKIP:])
+            else:
+                yield _block[:min(_mem_size, _disk_size)]
+        except (ValueError, IndexError, struct.error):
+            continue
+
+
+def iter_log_records(fileobj):
+    """
+    Iterate over the (decompressed) records of a WiredTiger log file.
+
+    Reading stops at the first empty record, the rest of a log file is
+    preallocated zeros.
+    """
+    while True:
+        _header = _read_exact(fileobj, WT_LOG_HEADER)
+        if len(_header) < WT_LOG_HEADER:
+            return
+        _len, _, _flags, _, _mem_len = struct.unpack('<IIHHI', _header)
+        if _len < WT_LOG_HEADER:
+            return
+        _size = -(-_len // WT_LOG_ALIGN)*WT_LOG_ALIGN
+        _body = _read_exact(fileobj, _size - WT_LOG_HEADER)
+        if len(_body) < _len - WT_LOG_HEADER:
+            return
+        _body = _body[:_len - WT_LOG_HEADER]
+        try:
+            yield _wt_snappy(_body) if _flags & WT_LOG_RECORD_COMPRESSED else _body
+        except (ValueError, IndexError, struct.error):
+            continue
+
+
+def is_wiredtiger_file(filename: str):
+    """WiredTiger data directory files, tables (*.wt), logs and metadata"""
+    _base = os.path.basename(filename)
+    return _base.endswith('.wt') or _base.startswith('WiredTiger') or _base in ('mongod.lock', 'storage.bson')
+
+
+def iter_wiredtiger_bson(fileobj, filename: str):
+    """
+    Iterate over the BSON documents stored in one file of a data directory.
+
+    Tables (*.wt) and logs (WiredTigerLog.*) are read, the other files
+    (metadata, preallocated logs, locks) hold no documents.
+    """
+    _base = os.path.basename(filename)
+    if _base.endswith('.wt') and not _base.startswith('WiredTiger'):
+        _chunks = iter_table_pages(fileobj)
+    elif _base.startswith('WiredTigerLog.'):
+        _chunks = iter_log_records(fileobj)
+    else:
+        return
+    for _chunk in _chunks:
+        yield from scan_bson(_chunk)
+
+
+# databroker (v0/mongo_normalized) document name from its keys
+def databroker_name(doc: dict):
+    """name of a databroker document (start, stop, ...) or None"""
+    if 'datum_id' in doc and 'resource' in doc:
+        return 'datum'
+    if 'spec' in doc and 'resource_path' in doc:
+        return 'resource'
+    if 'descriptor' in doc and 'seq_num' in doc and 'data' in doc:
+        return 'event'
+    if 'run_start' in doc and 'data_keys' in doc:
+        return 'descriptor'
+    if 'run_start' in doc and 'exit_status' in doc:
+        return 'stop'
+    if 'uid' in doc and 'time' in doc and not {'run_start', 'descriptor', 'resource'} & set(doc):
+        return 'start'
+    return None
+
+
+if __name__ == "__main__":
+    print("Example usage see corresponding notebooks")
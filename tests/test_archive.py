@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.archive and seisidd.wiredtiger, on synthetic archives (journal
+tarballs and a hand made WiredTiger data directory) and the archived test
+databases under seisidd/private.
+"""
+
+import io
+import os
+import json
+import struct
+import tarfile
+
+from seisidd.archive import import_archive
+from seisidd.docstream import read_journal
+from seisidd.wiredtiger import snappy_decompress, decode_bson, iter_wiredtiger_bson
+
+
+PRIVATE = os.path.join(os.path.dirname(__file__), os.pardir, 'seisidd', 'private')
+
+
+def _run_documents(uid: str='run0', n_events: int=6, t0: float=100.0):
+    yield 'start', {'uid': uid, 'time': t0, 'scan_id': 1}
+    yield 'descriptor', {'uid': f'{uid}-desc', 'run_start': uid, 'data_keys': {'x': {}}, 'time': t0}
+    yield 'resource', {'uid': f'{uid}-res', 'run_start': uid, 'spec': 'AD_HDF5', 'resource_path': 'a.h5'}
+    for i in range(n_events):
+        yield 'datum', {'datum_id': f'{uid}-res/{i}', 'resource': f'{uid}-res', 'datum_kwargs': {}}
+        yield 'event', {
+            'uid': f'{uid}-ev{i}', 'descriptor': f'{uid}-desc', 'seq_num': i + 1,
+            'time': t0 + i, 'data': {'x': i}, 'timestamps': {'x': t0 + i},
+        }
+    yield 'stop', {'uid': f'{uid}-stop', 'run_start': uid, 'exit_status': 'success', 'time': t0 + n_events}
+
+
+def _tarball(path, members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in members.items():
+            _info = tarfile.TarInfo(name)
+            _info.size = len(data)
+            tar.addfile(_info, io.BytesIO(data))
+    return str(path)
+
+
+def _journal_bytes(docs):
+    return "".join(json.dumps([name, doc]) + "\n" for name, doc in docs).encode()
+
+
+def test_import_journal_archive_twice(tmp_path):
+    _docs = list(_run_documents('run0')) + list(_run_documents('run1', n_events=3, t0=200.0))
+    # children stored before their run (e.g. collections dumped in any order)
+    _docs = [me for me in _docs if me[0] == 'event'] + [me for me in _docs if me[0] != 'event']
+    _tar = _tarball(tmp_path/'archive.tar.gz', {'journal/runs.jsonl': _journal_bytes(_docs)})
+
+    for _ in range(2):
+        _result = import_archive(_tar, str(tmp_path/'journal'), verbose=False)
+        assert _result['verified']
+        assert _result['runs'] == 2
+        assert _result['journal'] == {'start': 2, 'descriptor': 2, 'resource': 2, 'datum': 9, 'event': 9, 'stop': 2}
+    assert len(os.listdir(tmp_path/'journal')) == 2
+
+    _names = [name for name, _ in read_journal(_result['files'][0])]
+    assert _names[:3] == ['start', 'descriptor', 'resource']
+    assert _names[-1] == 'stop'
+
+
+def test_import_reports_orphans(tmp_path):
+    _docs = list(_run_documents('run0'))
+    _docs.append(('event', dict(_docs[4][1], uid='lost', descriptor='unknown')))
+    _tar = _tarball(tmp_path/'archive.tar.gz', {'runs.jsonl': _journal_bytes(_docs)})
+    _result = import_archive(_tar, str(tmp_path/'journal'), verbose=False)
+    assert _result['orphans'] == {'event': 1}
+    assert _result['verified']
+
+
+def test_snappy_literal_and_copy():
+    # 'abcd' literal, then a copy of 8 bytes at offset 4 (overlapping)
+    _block = bytes([12, 3 << 2]) + b'abcd' + bytes([((8 - 4) << 2) | 1, 4])
+    assert snappy_decompress(_block) == b'abcdabcdabcd'
+
+
+def _bson(doc):
+    """minimal BSON encoder (str, float, int, dict) for the tests"""
+    _body = b''
+    for _key, _value in doc.items():
+        _name = _key.encode() + b'\x00'
+        if isinstance(_value, str):
+            _data = _value.encode() + b'\x00'
+            _body += b'\x02' + _name + struct.pack('<i', len(_data)) + _data
+        elif isinstance(_value, float):
+            _body += b'\x01' + _name + struct.pack('<d', _value)
+        elif isinstance(_value, int):
+            _body += b'\x10' + _name + struct.pack('<i', _value)
+        else:
+            _body += b'\x03' + _name + _bson(_value)
+    return struct.pack('<i', len(_body) + 5) + _body + b'\x00'
+
+
+def test_decode_bson():
+    _doc = {'uid': 'abc', 'time': 1.5, 'scan_id': 3, 'md': {'setup': 'tomo'}}
+    assert decode_bson(_bson(_doc)) == (_doc, len(_bson(_doc)))
+
+
+def _wt_table(docs):
+    """uncompressed WiredTiger table file, one leaf page with the documents"""
+    _payload = b''.join(b'\x05' + _bson(me) for me in docs)
+    _mem_size = 64 + len(_payload)
+    _disk_size = -(-_mem_size // 4096)*4096
+    _page = struct.pack('<QQIIBBBB', 0, 1, _mem_size, len(docs), 7, 0, 0, 0)
+    _page += struct.pack('<IIB3x', _disk_size, 0, 0)
+    _page = _page.ljust(64, b'\x00') + _payload
+    return bytes(4096) + _page.ljust(_disk_size, b'\x00')
+
+
+def _wt_log(docs):
+    """uncompressed WiredTiger log file, one record per document"""
+    _log = b''
+    for me in docs:
+        _record = b'\x00'*8 + _bson(me)
+        _len = 16 + len(_record)
+        _log += (struct.pack('<IIHHI', _len, 0, 0, 0, _len) + _record).ljust(-(-_len // 128)*128, b'\x00')
+    return _log + bytes(1024)
+
+
+def test_wiredtiger_pages_and_log_records():
+    _docs = [{'uid': f'u{i}', 'time': float(i)} for i in range(3)]
+    assert list(iter_wiredtiger_bson(io.BytesIO(_wt_table(_docs)), 'db/collection-2--1.wt')) == _docs
+    assert list(iter_wiredtiger_bson(io.BytesIO(_wt_log(_docs)), 'db/journal/WiredTigerLog.0000000001')) == _docs
+
+
+def test_import_wiredtiger_archive(tmp_path):
+    _docs = list(_run_documents('run0', n_events=4))
+    _catalog = {'ns': 'metadatastore.run_start', 'ident': 'collection-2--1', 'md': {'ns': 'metadatastore.run_start'}}
+    # the events were checkpointed, the rest is in the log only (and repeated)
+    _events = [doc for name, doc in _docs if name == 'event']
+    _others = [doc for name, doc in _docs if name != 'event']
+    _tar = _tarball(tmp_path/'db.tar.gz', {
+        'db/_mdb_catalog.wt':                 _wt_table([_catalog]),
+        'db/collection-2--1.wt':              _wt_table(_events),
+        'db/journal/WiredTigerLog.0000000001': _wt_log(_others + _events[:2]),
+        'db/WiredTiger.lock':                 b'WiredTiger lock file\n',
+    })
+    _result = import_archive(_tar, str(tmp_path/'journal'), verbose=False)
+    assert _result['verified']
+    assert _result['runs'] == 1
+    assert _result['journal']['event'] == 4
+    assert _result['namespaces'] == ['metadatastore.run_start']
+
+
+def test_archived_test_databases_hold_no_runs(tmp_path):
+    _result = import_archive(
+        os.path.join(PRIVATE, 'test_10-17-2019', 'db.tar.gz'), str(tmp_path/'journal'), verbose=False,
+    )
+    assert _result['runs'] == 0
+    assert 'local.startup_log' in _result['namespaces']
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.azimuthal, on a small synthetic detector.
+"""
+
+import numpy as np
+import pytest
+
+from seisidd.azimuthal import AzimuthalIntegrator, detector_to_angles
+
+
+GEOMETRY = {
+    'shape':      (64, 80),
+    'pixel_size': (0.2, 0.2),
+    'center':     (31.5, 39.5),
+    'distance':   50.0,
+    'tilt_x':     0.0,
+    'tilt_y':     0.0,
+}
+
+
+def _integrator(tmp_path, **kwargs):
+    _kwargs = dict(tth_range=(0, 12), n_tth=48, n_eta=8, cache_dir=str(tmp_path/'lut'))
+    _kwargs.update(kwargs)
+    return AzimuthalIntegrator(GEOMETRY, **_kwargs)
+
+
+def test_eta_counter_clockwise_from_the_horizontal():
+    _tth, _eta = detector_to_angles([31.5, 21.5, 31.5], [49.5, 39.5, 29.5], GEOMETRY)
+    np.testing.assert_allclose(_eta, [0, 90, 180], atol=1e-9)
+    np.testing.assert_allclose(_tth, np.degrees(np.arctan(2/50)))
+
+
+def test_flat_frame_gives_a_flat_cake(tmp_path):
+    _ai = _integrator(tmp_path)
+    _cake = _ai.integrate(np.full(GEOMETRY['shape'], 3.0))
+    assert _cake.shape == (8, 48)
+    _covered = _ai.coverage.reshape(_ai.shape) > 0
+    np.testing.assert_allclose(_cake[_covered], 3.0, rtol=1e-6)
+    assert np.isnan(_cake[~_covered]).all()
+    # the 2theta range covers the whole detector, every pixel is shared out completely
+    assert _ai.coverage.sum() == pytest.approx(np.prod(GEOMETRY['shape']))
+
+
+def test_ring_profile_peaks_at_the_ring(tmp_path):
+    _ai = _integrator(tmp_path)
+    _tth, _ = detector_to_angles(*np.mgrid[0:64, 0:80], GEOMETRY)
+    _frames = np.stack([np.exp(-((_tth - me)/0.3)**2) for me in (4.0, 6.0)])
+    _profiles = _ai.integrate1d(_frames)
+    assert _profiles.shape == (2, 48)
+    np.testing.assert_allclose(_ai.tth[np.nanargmax(_profiles, axis=1)], [4.0, 6.0], atol=0.25)
+    # block integration gives the same cakes
+    _blocks = dict(_ai.iter_integrate(_frames, block=1))
+    np.testing.assert_allclose(np.concatenate([_blocks[0], _blocks[1]]), _ai.integrate(_frames))
+
+
+def test_lookup_table_cached_on_disk(tmp_path):
+    _ai = _integrator(tmp_path)
+    _again = _integrator(tmp_path)
+    assert _again.lut_file == _ai.lut_file
+    np.testing.assert_array_equal(_again._indices, _ai._indices)
+    np.testing.assert_array_equal(_again._data, _ai._data)
+    _mask = np.zeros(GEOMETRY['shape'], dtype=bool)
+    _mask[:, :40] = True
+    _masked = _integrator(tmp_path, mask=_mask)
+    assert _masked.lut_file != _ai.lut_file
+    assert _masked.coverage.sum() == pytest.approx(_mask.size/2)
+
+
+def test_integrate_file(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    _frames = np.arange(3, dtype=np.uint16)[:, None, None]*np.ones((1, 64, 80), dtype=np.uint16)
+    with h5py.File(tmp_path/'ff_000001.h5', 'w') as h5f:
+        h5f['/exchange/data'] = _frames
+    _ai = _integrator(tmp_path)
+    _fn = _ai.integrate_file(str(tmp_path/'ff_000001.h5'), block=2)
+    assert _fn == str(tmp_path/'ff_000001_cake.h5')
+    with h5py.File(_fn, 'r') as h5f:
+        _cake = h5f['/exchange/cake'][()]
+        assert _cake.shape == (3, 8, 48)
+        np.testing.assert_allclose(np.nanmax(_cake, axis=(1, 2)), [0, 1, 2], rtol=1e-6)
+        np.testing.assert_allclose(h5f['/exchange/tth'][()], _ai.tth)
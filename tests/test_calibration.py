@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.calibration, on a synthetic CeO2 ring image.
+"""
+
+import numpy as np
+import pytest
+
+from seisidd.azimuthal import detector_to_angles
+from seisidd.calibration import calibrant_rings, calibrate, calibrate_file
+
+
+ENERGY = 71.676
+NOMINAL = {'shape': (400, 400), 'pixel_size': (0.2, 0.2), 'center': (199.5, 199.5),
+           'distance': 300.0, 'tilt_x': 0.0, 'tilt_y': 0.0}
+TRUE = dict(NOMINAL, center=(201.3, 198.2), distance=304.0)
+
+
+def _ring_image(geometry=TRUE, width: float=0.01, background: float=10.0):
+    _tth, _ = detector_to_angles(*np.mgrid[0:400, 0:400], geometry)
+    _img = np.full(_tth.shape, background)
+    for me in calibrant_rings('CeO2', ENERGY, tth_max=float(_tth.max())):
+        _img += 1000*np.exp(-(_tth - me)**2/(2*width**2))
+    return _img
+
+
+def test_calibrate_synthetic_ring():
+    _result = calibrate(_ring_image(), ENERGY, geometry=NOMINAL, fix=('tilt_x', 'tilt_y'), verbose=False)
+    _geometry = _result['geometry']
+    assert np.allclose(_geometry['center'], TRUE['center'], atol=0.1)
+    assert _geometry['distance'] == pytest.approx(TRUE['distance'], abs=0.5)
+    assert _result['rms_tth'] < 5e-3
+
+
+def test_calibrate_file_sums_in_blocks(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    _img = _ring_image()
+    _frames = np.stack([np.zeros_like(_img)] + [_img + 100]*5).astype(np.uint16)
+    _fn = str(tmp_path/'CeO2_000001.h5')
+    with h5py.File(_fn, 'w') as h5f:
+        h5f['/exchange/data'] = _frames
+        h5f['/exchange/data_dark'] = np.full((3, 400, 400), 100, dtype=np.uint16)
+    # two frames per block
+    _result = calibrate_file(
+        _fn, ENERGY, geometry=NOMINAL, max_memory=2*400*400*8, fix=('tilt_x', 'tilt_y'), verbose=False,
+    )
+    _direct = calibrate(
+        5*_img.astype(np.uint16).astype(float), ENERGY, geometry=NOMINAL, fix=('tilt_x', 'tilt_y'), verbose=False,
+    )
+    assert np.allclose(_result['geometry']['center'], _direct['geometry']['center'])
+    assert _result['geometry']['distance'] == pytest.approx(_direct['geometry']['distance'])
+    assert _result['source'] == _fn
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.docstream, on synthetic RunEngine document streams.
+"""
+
+from seisidd.docstream import BufferedInserter, DocumentJournal, EventPageBuffer, insert_documents
+
+
+def _step_scan_documents(n_frames: int=12, frames_per_file: int=5):
+    """documents of a step scan with file registration (resource per file, datum per frame)"""
+    yield 'start', {'uid': 'start0', 'time': 0.0}
+    yield 'descriptor', {'uid': 'desc0', 'run_start': 'start0', 'name': 'primary'}
+    for i in range(n_frames):
+        if i % frames_per_file == 0:
+            yield 'resource', {'uid': f'res{i}', 'run_start': 'start0'}
+        yield 'datum', {'datum_id': f'res/{i}', 'resource': f'res{i - i % frames_per_file}'}
+        yield 'event', {
+            'descriptor': 'desc0',
+            'uid':        f'ev{i}',
+            'seq_num':    i + 1,
+            'time':       float(i),
+            'data':       {'det_image': f'res/{i}'},
+            'timestamps': {'det_image': float(i)},
+            'filled':     {'det_image': False},
+        }
+    yield 'stop', {'uid': 'stop0', 'run_start': 'start0'}
+
+
+def test_page_buffer_batches_step_scan_with_datums():
+    _docs = []
+    _buffer = EventPageBuffer(lambda name, doc: _docs.append((name, doc)), page_size=5)
+    for name, doc in _step_scan_documents(n_frames=12):
+        _buffer(name, doc)
+
+    _pages = [doc for name, doc in _docs if name == 'event_page']
+    assert [len(me['uid']) for me in _pages] == [5, 5, 2]
+    assert [name for name, _ in _docs].count('datum') == 12
+    # every datum is emitted before the page holding its event
+    _seen = set()
+    for name, doc in _docs:
+        if name == 'datum':
+            _seen.add(doc['datum_id'])
+        elif name == 'event_page':
+            assert set(doc['data']['det_image']) <= _seen
+    assert _docs[-1][0] == 'stop'
+
+
+def test_page_buffer_flushes_on_descriptor_change():
+    _docs = []
+    _buffer = EventPageBuffer(lambda name, doc: _docs.append((name, doc)), page_size=100)
+    _events = [doc for name, doc in _step_scan_documents(n_frames=3) if name == 'event']
+    for me in _events:
+        _buffer('event', me)
+    _buffer('descriptor', {'uid': 'desc1', 'run_start': 'start0', 'name': 'baseline'})
+    assert [name for name, _ in _docs] == ['event_page', 'descriptor']
+    assert len(_docs[0][1]['uid']) == 3
+
+
+class _FakeMds:
+    def __init__(self):
+        self.bulk = []
+
+    def bulk_insert_events(self, descriptor, events):
+        self.bulk.append((descriptor, len(events)))
+
+
+class _FakeDb:
+    def __init__(self):
+        self.mds = _FakeMds()
+        self.inserted = []
+
+    def insert(self, name, doc):
+        self.inserted.append(name)
+
+
+def test_insert_documents_batches_events_across_datums():
+    _db = _FakeDb()
+    insert_documents(_db, list(_step_scan_documents(n_frames=12)))
+    assert _db.mds.bulk == [('desc0', 12)]
+    assert _db.inserted.count('datum') == 12
+    assert _db.inserted[-1] == 'stop'
+
+
+class _DownDb:
+    def insert(self, name, doc):
+        raise ConnectionError("MongoDB is down")
+
+
+def _run_documents(uid):
+    yield 'start', {'uid': uid, 'time': 0.0}
+    yield 'descriptor', {'uid': f'{uid}-desc', 'run_start': uid, 'name': 'primary'}
+    yield 'stop', {'uid': f'{uid}-stop', 'run_start': uid}
+
+
+def test_inserter_close_writes_a_full_queue():
+    _db = _FakeDb()
+    _inserter = BufferedInserter(_db, maxsize=3, batch_size=2, flush_interval=0.01)
+    for uid in ['r0', 'r1', 'r2']:
+        for name, doc in _run_documents(uid):
+            _inserter(name, doc)
+    _inserter.close()
+    assert not _inserter._worker.is_alive()
+    assert _db.inserted == ['start', 'descriptor', 'stop']*3
+
+
+def test_inserter_with_journal_replays_missed_runs(tmp_path):
+    _journal = DocumentJournal(str(tmp_path/'journal'))
+    _inserter = BufferedInserter(
+        _DownDb(), flush_interval=0.01, spool_dir=str(tmp_path/'spool'), journal=_journal,
+    )
+    for uid in ['r0', 'r1']:
+        for name, doc in _run_documents(uid):
+            _inserter(name, doc)
+            _journal(name, doc)
+    _inserter.flush()
+    # documents go to the journal only
+    assert not (tmp_path/'spool').exists()
+    _db = _FakeDb()
+    assert _inserter.drain(_db) == 6
+    assert _db.inserted == ['start', 'descriptor', 'stop']*2
+    assert _inserter.online
+    _inserter.close()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.ffsparse, on small synthetic FF layer files.
+"""
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from seisidd.ffsparse import SparseFrames, frame_omega, sparsify_file
+
+
+def _ff_layer(path, n_frames: int=9, shape: tuple=(16, 20)):
+    """flat background (98-102 counts) with two spots per frame, and 4 dark frames"""
+    _f, _r, _c = np.indices((n_frames, ) + shape)
+    _data = (98 + (_f + _r + 2*_c) % 5).astype(np.uint16)
+    _dark = _data[:4].copy()
+    for i in range(n_frames):
+        _data[i, i, (2*i) % shape[1]] = 5000 + i
+        _data[i, shape[0]-1, 3] = 4000
+    with h5py.File(path, 'w') as h5f:
+        h5f['/exchange/data'] = _data
+        h5f['/exchange/data_dark'] = _dark
+    return _data
+
+
+def test_sparsify_file_keeps_the_spots(tmp_path):
+    _data = _ff_layer(tmp_path/'ff_000001.h5')
+    _stats = sparsify_file(str(tmp_path/'ff_000001.h5'), omega=np.arange(9)*0.25, block=4, verbose=False)
+    assert _stats['file'] == str(tmp_path/'ff_000001_sparse.h5')
+    assert _stats['nnz'] == 2*9
+
+    with SparseFrames(_stats['file']) as ff:
+        assert ff.shape == _data.shape
+        assert ff.dtype == _data.dtype
+        np.testing.assert_array_equal(ff.nnz, 2)
+        np.testing.assert_array_equal(ff.omega, np.arange(9)*0.25)
+        _spots = np.where(_data > 1000, _data, 0)
+        np.testing.assert_array_equal(ff[:], _spots)
+        np.testing.assert_array_equal(ff[7], _spots[7])
+        np.testing.assert_array_equal(ff[8:1:-3], _spots[8:1:-3])
+        _rows, _cols, _values = ff.pixels(2)
+        assert list(zip(_rows, _cols, _values)) == [(2, 4, 5002), (15, 3, 4000)]
+
+
+def test_sparse_frames_background_fill(tmp_path):
+    _ff_layer(tmp_path/'ff_000001.h5')
+    _stats = sparsify_file(str(tmp_path/'ff_000001.h5'), verbose=False)
+    with SparseFrames(_stats['file'], fill='background') as ff:
+        _frame = ff[0]
+        assert _frame[0, 0] == 5000
+        assert abs(float(np.median(_frame)) - 100) < 10
+        assert np.isnan(ff.omega).all()
+
+
+def test_frame_omega_skips_the_taxi_frame_of_each_layer():
+    _md = {
+        'scan_config': {'ff': {'omega_start': 0.0, 'omega_step': 0.5}},
+        'volume_capture': {'frames_per_layer': {'data': 3}},
+    }
+    np.testing.assert_allclose(frame_omega(_md, 6), [-0.5, 0, 0.5, -0.5, 0, 0.5])
+    assert frame_omega({}, 6) is None
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.h5tools, on small synthetic dxchange files.
+"""
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from seisidd import h5tools
+from seisidd.h5tools import _compress_frame, rewrite_volume, to_sinograms
+
+
+def _projections(path, n_frames: int=7, shape: tuple=(5, 6)):
+    _data = np.arange(n_frames*shape[0]*shape[1], dtype=np.uint16).reshape((n_frames, ) + shape)
+    with h5py.File(path, 'w') as h5f:
+        h5f['/exchange/data'] = _data
+    return _data
+
+
+def test_to_sinograms_round_trip(tmp_path):
+    _data = _projections(tmp_path/'proj.h5')
+    # 3 frames per block, the last block is partial
+    _stats = to_sinograms(
+        str(tmp_path/'proj.h5'), str(tmp_path/'sino.h5'), max_memory=2*3*_data[0].nbytes, verbose=False,
+    )
+    assert _stats['frames_per_block'] == 3
+    with h5py.File(tmp_path/'sino.h5', 'r') as h5f:
+        _sino = h5f['/exchange/sinogram']
+        assert _sino.chunks == (1, 3, 6)
+        np.testing.assert_array_equal(_sino[()], _data.transpose(1, 0, 2))
+
+
+def test_rewrite_volume_round_trip(tmp_path):
+    _data = np.arange(2*3*4*5, dtype=np.uint16).reshape(2, 3, 4, 5)
+    with h5py.File(tmp_path/'volume.h5', 'w') as h5f:
+        h5f['/exchange/data'] = _data
+        h5f['/exchange/ky'] = [0.0, 0.5]
+    rewrite_volume(str(tmp_path/'volume.h5'), str(tmp_path/'volume_gz.h5'), level=1, n_workers=2)
+    with h5py.File(tmp_path/'volume_gz.h5', 'r') as h5f:
+        assert h5f['/exchange/data'].compression == 'gzip'
+        assert h5f['/exchange/data'].chunks == (1, 1, 4, 5)
+        np.testing.assert_array_equal(h5f['/exchange/data'][()], _data)
+        np.testing.assert_array_equal(h5f['/exchange/ky'][()], [0.0, 0.5])
+
+
+def test_worker_files_are_closed(tmp_path):
+    _data = np.ones((1, 2, 4, 5), dtype=np.uint16)
+    with h5py.File(tmp_path/'volume.h5', 'w') as h5f:
+        h5f['/exchange/data'] = _data
+    _compress_frame((str(tmp_path/'volume.h5'), '/exchange/data', 0, 1, 1))
+    _h5f = h5tools._WORKER_FILES[str(tmp_path/'volume.h5')]
+    h5tools._close_worker_files()
+    assert not h5tools._WORKER_FILES
+    assert not _h5f.id.valid
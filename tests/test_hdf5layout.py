@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.hdf5layout, with a stand-in HDF plugin.
+"""
+
+import types
+
+import pytest
+
+from seisidd.hdf5layout import configure_hdf_layout
+
+
+class _PV:
+    def __init__(self, value=None):
+        self.value = value
+
+    def get(self, as_string=False):
+        return self.value
+
+    def put(self, value):
+        self.value = value
+
+
+def _det(data_type: str, shape: tuple=(2048, 2448)):
+    _hdf1 = types.SimpleNamespace(
+        array_size=types.SimpleNamespace(height=_PV(shape[0]), width=_PV(shape[1])),
+        data_type=_PV(data_type),
+        **{me: _PV() for me in (
+            'xml_file_name', 'num_frames_chunks', 'num_row_chunks', 'num_col_chunks', 'compression', 'zlevel',
+        )},
+    )
+    return types.SimpleNamespace(hdf1=_hdf1)
+
+
+@pytest.mark.parametrize('data_type, n_rows', [
+    ('UInt8', 16), ('Int16', 8), ('UInt32', 4), ('Float32', 4), ('Int64', 2), ('Float64', 2),
+])
+def test_sinogram_chunks_follow_the_data_type(data_type, n_rows):
+    # 1 MB chunks of 64 frames of 1024 pixels wide rows
+    _det_sim = _det(data_type, shape=(2048, 1024))
+    assert configure_hdf_layout(_det_sim, 'tomo')['chunks'] == (64, n_rows, 1024)
+    assert _det_sim.hdf1.num_row_chunks.get() == n_rows
+
+
+def test_unknown_data_type():
+    with pytest.raises(ValueError):
+        configure_hdf_layout(_det('Complex'), 'tomo')
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.loader, on small synthetic dxchange files.
+"""
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from seisidd.loader import ScanData, load_scan
+from seisidd.scanindex import ScanIndex
+
+
+def _layer(path, layer: int, n_frames: int=6, shape: tuple=(3, 4)):
+    _data = (100*layer + np.arange(n_frames*shape[0]*shape[1])).astype(np.uint16).reshape((n_frames, ) + shape)
+    with h5py.File(path, 'w') as h5f:
+        h5f['/exchange/data'] = _data
+        h5f['/exchange/data_dark'] = np.zeros((2, ) + shape, dtype=np.uint16)
+    return _data
+
+
+def _tomo_md(**kwargs):
+    _md = {
+        'setup': 'tomo',
+        'scan_config': {'tomo': {'omega_start': 0.0, 'omega_step': 30.0, 'volume': {'ky_start': 1.0, 'ky_step': 0.5}}},
+    }
+    _md.update(kwargs)
+    return _md
+
+
+def test_load_layer_files_by_prefix(tmp_path):
+    _layers = [_layer(tmp_path/f'Ti64_00000{i}.hdf', i) for i in (1, 2)]
+    _layer(tmp_path/'Ti64_000001_sparse.hdf', 9)
+    _scan = load_scan('Ti64', filepath=str(tmp_path), output_type='hdf')
+    assert _scan.files == [str(tmp_path/'Ti64_000001.hdf'), str(tmp_path/'Ti64_000002.hdf')]
+    assert _scan.data.shape == (2, 6, 3, 4)
+    np.testing.assert_array_equal(np.asarray(_scan.data[1, ::2]), _layers[1][::2])
+    np.testing.assert_array_equal(np.asarray(_scan.data[:, 3, 1]), np.stack([me[3, 1] for me in _layers]))
+    assert _scan.data_dark.shape == (2, 2, 3, 4)
+    assert _scan.data_white_pre is None
+    # no run metadata, no guessed angles
+    assert _scan.angles is None
+    _scan.close()
+
+
+def test_load_volume_capture_file(tmp_path):
+    # two layers of 3 frames (and 1 dark frame) in one file
+    _data = _layer(tmp_path/'Ti64_000001.h5', 0)
+    _md = _tomo_md(volume_capture={
+        'n_layers': 2,
+        'frames_per_layer': {'data': 3, 'data_white_pre': 0, 'data_white_post': 0, 'data_dark': 1},
+    })
+    _scan = ScanData([str(tmp_path/'Ti64_000001.h5')], md=_md)
+    assert _scan.data.shape == (2, 3, 3, 4)
+    assert _scan.data_dark.shape == (2, 1, 3, 4)
+    np.testing.assert_array_equal(np.asarray(_scan.data[1]), _data[3:])
+    np.testing.assert_array_equal(np.asarray(_scan.data[1, 1:, 2]), _data[4:, 2])
+    np.testing.assert_allclose(_scan.angles, [0.0, 30.0, 60.0])
+    np.testing.assert_allclose(_scan.ky, [1.0, 1.5])
+    _scan.close()
+
+
+def test_load_scan_from_the_index(tmp_path):
+    _layers = [_layer(tmp_path/f'Ti64_00000{i}.hdf', i) for i in (1, 2, 3)]
+    _md = _tomo_md(
+        uid='run0', time=0.0, file_numbers=[2, 4],
+        scan_config=dict(_tomo_md()['scan_config'], output={'filepath': str(tmp_path), 'fileprefix': 'Ti64', 'type': 'hdf'}),
+    )
+    _index = ScanIndex(str(tmp_path/'index.sqlite'))
+    _index.add_start(_md)
+    _scan = load_scan('run0', index=_index)
+    # only the files written by the run
+    assert _scan.files == [str(tmp_path/'Ti64_000002.hdf'), str(tmp_path/'Ti64_000003.hdf')]
+    np.testing.assert_array_equal(np.asarray(_scan.data[0]), _layers[1])
+    np.testing.assert_allclose(_scan.angles, np.arange(6)*30.0)
+    np.testing.assert_allclose(_scan.ky, [1.0, 1.5])
+    _scan.close()
+    _index.close()
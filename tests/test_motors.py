@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+Tests for the angle wrapping of seisidd.devices.motors.AeroEpicsMotor, against a
+simulated motor (ophyd fake EPICS signals, plans inspected message by message).
+"""
+
+import pytest
+
+pytest.importorskip('ophyd')
+pytest.importorskip('bluesky')
+
+from ophyd.sim import make_fake_device
+
+from seisidd.devices.motors import AeroEpicsMotor
+
+
+FakeAeroEpicsMotor = make_fake_device(AeroEpicsMotor)
+
+
+def _rot(position, dial=None, direction=0):
+    """simulated rotation at position (user) with dial readback dial"""
+    rot = FakeAeroEpicsMotor('SIM:m1', name='rot')
+    rot.user_direction.sim_put(direction)
+    rot.dial_readback.sim_put(position if dial is None else dial)
+    rot.motor_is_moving.sim_put(0)
+    rot.user_readback.sim_put(position)
+    return rot
+
+
+def _sets(plan):
+    """(object, value) of the set messages of a plan, without a RunEngine"""
+    _msgs = []
+    try:
+        _msg = next(plan)
+        while True:
+            if _msg.command == 'set':
+                _msgs.append((_msg.obj, _msg.args[0]))
+            _msg = plan.send(None)
+    except StopIteration:
+        pass
+    return _msgs
+
+
+@pytest.mark.parametrize('position, target', [
+    (718.0, 0.0), (-718.0, 0.0), (720.0, 0.0), (-720.0, 0.0),
+    (360.0, 0.0), (0.0, 360.0), (179.0, 0.0), (181.0, 0.0),
+    (-181.0, 0.0), (1079.5, 360.0), (12.3, -45.0),
+])
+def test_turns_to_unwind_within_half_a_turn(position, target):
+    _n_turns = AeroEpicsMotor.turns_to_unwind(position, target)
+    assert isinstance(_n_turns, int)
+    assert abs(position - 360*_n_turns - target) <= 180
+
+
+@pytest.mark.parametrize('position, n_turns', [
+    (720.0, 2), (-720.0, -2), (360.0, 1), (0.0, 0), (-1.0, 0),
+])
+def test_turns_to_unwind_exact_multiples(position, n_turns):
+    assert AeroEpicsMotor.turns_to_unwind(position, 0.0) == n_turns
+
+
+@pytest.mark.parametrize('direction, dial, new_dial', [
+    (0,  718.0,  -2.0),   # .DIR Pos, the dial follows the user position
+    (1, -718.0,   2.0),   # .DIR Neg, the dial goes the other way
+])
+def test_unwind_near_redefines_the_dial(direction, dial, new_dial):
+    rot = _rot(718.0, dial=dial, direction=direction)
+    _msgs = _sets(rot.unwind_near(0.0))
+    assert _msgs == [
+        (rot.set_use_switch, 1),
+        (rot.dial_setpoint,  new_dial),
+        (rot.set_use_switch, 0),
+    ]
+
+
+def test_unwind_near_negative_position():
+    rot = _rot(-718.0)
+    assert _sets(rot.unwind_near(0.0))[1] == (rot.dial_setpoint, -718.0 + 720.0)
+
+
+def test_unwind_near_returns_turns():
+    rot = _rot(1080.0)
+    _plan = rot.unwind_near(0.0)
+    with pytest.raises(StopIteration) as _stop:
+        _msg = next(_plan)
+        while True:
+            _msg = _plan.send(None)
+    assert _stop.value.value == 3
+
+
+def test_no_redefinition_when_already_near():
+    rot = _rot(10.0)
+    assert _sets(rot.unwind_near(0.0)) == []
+
+
+def test_unwind_refused_while_moving():
+    rot = _rot(718.0)
+    rot.motor_is_moving.sim_put(1)
+    with pytest.raises(RuntimeError):
+        _sets(rot.unwind(2))
+
+
+def test_unwind_restores_use_on_abort():
+    rot = _rot(718.0)
+    _plan = rot.unwind(2)
+    _msgs = [next(_plan)]
+    # abort right after switching to Set
+    _msg = _plan.throw(RuntimeError('abort'))
+    _restore = []
+    with pytest.raises(RuntimeError):
+        while True:
+            if _msg.command == 'set':
+                _restore.append((_msg.obj, _msg.args[0]))
+            _msg = _plan.send(None)
+    assert _msgs[0].obj is rot.set_use_switch and _msgs[0].args[0] == 1
+    assert _restore == [(rot.set_use_switch, 0)]
+
+
+@pytest.mark.parametrize('position, target, n_turns', [
+    (718.0, 0.0, 2), (-358.0, 0.0, -1), (720.0, 0.0, 2), (5.0, 0.0, 0),
+])
+def test_shortest_move(position, target, n_turns):
+    rot = _rot(position)
+    _msgs = _sets(rot.shortest_move(target))
+    assert _msgs[-1] == (rot, target)
+    if n_turns:
+        assert _msgs[1] == (rot.dial_setpoint, position - 360*n_turns)
+    else:
+        assert _msgs == [(rot, target)]
+
+
+def _psofly():
+    from seisidd.devices.motors import SimEnsemblePSOFlyDevice
+    from ophyd import EpicsMotor
+    psofly = SimEnsemblePSOFlyDevice(name='psofly')
+    psofly._motor = make_fake_device(EpicsMotor)('SIM:m4', name='psofly_motor')
+    psofly._motor.user_setpoint.sim_set_limits((-3600, 3600))
+    return psofly
+
+
+def test_fly_angles_single_sweep():
+    psofly = _psofly()
+    _angles = [0.0, 0.5, 1.0, 7.0, 7.1, 30.0]
+    _msgs = []
+    _plan = psofly.fly_angles(_angles, slew_speed=2)
+    try:
+        _msg = next(_plan)
+        while True:
+            _msgs.append(_msg)
+            _msg = _plan.send(None)
+    except StopIteration:
+        pass
+    _sets = [(me.obj, me.args[0]) for me in _msgs if me.command == 'set']
+    _values = dict((obj.attr_name, value) for obj, value in _sets)
+    assert list(_values['pso_array']) == _angles
+    assert _values['start'] == 0.0
+    assert _values['end'] == pytest.approx(30.1)
+    assert _values['scan_delta'] == pytest.approx(0.1)
+    # one taxi and one fly for the whole angle list, PSO back to window mode after
+    assert [obj.attr_name for obj, _ in _sets].count('taxi') == 1
+    assert [obj.attr_name for obj, _ in _sets].count('fly') == 1
+    assert [value for obj, value in _sets if obj.attr_name == 'pso_mode'] == ["Array", "Window"]
+    # angles recorded in the run
+    assert [me.command for me in _msgs][-3:] == ['create', 'read', 'save']
+    assert _msgs[-3].kwargs['name'] == 'trigger_angles'
+
+
+@pytest.mark.parametrize('angles', [[], [1.0, 0.5], [[0.0, 1.0]]])
+def test_fly_angles_rejects_bad_angles(angles):
+    with pytest.raises(ValueError):
+        next(_psofly().fly_angles(angles))
+
+
+def test_sim_taxi_and_fly_move_the_rotation():
+    psofly = _psofly()
+    psofly.start.put(10.0)
+    psofly.end.put(50.0)
+    psofly.scan_delta.put(0.5)
+    psofly.taxi.set("Taxi")
+    assert psofly.motor.user_setpoint.get() == 9.5
+    psofly.fly.set("1")
+    assert psofly.motor.user_setpoint.get() == 50.0
+
+
+def test_step_pulses_follow_the_frame_counter():
+    from ophyd import Signal
+    psofly = _psofly()
+    rot = _rot(0.0)
+    counter = Signal(name='array_counter', value=0)
+    _plan = psofly.step_pulses(rot, [0.0, 1.0], counter, n_frames=3, timeout=1)
+    _sets = []
+    try:
+        _msg = next(_plan)
+        while True:
+            if _msg.command == 'set':
+                _sets.append((_msg.obj, _msg.args[0]))
+                if _msg.obj is psofly.soft_pulse:
+                    # the detector counts the frame
+                    counter.put(counter.get() + 1)
+            _msg = _plan.send(None)
+    except StopIteration:
+        pass
+    assert counter.get() == 6
+    assert [obj for obj, _ in _sets] == [rot] + [psofly.soft_pulse]*3 + [rot] + [psofly.soft_pulse]*3
+
+
+def test_step_pulses_time_out_on_a_lost_frame():
+    from ophyd import Signal
+    psofly = _psofly()
+    counter = Signal(name='array_counter', value=0)
+    with pytest.raises(RuntimeError, match='missed a pulse'):
+        _sets(psofly.step_pulses(_rot(0.0), [0.0], counter, timeout=0.05))
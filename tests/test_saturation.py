@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Tests for seisidd.saturation, against simulated signals (plans inspected
+message by message).
+"""
+
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ophyd')
+pytest.importorskip('bluesky')
+
+from ophyd import Signal
+from ophyd.sim import SynAxis
+
+from seisidd.saturation import SaturationGuard, attenuation_levels, frame_saturation
+
+
+def _run(plan, on_set=None):
+    """execute the set messages of a plan without a RunEngine, returns the created streams"""
+    _streams = []
+    try:
+        _msg = next(plan)
+        while True:
+            if _msg.command == 'set':
+                # Signal.set completes in a background thread, put is immediate
+                if isinstance(_msg.obj, Signal):
+                    _msg.obj.put(_msg.args[0])
+                else:
+                    _msg.obj.set(_msg.args[0])
+                if on_set is not None:
+                    on_set(_msg.obj, _msg.args[0])
+            elif _msg.command == 'create':
+                _streams.append(_msg.kwargs.get('name', _msg.args[0] if _msg.args else None))
+            _msg = plan.send(None)
+    except StopIteration:
+        pass
+    return _streams
+
+
+def _guard(level: int=0, **kwargs):
+    _motor = SynAxis(name='att')
+    _motor.set(level)
+    return SaturationGuard(types.SimpleNamespace(_motor=_motor), saturation=100, levels=[0, 1, 2, 3], **kwargs)
+
+
+def test_attenuation_levels_least_attenuating_first():
+    assert attenuation_levels({3: 0.5, 0: 0.0, 1: 0.1, 2: 0.1}) == [0, 1, 2, 3]
+
+
+def test_frame_saturation():
+    _frame = np.zeros((100, 100))
+    _frame[:2, :5] = 100
+    _frame[50, 50] = 80
+    _stats = frame_saturation(_frame, saturation=100, top_fraction=1e-3)
+    assert _stats['saturated_fraction'] == pytest.approx(1e-3)
+    assert _stats['top_value'] == 100
+    assert frame_saturation(_frame, 100, top_fraction=11e-4)['top_value'] == 80
+
+
+def test_next_level_steps_up_when_saturated():
+    _guard_sim = _guard(max_fraction=1e-4)
+    assert _guard_sim.next_level(1, 1e-3) == (2, 'saturated')
+    assert _guard_sim.next_level(3, 1e-3) == (3, 'saturated at the most attenuating level')
+    # no transmission table, the guard never lowers the attenuation
+    assert _guard_sim.next_level(2, 0.0, top_value=1) == (2, 'below saturation')
+
+
+def test_next_level_lowers_with_transmission():
+    _guard_sim = _guard(transmission={0: 1.0, 1: 0.5, 2: 0.1, 3: 0.01})
+    # 15 counts at T=0.1: 150 at T=1 (saturated), 75 at T=0.5
+    assert _guard_sim.next_level(2, 0.0, top_value=15) == (1, 'below saturation, less attenuation')
+
+
+def test_adjust_moves_the_attenuator_and_records_the_decision():
+    _guard_sim = _guard(level=1)
+    _summary = {'n_frames': 10, 'max_saturated_fraction': 0.01, 'max_top_value': 100}
+    assert _run(_guard_sim.adjust(_summary, layer=3)) == ['attenuation']
+    assert _guard_sim.level == 2
+    assert _guard_sim.history[-1]['layer'] == 3
+    assert _guard_sim.history[-1]['new_level'] == 2
+    # nothing collected, nothing decided
+    assert _run(_guard_sim.adjust({'n_frames': 0}, layer=4)) == []
+    assert len(_guard_sim.history) == 1
+
+
+def _detector():
+    def _sig(name, value):
+        return Signal(name=name, value=value)
+    return types.SimpleNamespace(
+        name='det',
+        hdf1=types.SimpleNamespace(enable=_sig('hdf1_enable', 1)),
+        tiff1=types.SimpleNamespace(enable=_sig('tiff1_enable', 0)),
+        cam1=types.SimpleNamespace(
+            trigger_mode=_sig('trigger_mode', 'External'),
+            image_mode=_sig('image_mode', 'Continuous'),
+            num_images=_sig('num_images', 1800),
+            acquire_time=_sig('acquire_time', 0.3),
+            acquire=_sig('acquire', 0),
+        ),
+        image1=types.SimpleNamespace(array_counter=_sig('array_counter', 0), image=None),
+    )
+
+
+def test_test_exposure_stops_at_the_first_unsaturated_level():
+    _guard_sim = _guard(level=0)
+    _det = _detector()
+    _file_enabled = []
+
+    def _camera(obj, value):
+        if obj is _det.cam1.acquire and value == 1:
+            _file_enabled.append(_det.hdf1.enable.get())
+            # saturated below level 2
+            _det.image1.image = np.full((10, 10), 100 if _guard_sim.level < 2 else 50)
+            _det.image1.array_counter.put(_det.image1.array_counter.get() + 1)
+
+    _streams = _run(_guard_sim.test_exposure(_det, acquire_time=0.05), on_set=_camera)
+    assert _streams == ['attenuation']
+    assert _guard_sim.level == 2
+    assert _file_enabled == [0, 0, 0]
+    assert _guard_sim.history[-1]['reason'] == 'test exposure'
+    # the camera and the file plugins are restored
+    assert _det.hdf1.enable.get() == 1
+    assert _det.cam1.trigger_mode.get() == 'External'
+    assert _det.cam1.num_images.get() == 1800
+    assert _det.cam1.acquire_time.get() == 0.3
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Tests for the file lookup of seisidd.scanindex.
+"""
+
+import os
+
+from seisidd.scanindex import ScanIndex, is_side_file, find_hdf5_files
+
+
+def _touch(path, names):
+    for me in names:
+        open(os.path.join(path, me), 'w').close()
+
+
+def test_side_files_keep_the_detector_extension():
+    assert is_side_file('/data/Ti64_000001_sparse.hdf')
+    assert is_side_file('/data/Ti64_000001_revolutions.h5')
+    assert not is_side_file('/data/Ti64_000001.hdf')
+    assert not is_side_file('/data/Ti64_sparse_000001.hdf')
+
+
+def test_find_hdf5_files_default_output_type(tmp_path):
+    _touch(tmp_path, [
+        'Ti64_000001.hdf', 'Ti64_000001_sparse.hdf', 'Ti64_000001_reduced.hdf',
+        'Ti64_000002.hdf', 'Ti64_000002.tiff', 'Other_000001.hdf',
+    ])
+    _expected = [str(tmp_path/'Ti64_000001.hdf'), str(tmp_path/'Ti64_000002.hdf')]
+    assert find_hdf5_files(str(tmp_path), 'Ti64', 'hdf') == _expected
+    assert find_hdf5_files(str(tmp_path), 'Ti64') == _expected
+    assert find_hdf5_files(str(tmp_path), 'Ti64', 'hdf5') == []
+
+
+def test_hdf5_files_only_lists_the_files_of_the_run(tmp_path):
+    _touch(tmp_path, ['Ti64_000001.hdf', 'Ti64_000002.hdf', 'Ti64_000003.hdf', 'Ti64_000002_sparse.hdf'])
+    _cfg = {'setup': 'tomo', 'tomo': {}, 'output': {'filepath': str(tmp_path), 'fileprefix': 'Ti64', 'type': 'hdf'}}
+    index = ScanIndex(str(tmp_path/'index.sqlite'))
+    index.add_start({'uid': 'a', 'time': 0, 'setup': 'tomo', 'scan_config': _cfg, 'file_numbers': [2, 4]})
+    index.add_start({'uid': 'b', 'time': 1, 'setup': 'tomo', 'scan_config': _cfg})
+    index.add_start({'uid': 'c', 'time': 2, 'setup': 'tomo', 'scan_config': _cfg, 'file_numbers': [1, 2]})
+    index(
+        'resource',
+        {'uid': 'r', 'run_start': 'c', 'spec': 'AD_HDF5', 'resource_path': '/data/Ti64_000001.hdf'},
+    )
+    assert index.hdf5_files('a') == [str(tmp_path/'Ti64_000002.hdf'), str(tmp_path/'Ti64_000003.hdf')]
+    # neither registered files nor file numbers, the shared prefix is not enough
+    assert index.hdf5_files('b') == []
+    assert index.hdf5_files('c') == ['/data/Ti64_000001.hdf']
+    index.close()